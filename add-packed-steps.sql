@@ -0,0 +1,6 @@
+-- Add the column holding the packed steps of routes, written by
+-- runroutes.py --packed-steps, to databases created before it.
+
+-- run me as: psql osrm osm < add-packed-steps.sql
+
+ALTER TABLE osrmroutes ADD COLUMN steps BYTEA;
@@ -0,0 +1,13 @@
+-- Number the routes in the order they are added, for incremental
+-- edge frequency updates with refresh-edge-frequencies.sql.
+-- Existing routes are numbered in table order.
+
+-- run me as: psql osrm osm < add-route-seq.sql
+
+BEGIN;
+
+CREATE SEQUENCE osrmroutes_seq;
+ALTER TABLE osrmroutes ADD COLUMN seq BIGINT DEFAULT nextval('osrmroutes_seq');
+CREATE INDEX ix_osrmroutes_seq ON osrmroutes (seq);
+
+COMMIT;
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks the route runner engines against a local stub OSRM server
+
+Each engine runs the same routes through the runroutes.py pipeline, and
+the throughput, request latency percentiles and DB write rate are
+reported.  Without --dbconnection, the routes are converted but not
+written.
+"""
+__license__ = None
+
+import argparse
+import logging
+import threading
+import time
+
+import numpy
+from sqlalchemy import create_engine
+
+from stanalysis.localrouter import DEFAULT_PER_ORIGIN
+from stanalysis.osrmcache import open_osrm
+from stanalysis.pipeline import Pipeline
+from stanalysis.routegraph import RouteGraph
+from stanalysis.routewriter import RouteWriter, convert_route
+from stanalysis.stubosrm import start_stub_server
+import stanalysis.models as models
+from runroutes import generate_route_pairs, make_fetcher
+
+log = logging.getLogger(__name__)
+
+
+class TimedFetcher(object):
+    """Record the latency of each call to a route fetching function"""
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def __call__(self, coords):
+        start = time.time()
+        result = self.fetch(coords)
+        with self._lock:
+            self.latencies.append(time.time() - start)
+        return result
+
+
+class CountingSink(object):
+    """Stands in for a RouteWriter, counting the routes instead"""
+
+    def __init__(self):
+        self.routes_written = 0
+        self.steps_written = 0
+
+    def add(self, converted):
+        self.routes_written += 1
+        self.steps_written += len(converted.edge_ids)
+
+    __call__ = add
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def run_benchmark(pairs, fetch, workers, sink, convert_workers=1,
+                  queue_size=1000):
+    """Run routes through the pipeline, and measure them
+
+    Returns a dictionary of the measurements.
+    """
+    timed = TimedFetcher(fetch)
+    pipeline = Pipeline(pairs, report_every=10)
+    pipeline.add_stage('fetch', timed, workers, queue_size)
+    pipeline.add_stage('convert', convert_route, convert_workers,
+                       queue_size)
+    pipeline.add_stage('write', sink, 1, queue_size)
+    start = time.time()
+    with sink:
+        pipeline.run()
+    elapsed = time.time() - start
+    latencies = numpy.array(timed.latencies or [numpy.nan]) * 1E3
+    return {
+        'routes': len(timed.latencies),
+        'seconds': elapsed,
+        'routes/s': len(timed.latencies) / elapsed,
+        'p50 ms': numpy.percentile(latencies, 50),
+        'p99 ms': numpy.percentile(latencies, 99),
+        'rows/s': sink.steps_written / elapsed,
+    }
+
+
+if __name__ == "__main__":  # pragma: nocover
+    parser = argparse.ArgumentParser()
+    parser.add_argument('N', type=int, help='Number of routes per engine')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Increase log output')
+    parser.add_argument(
+        '--engines', nargs='+', choices=['threads', 'pooled', 'local'],
+        default=['threads', 'pooled'],
+        help='Engines to benchmark. Default %(default)s')
+    parser.add_argument(
+        '--threads', type=int, default=2,
+        help='Workers of the "threads" engine. Default %(default)s')
+    parser.add_argument(
+        '--max-in-flight', type=int, default=200,
+        help='Concurrent requests for the "pooled" and "local" engines. '
+        'Default %(default)s')
+    parser.add_argument(
+        '--processes', type=int,
+        help='Routing processes of the "local" engine, which routes over '
+        'the stub server graph. Default one per CPU')
+    parser.add_argument(
+        '--destinations-per-origin', type=int,
+        help='Destinations drawn for each origin, more than one with the '
+        '"local" engine. Default %i with the "local" engine, otherwise 1'
+        % DEFAULT_PER_ORIGIN)
+    parser.add_argument(
+        '--convert-workers', type=int, default=1,
+        help='Number of threads converting routes. Default %(default)s')
+    parser.add_argument(
+        '--queue-size', type=int, default=1000,
+        help='Capacity of the pipeline queues. Default %(default)s')
+    stubgroup = parser.add_argument_group('stub OSRM server')
+    stubgroup.add_argument(
+        '--grid', type=int, nargs=2, default=[100, 100],
+        metavar=('NX', 'NY'),
+        help='Size of the synthetic street grid. Default %(default)s')
+    stubgroup.add_argument(
+        '--osrm-file',
+        help='Route over the graph of this .osrm file instead of a grid')
+    stubgroup.add_argument(
+        '--latency', type=float, default=0.02,
+        help='Seconds of latency of each response. Default %(default)s')
+    stubgroup.add_argument(
+        '--jitter', type=float, default=0.01,
+        help='Maximum seconds of random extra latency. '
+        'Default %(default)s')
+    stubgroup.add_argument(
+        '--host',
+        help='Benchmark an OSRM server at this host instead of the stub. '
+        'Its nodes are still taken from --grid or --osrm-file')
+    stubgroup.add_argument('--port', type=int, default=5000,
+                           help='Port of the --host server')
+    dbgroup = parser.add_argument_group('postgis db')
+    dbgroup.add_argument(
+        '--dbconnection',
+        help='Write the routes to this scratch database. The route tables '
+        'are recreated before each engine runs')
+    dbgroup.add_argument(
+        '--flush-rows', type=int, default=100000,
+        help='Write buffered routes once they have this many steps. '
+        'Default %(default)s')
+
+    args = parser.parse_args()
+    if args.destinations_per_origin is None:
+        args.destinations_per_origin = \
+            DEFAULT_PER_ORIGIN if 'local' in args.engines else 1
+    elif 'local' in args.engines and args.destinations_per_origin < 2:
+        parser.error('--engines local needs --destinations-per-origin > 1')
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+    logging.getLogger("requests.packages.urllib3.connectionpool").setLevel(
+        logging.WARNING)
+
+    if args.osrm_file:
+        router = RouteGraph.from_osrm(*open_osrm(args.osrm_file))
+    else:
+        router = RouteGraph.grid(*args.grid)
+
+    if args.host:
+        host, port = args.host, args.port
+    else:
+        server = start_stub_server(router, latency=args.latency,
+                                   jitter=args.jitter)
+        host, port = server.server_address
+
+    engine = None
+    if args.dbconnection:
+        engine = create_engine(args.dbconnection)
+
+    for name in args.engines:
+        fetch, workers = make_fetcher(
+            name, host, port, args.threads, args.max_in_flight, router,
+            args.processes)
+        if engine is not None:
+            models.OSRMRouteStep.__table__.drop(engine, checkfirst=True)
+            models.OSRMRoute.__table__.drop(engine, checkfirst=True)
+            models.Base.metadata.create_all(engine)
+            sink = RouteWriter(engine.raw_connection(), args.flush_rows)
+        else:
+            sink = CountingSink()
+        pairs = generate_route_pairs(args.N, router.coords, args.seed,
+                                     per_origin=args.destinations_per_origin)
+        result = run_benchmark(pairs, fetch, workers, sink,
+                               args.convert_workers, args.queue_size)
+        if name in ('pooled', 'local'):
+            fetch.close()
+        print '%-8s routes=%i  %s' % (name, result['routes'], '  '.join(
+            '%s=%0.1f' % (key, result[key]) for key in (
+                'seconds', 'routes/s', 'p50 ms', 'p99 ms', 'rows/s')))
+
+    if not args.host:
+        server.shutdown()
+        server.server_close()
@@ -3,7 +3,17 @@
 
 -- run me as: psql osrm osm < edge-frequencies.sql
 
-DROP TABLE edgefrequencies;
+-- The counts are rebuilt from osrmroutesteps, so don't run this after
+-- runroutes.py --edge-frequencies --no-steps, whose counts would be lost.
+
+-- To count routes added afterwards, use refresh-edge-frequencies.sql.
+
+BEGIN;
+
+-- Hold off new routes, so the watermark matches the counted steps
+LOCK TABLE osrmroutes IN SHARE MODE;
+
+DROP TABLE IF EXISTS edgefrequencies;
 
 CREATE TABLE edgefrequencies (
   edge BIGINT NOT NULL,
@@ -25,7 +35,7 @@ CREATE INDEX "idx_edgefrequences_edge" ON edgefrequencies (edge);
 
 -- Now do a version with merged forward-backwards and 
 -- populated geometry for easy QGIS viewing.
-DROP TABLE edgefrequencies_bothways;
+DROP TABLE IF EXISTS edgefrequencies_bothways;
 CREATE TABLE edgefrequencies_bothways (
   edge BIGINT NOT NULL,
   freq BIGINT,
@@ -49,3 +59,19 @@ INNER JOIN osrmedges AS rawedge ON rawedge.hash = edges.edge
 GROUP BY edges.edge, geoms.geom, CAST(rawedge.distance AS FLOAT) / CAST(rawedge.weight AS FLOAT);
 
 CREATE INDEX "idx_edgefrequencies_bothways_geom" ON "public"."edgefrequencies_bothways" USING GIST (geom);
+
+-- The last route counted so far
+DROP TABLE IF EXISTS edgefrequencies_watermark;
+CREATE TABLE edgefrequencies_watermark (
+  seq BIGINT NOT NULL
+);
+INSERT INTO edgefrequencies_watermark (seq)
+SELECT COALESCE(MAX(seq), 0) FROM osrmroutes;
+
+-- Every route up to the watermark is counted now
+CREATE TABLE IF NOT EXISTS edgefrequencies_counted (
+  seq BIGINT PRIMARY KEY
+);
+DELETE FROM edgefrequencies_counted;
+
+COMMIT;
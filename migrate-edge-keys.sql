@@ -0,0 +1,64 @@
+-- Convert edge and route keys from Python's hash() to the deterministic
+-- keys of stanalysis/keys.py.  Edge keys are (min << 32) | max of the
+-- node ids, route hashes are the first 64 bits of the MD5 of the
+-- comma separated start/end coordinates.
+
+-- run me as: psql osrm osm < migrate-edge-keys.sql
+
+-- Afterwards, rebuild the derived tables with edge-frequencies.sql.
+
+BEGIN;
+
+CREATE TEMPORARY TABLE edge_key_map AS
+SELECT
+  hash AS old_key,
+  (LEAST(source, sink)::bigint << 32) | GREATEST(source, sink)::bigint
+    AS new_key
+FROM osrmedges;
+
+CREATE INDEX "idx_edge_key_map" ON edge_key_map (old_key);
+
+CREATE TEMPORARY TABLE route_hash_map AS
+SELECT
+  route_hash AS old_hash,
+  ('x' || substr(md5(start_lat || ',' || start_lon || ','
+                     || end_lat || ',' || end_lon), 1, 16))::bit(64)::bigint
+    AS new_hash
+FROM osrmroutes;
+
+CREATE INDEX "idx_route_hash_map" ON route_hash_map (old_hash);
+
+-- The referencing tables are updated before the keys they point to.
+ALTER TABLE edgefrequencies DROP CONSTRAINT IF EXISTS edgefrequencies_edge_fkey;
+ALTER TABLE osrmedgegeoms DROP CONSTRAINT IF EXISTS osrmedgegeoms_hash_fkey;
+
+UPDATE osrmroutesteps SET edge_id = map.new_key
+FROM edge_key_map AS map WHERE osrmroutesteps.edge_id = map.old_key;
+
+UPDATE osrmroutesteps SET route_hash = map.new_hash
+FROM route_hash_map AS map WHERE osrmroutesteps.route_hash = map.old_hash;
+
+UPDATE osrmroutes SET route_hash = map.new_hash
+FROM route_hash_map AS map WHERE osrmroutes.route_hash = map.old_hash;
+
+UPDATE edgefrequencies SET edge = map.new_key
+FROM edge_key_map AS map WHERE edgefrequencies.edge = map.old_key;
+
+UPDATE osrmedgegeoms SET hash = map.new_key
+FROM edge_key_map AS map WHERE osrmedgegeoms.hash = map.old_key;
+
+UPDATE osrmedges SET hash = map.new_key
+FROM edge_key_map AS map WHERE osrmedges.hash = map.old_key;
+
+ALTER TABLE edgefrequencies ADD CONSTRAINT edgefrequencies_edge_fkey
+  FOREIGN KEY (edge) REFERENCES osrmedges (hash);
+ALTER TABLE osrmedgegeoms ADD CONSTRAINT osrmedgegeoms_hash_fkey
+  FOREIGN KEY (hash) REFERENCES osrmedges (hash);
+
+COMMIT;
+
+ANALYZE osrmedges;
+ANALYZE osrmedgegeoms;
+ANALYZE osrmroutes;
+ANALYZE osrmroutesteps;
+ANALYZE edgefrequencies;
@@ -12,25 +12,43 @@ import logging
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
-from stanalysis.osrmbinary import unpack_osrm_nodes, unpack_osrm_edges
+from stanalysis.bulkload import bulk_upload_osrm, deferred_upload_osrm, \
+    update_osrm
+from stanalysis.osrmbinary import unique_edge_rows
+from stanalysis.osrmcache import open_osrm
+from stanalysis.parallelload import parallel_upload_osrm
 from stanalysis.models import OSRMNode, OSRMEdge, Base
 
 log = logging.getLogger(__name__)
 
 
-def upload_osrm_binary(binaryfd, dbsession, merge=False, commit_every=1000):
+def iter_columns(table, fields, rows=None):
+    ''' Iterate over the rows of a node or edge table
+
+    Yields tuples of native Python values of the given fields.
+
+    :param: rows - optional array of the row indices to iterate over
+    '''
+    if rows is None:
+        return zip(*[table[field].tolist() for field in fields])
+    return zip(*[table[field][rows].tolist() for field in fields])
+
+
+def upload_osrm_binary(nodes, edges, dbsession, merge=False,
+                       commit_every=1000):
     ''' Upload OSRM data into the db
 
-    :param: binaryfd - a file descript pointing to the .osrm data
+    :param: nodes - the OSRM node records, e.g. :attr:`OSRMFile.nodes`
+    :param: edges - the OSRM edge records, e.g. :attr:`OSRMFile.edges`
     :param: dbsession - an active :class:`sqlalchemy.Session`
     '''
 
     insert_method = dbsession.add if not merge else dbsession.merge
     log.info("Loading OSRM node data")
     nodes_added = 0
-    for node in unpack_osrm_nodes(binaryfd):
-        ormified = OSRMNode(node.id, node.lat, node.lon,
-                            node.bollard, node.traffic_light)
+    for node_id, lat, lon, bollard, traffic_light in iter_columns(
+            nodes, ('id', 'lat', 'lon', 'bollard', 'traffic_light')):
+        ormified = OSRMNode(node_id, lat, lon, bollard, traffic_light)
         insert_method(ormified)
         nodes_added += 1
         if nodes_added % commit_every == 0:
@@ -40,23 +58,13 @@ def upload_osrm_binary(binaryfd, dbsession, merge=False, commit_every=1000):
     log.info("Added %i nodes", nodes_added)
 
     log.info("Loading OSRM edge data")
-    existing_edges = set()
+    rows, dropped = unique_edge_rows(edges)
+    log.info("Skipping %i duplicate edges", dropped)
     edges_added = 0
-    for edge in unpack_osrm_edges(binaryfd):
-        ormified = OSRMEdge(
-            edge.node_a,
-            edge.node_b,
-            edge.distance,
-            edge.weight,
-            edge.bidirectional,
-        )
-        # make sure we don't j
-        key = OSRMEdge.hash_edge(edge.node_a, edge.node_b)
-        if key in existing_edges:
-            log.warning("Skipping existing edge: %s", repr(edge))
-            continue
-        existing_edges.add(key)
-        insert_method(ormified)
+    for edge in iter_columns(
+            edges, ('node_a', 'node_b', 'distance', 'weight',
+                    'bidirectional'), rows):
+        insert_method(OSRMEdge(*edge))
         edges_added += 1
         if edges_added % commit_every == 0:
             log.info("Added %i edges", edges_added)
@@ -68,7 +76,6 @@ def upload_osrm_binary(binaryfd, dbsession, merge=False, commit_every=1000):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('osrm_file', metavar='input.osrm',
-                        type=argparse.FileType('rb'),
                         help='Input .osrm binary file')
     parser.add_argument(
         '--connection',
@@ -77,11 +84,36 @@ if __name__ == "__main__":
     )
     parser.add_argument('--mode', choices=['append', 'recreate', 'update'],
                         default='recreate',
-                        help='If "recreate", the tables will be dropped')
+                        help='If "recreate", the tables will be dropped.  '
+                        'If "update", only the differences between the '
+                        'tables and the input are applied.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Load the tables with COPY instead of the ORM')
+    parser.add_argument('--defer-constraints', action='store_true',
+                        help='Load bare tables with COPY, then build node '
+                        'geometries, keys, indexes and foreign keys.  '
+                        'Requires --mode recreate')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Load partitions of the data over this many '
+                        'connections in parallel, using COPY.  '
+                        'Default %(default)s')
+    parser.add_argument('--batch-size', type=int, default=100000,
+                        help='Rows per COPY in --bulk and update mode.  '
+                        'Default %(default)s')
+    parser.add_argument('--cache-dir',
+                        help='Parsed column cache location.  '
+                        'Default input.osrm.cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Read the .osrm file directly, '
+                        'without the column cache')
     parser.add_argument('--verbose', action='store_true',
                         help='Increase logging level')
 
     args = parser.parse_args()
+    if args.defer_constraints and args.mode != 'recreate':
+        parser.error("--defer-constraints requires --mode recreate")
+    if args.workers > 1 and args.mode == 'update':
+        parser.error("--workers can not be used with --mode update")
 
     logging.basicConfig(
         level=logging.INFO if args.verbose else logging.WARNING)
@@ -96,10 +128,31 @@ if __name__ == "__main__":
     if args.mode == 'recreate':
         log.info("Dropping existing OSRM tables")
         Base.metadata.drop_all(engine)
-    if args.mode in ('append', 'recreate'):
+    if args.mode in ('append', 'recreate') and not args.defer_constraints:
         log.info("Creating OSRM tables")
         Base.metadata.create_all(engine)
 
-    upload_osrm_binary(args.osrm_file, session, args.mode == 'update')
+    if args.workers > 1:
+        parallel_upload_osrm(args.connection, args.osrm_file, args.workers,
+                             args.cache_dir, not args.no_cache,
+                             args.defer_constraints, args.batch_size)
+    else:
+        nodes, edges = open_osrm(args.osrm_file, args.cache_dir,
+                                 not args.no_cache)
+        if args.mode == 'update':
+            update_osrm(engine.raw_connection(), nodes, edges,
+                        args.batch_size)
+        elif args.defer_constraints:
+            deferred_upload_osrm(engine.raw_connection(), nodes, edges,
+                                 args.batch_size)
+        elif args.bulk:
+            bulk_upload_osrm(engine.raw_connection(), nodes, edges,
+                             args.batch_size)
+        else:
+            upload_osrm_binary(nodes, edges, session)
+
+    if args.defer_constraints:
+        log.info("Creating remaining OSRM tables")
+        Base.metadata.create_all(engine)
 
     log.info("Done.")
@@ -0,0 +1,97 @@
+-- Add the routes run since the last edge frequency update to
+-- edgefrequencies and edgefrequencies_bothways.
+
+-- Only the steps of routes past the watermark left by
+-- edge-frequencies.sql (or the previous refresh) are counted, and only
+-- the edges they touch are updated.  Run edge-frequencies.sql once
+-- first, and add-route-seq.sql on databases from before osrmroutes.seq.
+
+-- Routes written by runroutes.py --edge-frequencies are listed in
+-- edgefrequencies_counted, as their counts are already in
+-- edgefrequencies.  They are only added to edgefrequencies_bothways.
+
+-- Routes stored with packed steps only (runroutes.py --packed-steps
+-- --no-steps) are not seen here; use packedfreqs.py --mode add instead,
+-- which counts both kinds of routes.
+
+-- run me as: psql osrm osm < refresh-edge-frequencies.sql
+
+BEGIN;
+
+-- Wait for routes being written, and hold off new ones, so no route
+-- below the new watermark commits after it is set.
+LOCK TABLE osrmroutes IN SHARE MODE;
+
+CREATE TABLE IF NOT EXISTS edgefrequencies_counted (
+  seq BIGINT PRIMARY KEY
+);
+
+CREATE TEMPORARY TABLE refresh_window ON COMMIT DROP AS
+SELECT
+  (SELECT seq FROM edgefrequencies_watermark) AS low,
+  (SELECT COALESCE(MAX(seq), 0) FROM osrmroutes) AS high;
+
+-- freq counts all the new routes, uncounted only those not in
+-- edgefrequencies yet
+CREATE TEMPORARY TABLE freq_delta ON COMMIT DROP AS
+SELECT
+  step.edge_id AS edge,
+  step.forward AS forward,
+  COUNT(*) AS freq,
+  COUNT(*) - COUNT(counted.seq) AS uncounted
+FROM
+  osrmroutes AS route
+  INNER JOIN refresh_window AS w
+    ON route.seq > w.low AND route.seq <= w.high
+  INNER JOIN osrmroutesteps AS step ON step.route_hash = route.route_hash
+  LEFT JOIN edgefrequencies_counted AS counted ON counted.seq = route.seq
+  GROUP BY step.edge_id, step.forward;
+
+UPDATE edgefrequencies AS freqs
+SET freq = freqs.freq + delta.uncounted
+FROM freq_delta AS delta
+WHERE freqs.edge = delta.edge AND freqs.forward = delta.forward
+  AND delta.uncounted > 0;
+
+INSERT INTO edgefrequencies (edge, forward, freq)
+SELECT delta.edge, delta.forward, delta.uncounted
+FROM freq_delta AS delta
+WHERE delta.uncounted > 0 AND NOT EXISTS (
+  SELECT 1 FROM edgefrequencies AS freqs
+  WHERE freqs.edge = delta.edge AND freqs.forward = delta.forward);
+
+-- Merged forward-backwards, for the touched edges only
+CREATE TEMPORARY TABLE bothways_delta ON COMMIT DROP AS
+SELECT delta.edge AS edge, SUM(delta.freq) AS freq
+FROM freq_delta AS delta
+GROUP BY delta.edge;
+
+UPDATE edgefrequencies_bothways AS edges
+SET
+  freq = edges.freq + delta.freq,
+  logfreq = LOG(edges.freq + delta.freq)
+FROM bothways_delta AS delta
+WHERE edges.edge = delta.edge;
+
+INSERT INTO edgefrequencies_bothways (edge, freq, logfreq, speed, geom)
+SELECT
+  delta.edge,
+  delta.freq,
+  LOG(delta.freq),
+  CAST(rawedge.distance AS FLOAT) / CAST(rawedge.weight AS FLOAT),
+  geoms.geom
+FROM bothways_delta AS delta
+INNER JOIN osrmedgegeoms AS geoms ON geoms.hash = delta.edge
+INNER JOIN osrmedges AS rawedge ON rawedge.hash = delta.edge
+WHERE NOT EXISTS (
+  SELECT 1 FROM edgefrequencies_bothways AS edges
+  WHERE edges.edge = delta.edge);
+
+UPDATE edgefrequencies_watermark SET seq = (SELECT high FROM refresh_window);
+DELETE FROM edgefrequencies_counted
+WHERE seq <= (SELECT high FROM refresh_window);
+
+ANALYZE edgefrequencies;
+ANALYZE edgefrequencies_bothways;
+
+COMMIT;
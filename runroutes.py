@@ -5,26 +5,111 @@
 __license__ = None
 
 import argparse
-from concurrent import futures
 import functools
 import itertools
 import logging
-import math
 
 import numpy
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from stanalysis.edgefreq import EdgeFrequencyAccumulator
+from stanalysis.journal import RunJournal, ChunkTracker, chunk_seed, \
+    journaled_pairs, nodes_fingerprint, tagged
+from stanalysis.localrouter import LocalRouter, DEFAULT_PER_ORIGIN
+from stanalysis.odsampler import GridSampler, generate_random_choices_grid
+from stanalysis.osrmcache import file_fingerprint, open_osrm
+from stanalysis.pipeline import Pipeline
+from stanalysis.routegraph import RouteGraph
 import stanalysis.routerunner as rr
+from stanalysis.routewriter import RouteWriter, convert_route, \
+    written_routes
 import stanalysis.models as models
 
 log = logging.getLogger(__name__)
 
 
+def generate_route_pairs(N, nodes, seed=None, scale=None, per_origin=1):
+    """Generate N route start/end pairs
+
+    We run each route forward and backwards to better
+    describe the use-case for that region.
+
+    If a distance scale is given, the pairs are drawn from grid buckets
+    with that scale, otherwise by rejection sampling.  Drawing several
+    destinations per origin lets the "local" engine share searches.
+    """
+    if scale:
+        choices = generate_random_choices_grid(
+            N, nodes, scale, seed=seed, per_origin=per_origin)
+    else:
+        choices = rr.generate_random_choices_batched(
+            N, nodes, seed=seed, per_origin=per_origin)
+    return itertools.islice(
+        rr.generate_forward_backward_pairs(choices), N)
+
+
+def make_fetcher(engine, host, port, threads, max_in_flight, graph=None,
+                 processes=None):
+    """Get the route fetching function of an engine, and its worker count
+
+    :param: engine - "threads", "pooled" or "local"
+    :param: host - hostname of OSRM server
+    :param: port - port of OSRM server
+    :param: threads - number of workers of the "threads" engine
+    :param: max_in_flight - concurrent requests of the "pooled" and
+        "local" engines
+    :param: graph - :class:`stanalysis.routegraph.RouteGraph` of the
+        "local" engine
+    :param: processes - routing processes of the "local" engine
+    """
+    if engine == 'local':
+        log.info("Routing locally, up to %i concurrent routes",
+                 max_in_flight)
+        return LocalRouter(graph, processes), max_in_flight
+    if engine == 'pooled':
+        log.info("Running up to %i concurrent routes", max_in_flight)
+        return rr.RouteClient(host, port, max_in_flight), max_in_flight
+    log.info("Spawning %i workers", threads)
+    return functools.partial(rr.run_route, host=host, port=port), threads
+
+
+def route_chunk_maker(N, chunk_size, nodes, seed, scale=None,
+                      per_origin=1):
+    """Get a function generating the route pairs of a chunk of a run
+
+    Chunk i holds routes i * chunk_size up to (i + 1) * chunk_size of the
+    N routes, as hashable ((lat, lon), (lat, lon)) tuples.  Each chunk is
+    sampled with its own seed, see :func:`stanalysis.journal.chunk_seed`.
+    """
+    grid = GridSampler(nodes, scale) if scale else None
+
+    def make_chunk(chunk):
+        size = min(chunk_size, N - chunk * chunk_size)
+        # each pair is run forward and backward
+        npairs = (size + 1) // 2
+        if grid is not None:
+            choices = grid.choices(npairs, seed=chunk_seed(seed, chunk),
+                                   per_origin=per_origin)
+        else:
+            choices = rr.generate_random_choices_batched(
+                npairs, nodes, seed=chunk_seed(seed, chunk),
+                per_origin=per_origin)
+        return [(tuple(int(x) for x in start), tuple(int(x) for x in end))
+                for start, end in itertools.islice(
+                    rr.generate_forward_backward_pairs(choices), size)]
+    return make_chunk
+
+
 if __name__ == "__main__":  # pragma: nocover
     parser = argparse.ArgumentParser()
     parser.add_argument('N', type=int, help='Number of routes to run')
     parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument(
+        '--distance-scale', type=float,
+        help='Distance scale of the route pairs, in 1E-5 degrees. '
+        'If set, pairs are drawn from a spatial grid instead of '
+        'by rejection sampling')
     parser.add_argument('--verbose', action='store_true',
                         help='Increase log output')
     parser.add_argument('--echo', action='store_true',
@@ -47,8 +132,102 @@ if __name__ == "__main__":  # pragma: nocover
         '--threads', type=int, default=2,
         help='Number of concurrent threads'
     )
+    parser.add_argument(
+        '--convert-workers', type=int, default=1,
+        help='Number of threads converting routes to DB rows. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=1000,
+        help='Capacity of the queues between the pipeline stages. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--flush-rows', type=int, default=100000,
+        help='Write buffered routes once they have this many steps. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--flush-seconds', type=float, default=10,
+        help='Write buffered routes at least this often. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--edge-frequencies', action='store_true',
+        help='Add the edge counts of each flush of routes to the '
+        'edgefrequencies table, instead of aggregating the steps '
+        'afterwards with edge-frequencies.sql')
+    parser.add_argument(
+        '--no-steps', action='store_true',
+        help='Do not store the route steps. Use with --edge-frequencies')
+    parser.add_argument(
+        '--packed-steps', action='store_true',
+        help='Store the steps of each route packed into osrmroutes. '
+        'Use with --no-steps to store them only there')
+    parser.add_argument(
+        '--report-every', type=float, default=10,
+        help='Seconds between queue depth reports. Default %(default)s'
+    )
+    parser.add_argument(
+        '--engine', choices=['threads', 'pooled', 'local'],
+        default='threads',
+        help='"threads" runs --threads routes at a time, each on a new '
+        'connection. "pooled" keeps up to --max-in-flight requests '
+        'running over a pool of keep-alive connections. "local" needs '
+        'no OSRM server, and routes in --processes processes. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--max-in-flight', type=int, default=200,
+        help='Concurrent requests for the "pooled" and "local" engines. '
+        'Default %(default)s'
+    )
+    parser.add_argument(
+        '--destinations-per-origin', type=int,
+        help='Draw this many destinations for each origin. The "local" '
+        'engine shares a search between them, and needs more than one. '
+        'Default %i for the "local" engine, otherwise 1'
+        % DEFAULT_PER_ORIGIN)
+    localgroup = parser.add_argument_group('local engine')
+    localgroup.add_argument(
+        '--osrm-file',
+        help='Route over the graph of this .osrm file, instead of the '
+        'osrmnodes and osrmedges tables')
+    localgroup.add_argument(
+        '--processes', type=int,
+        help='Number of routing processes. Default one per CPU')
+    cachegroup = parser.add_argument_group('route cache')
+    cachegroup.add_argument(
+        '--route-cache',
+        help='SQLite file caching OSRM responses across runs')
+    cachegroup.add_argument(
+        '--route-cache-dataset',
+        help='The .osrm file the server runs on. Its fingerprint keys '
+        'the cached routes')
+    cachegroup.add_argument(
+        '--route-cache-mb', type=float,
+        help='Evict the least recently used routes beyond this size')
+    rungroup = parser.add_argument_group('resumable runs')
+    rungroup.add_argument(
+        '--run-id',
+        help='Name of a resumable run. Rerunning with the same name '
+        'continues where it stopped, with its original N, seed, '
+        'chunk size, distance scale and destinations per origin. '
+        'Runs over changed nodes are not resumed')
+    rungroup.add_argument(
+        '--journal', default='runroutes-journal.sqlite',
+        help='SQLite file recording the progress of runs. '
+        'Default %(default)s')
+    rungroup.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='Routes per journaled chunk. Default %(default)s')
 
     args = parser.parse_args()
+    if args.destinations_per_origin is None:
+        args.destinations_per_origin = \
+            DEFAULT_PER_ORIGIN if args.engine == 'local' else 1
+    elif args.engine == 'local' and args.destinations_per_origin < 2:
+        parser.error('--engine local needs --destinations-per-origin > 1')
 
     if args.seed is not None:
         log.info("Setting random seed to %i", args.seed)
@@ -77,77 +256,86 @@ if __name__ == "__main__":  # pragma: nocover
 
     log.info("Querying list of all nodes")
     nodes = []
+    # in a stable order, so resumed runs sample the same chunks
     for x in session.query(
-            models.OSRMNode.lat, models.OSRMNode.lon).yield_per(1000):
+            models.OSRMNode.osm_id, models.OSRMNode.lat,
+            models.OSRMNode.lon).order_by(
+                models.OSRMNode.osm_id).yield_per(1000):
         nodes.append(x)
-    nodes = numpy.array(nodes, dtype=int)
-
-    log.info("Spawning %i workers", args.threads)
-    with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-        route_runner = functools.partial(
-            rr.run_route, host=args.host, port=args.port)
-        # execute some jobs
-        route_count = 0
-        # Do the future mapping in chunks, to prevent memory
-        # blowup.  I don't understand why the executor keeps
-        # so much crap around.
-        chunk_size = 1000
-        nchunks = max(int(math.ceil(args.N / chunk_size)), 1)
-        for ichunk in range(nchunks):
-            log.info("Processing %i route block %i/%i",
-                     chunk_size, ichunk + 1, nchunks)
-            # We run each route forward and backwards to better
-            # describe the use-case for that region.
-            routes_to_run = rr.generate_forward_backward_pairs(
-                rr.generate_random_choices_exponential(
-                    chunk_size, nodes))
-            commit_every = 20
-            for route in executor.map(route_runner, routes_to_run):
-
-                coords, query_url, steps = route
-
-                if not len(steps):
-                    log.error("No steps returned for route: %s", coords)
-                    continue
-
-                route_hash = models.OSRMRoute.hash_route(
-                    tuple(coords[0]),
-                    tuple(coords[1]),
-                )
-                ormified_route = models.OSRMRoute(
-                    route_hash=route_hash,
-                    start_lat=coords[0][0],
-                    start_lon=coords[0][1],
-                    end_lat=coords[1][0],
-                    end_lon=coords[1][1],
-                    duration=steps[:, 1].sum(),
-                    nsteps=len(steps),
-                    query=query_url,
-                )
-
-                session.add(ormified_route)
-
-                def get_pair_steps(x):
-                    """Generate iterator over each step in list"""
-                    return itertools.izip(x[:-1], x[1:])
-
-                ormed_steps = []
-                for j, (startn, endn) in enumerate(
-                        get_pair_steps(steps)):
-                    start_id, _, start_lat, start_lon = startn
-                    end_id, _, end_lat, end_lon = endn
-                    ormified_step = models.OSRMRouteStep(
-                        route_hash=route_hash,
-                        step_idx=j,
-                        edge_id=models.OSRMEdge.hash_edge(start_id, end_id),
-                        forward=models.OSRMEdge.is_forward(start_id, end_id),
-                    )
-                    ormed_steps.append(ormified_step)
-                session.add_all(ormed_steps)
-                session.commit()
-                route_count += 1
-                log.info("Committed route %i with %i steps",
-                         route_count, len(ormed_steps))
-                if route_count == args.N:
-                    break
-            log.info("Committed %i routes", route_count)
+    nodes = numpy.array(nodes, dtype=int).reshape(-1, 3)
+    node_ids, nodes = nodes[:, 0], nodes[:, 1:]
+
+    graph = None
+    if args.engine == 'local':
+        log.info("Building the route graph")
+        if args.osrm_file:
+            graph = RouteGraph.from_osrm(*open_osrm(args.osrm_file))
+        else:
+            graph = RouteGraph.from_db(engine.raw_connection())
+    fetch, fetch_workers = make_fetcher(
+        args.engine, args.host, args.port, args.threads, args.max_in_flight,
+        graph, args.processes)
+    router = fetch
+
+    if args.route_cache:
+        fingerprint = ''
+        if args.route_cache_dataset:
+            log.info("Fingerprinting %s", args.route_cache_dataset)
+            fingerprint = file_fingerprint(args.route_cache_dataset)
+        max_bytes = None
+        if args.route_cache_mb is not None:
+            max_bytes = int(args.route_cache_mb * (1 << 20))
+        cache = rr.RouteCache(args.route_cache, fingerprint, max_bytes)
+        log.info("Using %i cached routes from %s",
+                 len(cache), args.route_cache)
+        fetch = cache_runner = rr.CachedRouteRunner(fetch, cache)
+
+    # pair generation => OSRM fetch => step conversion => DB write
+    frequencies = None
+    if args.edge_frequencies:
+        frequencies = EdgeFrequencyAccumulator()
+    writer = RouteWriter(engine.raw_connection(), args.flush_rows,
+                         args.flush_seconds, write_steps=not args.no_steps,
+                         frequencies=frequencies,
+                         packed_steps=args.packed_steps)
+    if args.run_id:
+        journal = RunJournal(args.journal, args.run_id)
+        seed = args.seed
+        if seed is None:
+            seed = numpy.random.randint(2 ** 31)
+        config = journal.start(dict(
+            N=args.N, seed=seed, chunk_size=args.chunk_size,
+            distance_scale=args.distance_scale,
+            per_origin=args.destinations_per_origin,
+            nodes=nodes_fingerprint(node_ids, nodes)), check=['nodes'])
+        log.info("Run %s configuration: %s", args.run_id, config)
+        n_chunks = -(-config['N'] // config['chunk_size'])
+        make_chunk = route_chunk_maker(
+            config['N'], config['chunk_size'], nodes, config['seed'],
+            config['distance_scale'], config.get('per_origin', 1))
+        sink = ChunkTracker(journal, writer)
+        written = functools.partial(written_routes, engine.raw_connection())
+        pairs = journaled_pairs(journal, sink, n_chunks, make_chunk, written)
+        fetch, convert = tagged(fetch), tagged(convert_route)
+    else:
+        sink = writer
+        pairs = generate_route_pairs(args.N, nodes, args.seed,
+                                     args.distance_scale,
+                                     args.destinations_per_origin)
+        convert = convert_route
+    pipeline = Pipeline(pairs, report_every=args.report_every)
+    pipeline.add_stage('fetch', fetch, fetch_workers, args.queue_size)
+    pipeline.add_stage('convert', convert, args.convert_workers,
+                       args.queue_size)
+    # The writer buffers rows, so there is only one.
+    pipeline.add_stage('write', sink, 1, args.queue_size)
+    # Flush whatever is buffered, even if the run fails.
+    with sink:
+        pipeline.run()
+    if args.engine == 'local':
+        router.close()
+    log.info("Wrote %i routes", writer.routes_written)
+    if args.route_cache:
+        cache.flush()
+        log.info("Route cache hits: %i, misses: %i", cache_runner.hits,
+                 cache_runner.misses)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+'''
+
+Bulk loading of OSRM nodes and edges into PostGIS with COPY.
+
+Instead of creating an ORM object per record, the node and edge arrays
+are formatted as tab separated text in large batches and streamed into
+the tables defined in :mod:`stanalysis.models` with ``COPY FROM STDIN``.
+Updates from a new extract are staged the same way, and only the
+differences are applied to the tables.
+
+For loading from scratch, the tables can also be created bare, and the
+node geometries, keys, indexes and foreign keys added after the load.
+
+'''
+
+import io
+import logging
+import time
+
+from geoalchemy.geometry import Geometry
+import numpy as np
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from stanalysis.models import OSRMNode, OSRMEdge, OSRMEdgeGeom, \
+    OSRMEdgeFrequencies, OSRMRouteNode
+from stanalysis.keys import edge_keys
+from stanalysis.osrmbinary import unique_edge_rows
+
+log = logging.getLogger(__name__)
+
+NODE_COLUMNS = ('osm_id', 'lat', 'lon', 'bollard', 'traffic_light', 'geom')
+NODE_FORMAT = '%d\t%d\t%d\t%d\t%d\tSRID=4326;POINT(%0.6f %0.6f)'
+NODE_DTYPE = np.dtype([
+    ('osm_id', '<i8'),
+    ('lat', '<i4'),
+    ('lon', '<i4'),
+    ('bollard', 'i1'),
+    ('traffic_light', 'i1'),
+    ('geom_lon', '<f8'),
+    ('geom_lat', '<f8'),
+])
+
+# Nodes without the geometry, which is built server side.
+BARE_NODE_COLUMNS = NODE_COLUMNS[:-1]
+BARE_NODE_FORMAT = '%d\t%d\t%d\t%d\t%d'
+BARE_NODE_DTYPE = np.dtype(NODE_DTYPE.descr[:-2])
+
+# Build the node geometry from the integer coordinates
+NODE_GEOMETRY = "ST_SetSRID(ST_MakePoint(lon / 1E5, lat / 1E5), 4326)"
+
+EDGE_COLUMNS = ('hash', 'source', 'sink', 'distance', 'weight',
+                'bidirectional')
+EDGE_FORMAT = '%d\t%d\t%d\t%d\t%d\t%d'
+EDGE_DTYPE = np.dtype([
+    ('hash', '<i8'),
+    ('source', '<i8'),
+    ('sink', '<i8'),
+    ('distance', '<i4'),
+    ('weight', '<i4'),
+    ('bidirectional', 'i1'),
+])
+
+
+def node_records(nodes, geometry=True):
+    """Convert OSRM node data into rows of the osrmnodes table
+
+    :param: geometry - include the coordinates of the geometry column
+    """
+    records = np.empty(
+        len(nodes), dtype=NODE_DTYPE if geometry else BARE_NODE_DTYPE)
+    records['osm_id'] = nodes['id']
+    records['lat'] = nodes['lat']
+    records['lon'] = nodes['lon']
+    records['bollard'] = nodes['bollard'] != 0
+    records['traffic_light'] = nodes['traffic_light'] != 0
+    if geometry:
+        records['geom_lon'] = nodes['lon'] / 1E5
+        records['geom_lat'] = nodes['lat'] / 1E5
+    return records
+
+
+def edge_records(edges):
+    """Convert OSRM edge data into rows of the osrmedges table
+
+    Duplicates of an undirected edge are dropped, keeping the first.
+    """
+    first, dropped = unique_edge_rows(edges)
+    log.info("Dropped %i duplicate edges", dropped)
+    node_a = edges['node_a'][first]
+    node_b = edges['node_b'][first]
+    records = np.empty(len(first), dtype=EDGE_DTYPE)
+    records['hash'] = edge_keys(node_a, node_b)
+    records['source'] = node_a
+    records['sink'] = node_b
+    records['distance'] = edges['distance'][first]
+    records['weight'] = edges['weight'][first]
+    records['bidirectional'] = edges['bidirectional'][first] != 0
+    return records
+
+
+def format_copy_rows(records, fmt):
+    """Format records as a COPY text-format buffer"""
+    output = io.BytesIO()
+    np.savetxt(output, records, fmt=fmt)
+    output.seek(0)
+    return output
+
+
+def copy_records(cursor, table, columns, fmt, records, batch_size=100000):
+    """Stream records into a table with COPY FROM STDIN
+
+    Each batch of batch_size records is sent as a separate COPY.
+    Returns the number of rows copied.
+
+    :param: cursor - a DBAPI (psycopg2) cursor
+    :param: table - name of the destination table
+    :param: columns - the destination columns, in record order
+    :param: fmt - printf style format of one row
+    :param: records - a structured array of the rows
+    """
+    statement = "COPY %s (%s) FROM STDIN" % (table, ', '.join(columns))
+    start = time.time()
+    copied = 0
+    for offset in range(0, len(records), batch_size):
+        batch = records[offset:offset + batch_size]
+        cursor.copy_expert(statement, format_copy_rows(batch, fmt))
+        copied += len(batch)
+        elapsed = time.time() - start
+        log.info("Copied %i/%i rows into %s, %0.0f rows/s",
+                 copied, len(records), table,
+                 copied / elapsed if elapsed else 0)
+    return copied
+
+
+def bulk_upload_osrm(connection, nodes, edges, batch_size=100000):
+    """Load OSRM nodes and edges into existing tables using COPY
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: nodes - the OSRM node records, e.g. :attr:`OSRMFile.nodes`
+    :param: edges - the OSRM edge records, e.g. :attr:`OSRMFile.edges`
+    :param: batch_size - number of rows sent per COPY
+    """
+    cursor = connection.cursor()
+    log.info("Copying OSRM node data")
+    copy_records(cursor, OSRMNode.__tablename__, NODE_COLUMNS, NODE_FORMAT,
+                 node_records(nodes), batch_size)
+    log.info("Copying OSRM edge data")
+    copy_records(cursor, OSRMEdge.__tablename__, EDGE_COLUMNS, EDGE_FORMAT,
+                 edge_records(edges), batch_size)
+    connection.commit()
+
+
+def create_bare_tables(cursor, tables):
+    """Create tables without geometries, keys, indexes or constraints
+
+    :param: tables - :class:`sqlalchemy.Table` objects from the models
+    """
+    dialect = postgresql.dialect()
+    for table in tables:
+        log.info("Creating bare table %s", table.name)
+        cursor.execute("CREATE TABLE %s (%s)" % (table.name, ', '.join(
+            '%s %s' % (column.name, column.type.compile(dialect=dialect))
+            for column in table.columns
+            if not isinstance(column.type, Geometry))))
+
+
+def finalize_tables(cursor, tables, geometries=None):
+    """Add what :func:`create_bare_tables` left out, then analyze
+
+    Geometry columns are added and filled, then the primary keys,
+    indexes and foreign keys are created, matching what the model
+    metadata would have created up front.
+
+    :param: tables - :class:`sqlalchemy.Table` objects from the models
+    :param: geometries - dict of table name => SQL expression used
+        to fill the table's geometry column
+    """
+    geometries = geometries or {}
+    dialect = postgresql.dialect()
+    for table in tables:
+        for column in table.columns:
+            if not isinstance(column.type, Geometry):
+                continue
+            log.info("Building %s.%s", table.name, column.name)
+            cursor.execute(
+                "SELECT AddGeometryColumn('public', %s, %s, %s, %s, %s)",
+                (table.name, column.name, column.type.srid,
+                 column.type.name, column.type.dimension))
+            if table.name in geometries:
+                cursor.execute("UPDATE %s SET %s = %s" % (
+                    table.name, column.name, geometries[table.name]))
+            if column.type.spatial_index:
+                cursor.execute(
+                    'CREATE INDEX "idx_%s_%s" ON "public"."%s" '
+                    'USING GIST (%s)' % (table.name, column.name,
+                                         table.name, column.name))
+        log.info("Adding keys and indexes to %s", table.name)
+        cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (
+            table.name,
+            ', '.join(column.name for column in table.primary_key)))
+        for index in table.indexes:
+            cursor.execute(str(CreateIndex(index).compile(dialect=dialect)))
+    # Foreign keys last, so the referenced keys exist
+    for table in tables:
+        for fk in table.foreign_keys:
+            log.info("Adding foreign key %s.%s => %s", table.name,
+                     fk.parent.name, fk.target_fullname)
+            cursor.execute(
+                "ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s (%s)" % (
+                    table.name, fk.parent.name,
+                    fk.column.table.name, fk.column.name))
+    for table in tables:
+        cursor.execute("ANALYZE %s" % table.name)
+
+
+def deferred_upload_osrm(connection, nodes, edges, batch_size=100000):
+    """Create and load the OSRM node and edge tables from scratch
+
+    The tables are loaded bare with COPY, and the node geometries are
+    built server side from the integer coordinates.  The keys, indexes
+    and foreign keys are only added once the data is loaded.  The tables
+    must not exist yet.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: nodes - the OSRM node records, e.g. :attr:`OSRMFile.nodes`
+    :param: edges - the OSRM edge records, e.g. :attr:`OSRMFile.edges`
+    :param: batch_size - number of rows sent per COPY
+    """
+    tables = (OSRMNode.__table__, OSRMEdge.__table__)
+    cursor = connection.cursor()
+    create_bare_tables(cursor, tables)
+    log.info("Copying OSRM node data")
+    copy_records(cursor, OSRMNode.__tablename__, BARE_NODE_COLUMNS,
+                 BARE_NODE_FORMAT, node_records(nodes, geometry=False),
+                 batch_size)
+    log.info("Copying OSRM edge data")
+    copy_records(cursor, OSRMEdge.__tablename__, EDGE_COLUMNS, EDGE_FORMAT,
+                 edge_records(edges), batch_size)
+    finalize_tables(cursor, tables,
+                    {OSRMNode.__tablename__: NODE_GEOMETRY})
+    connection.commit()
+
+
+def _stage(cursor, table, key, columns, fmt, records, batch_size):
+    """COPY records into a temporary copy of table, indexed by key
+
+    Returns the name of the staging table, which is dropped on commit.
+    """
+    staging = table + '_staging'
+    cursor.execute(
+        "CREATE TEMPORARY TABLE %s (LIKE %s) ON COMMIT DROP" %
+        (staging, table))
+    copy_records(cursor, staging, columns, fmt, records, batch_size)
+    cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (staging, key))
+    cursor.execute("ANALYZE %s" % staging)
+    return staging
+
+
+def _insert_new(cursor, table, staging, key, columns):
+    """Insert the staged rows whose key is not in table"""
+    cursor.execute(
+        "INSERT INTO {table} ({columns}) "
+        "SELECT {staged} FROM {staging} AS s "
+        "LEFT JOIN {table} AS t ON t.{key} = s.{key} "
+        "WHERE t.{key} IS NULL".format(
+            table=table, staging=staging, key=key,
+            columns=', '.join(columns),
+            staged=', '.join('s.' + c for c in columns)))
+    return cursor.rowcount
+
+
+def _update_changed(cursor, table, staging, key, columns, compare):
+    """Update the rows of table which differ from the staged row"""
+    cursor.execute(
+        "UPDATE {table} AS t SET {assign} FROM {staging} AS s "
+        "WHERE t.{key} = s.{key} "
+        "AND ({current}) IS DISTINCT FROM ({staged})".format(
+            table=table, staging=staging, key=key,
+            assign=', '.join('%s = s.%s' % (c, c)
+                             for c in columns if c != key),
+            current=', '.join('t.' + c for c in compare),
+            staged=', '.join('s.' + c for c in compare)))
+    return cursor.rowcount
+
+
+def _delete_missing(cursor, table, staging, key, column=None):
+    """Delete rows from table whose column is not a key in staging
+
+    :param: column - the column of table to match, default key
+    """
+    cursor.execute(
+        "DELETE FROM {table} AS t WHERE NOT EXISTS "
+        "(SELECT 1 FROM {staging} AS s WHERE s.{key} = t.{column})".format(
+            table=table, staging=staging, key=key,
+            column=column or key))
+    return cursor.rowcount
+
+
+def update_osrm(connection, nodes, edges, batch_size=100000):
+    """Apply the difference between new OSRM data and the tables
+
+    The new nodes and edges are copied into temporary staging tables,
+    and only the inserts, updates and deletes needed to make the tables
+    match them are applied.  Rows of routenodes, osrmedgegeoms and
+    edgefrequencies that refer to deleted nodes or edges are deleted.
+
+    Returns a dict of the number of rows changed, e.g.
+    ``changes['edges']['inserted']``.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: nodes - the OSRM node records, e.g. :attr:`OSRMFile.nodes`
+    :param: edges - the OSRM edge records, e.g. :attr:`OSRMFile.edges`
+    :param: batch_size - number of rows sent per COPY
+    """
+    cursor = connection.cursor()
+    node_table = OSRMNode.__tablename__
+    edge_table = OSRMEdge.__tablename__
+    log.info("Staging new OSRM node data")
+    node_staging = _stage(cursor, node_table, 'osm_id', NODE_COLUMNS,
+                          NODE_FORMAT, node_records(nodes), batch_size)
+    log.info("Staging new OSRM edge data")
+    edge_staging = _stage(cursor, edge_table, 'hash', EDGE_COLUMNS,
+                          EDGE_FORMAT, edge_records(edges), batch_size)
+
+    changes = {'nodes': {}, 'edges': {}}
+    # Nodes have to exist before the edges referring to them,
+    # and edges have to be gone before their nodes.
+    changes['nodes']['inserted'] = _insert_new(
+        cursor, node_table, node_staging, 'osm_id', NODE_COLUMNS)
+    changes['nodes']['updated'] = _update_changed(
+        cursor, node_table, node_staging, 'osm_id', NODE_COLUMNS,
+        ('lat', 'lon', 'bollard', 'traffic_light'))
+    for dependent, column in ((OSRMEdgeGeom.__tablename__, 'hash'),
+                              (OSRMEdgeFrequencies.__tablename__, 'edge')):
+        _delete_missing(cursor, dependent, edge_staging, 'hash', column)
+    changes['edges']['deleted'] = _delete_missing(
+        cursor, edge_table, edge_staging, 'hash')
+    changes['edges']['inserted'] = _insert_new(
+        cursor, edge_table, edge_staging, 'hash', EDGE_COLUMNS)
+    changes['edges']['updated'] = _update_changed(
+        cursor, edge_table, edge_staging, 'hash', EDGE_COLUMNS,
+        EDGE_COLUMNS[1:])
+    _delete_missing(cursor, OSRMRouteNode.__tablename__, node_staging,
+                    'osm_id')
+    changes['nodes']['deleted'] = _delete_missing(
+        cursor, node_table, node_staging, 'osm_id')
+    connection.commit()
+    for table in ('nodes', 'edges'):
+        log.info("Updated OSRM %s: %i inserted, %i updated, %i deleted",
+                 table, changes[table]['inserted'],
+                 changes[table]['updated'], changes[table]['deleted'])
+    return changes
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+'''
+
+Accumulate edge frequencies while routes are run.
+
+Instead of storing every route step and aggregating them afterwards with
+edge-frequencies.sql, the (edge, forward) traversal counts are summed in
+memory and added to the edgefrequencies table in batches.
+
+'''
+
+import logging
+
+import numpy as np
+
+from stanalysis.bulkload import copy_records
+from stanalysis.models import OSRMEdgeFrequencies
+
+log = logging.getLogger(__name__)
+
+FREQ_TABLE = OSRMEdgeFrequencies.__tablename__
+FREQ_COLUMNS = ('edge', 'forward', 'freq')
+FREQ_FORMAT = '%d\t%d\t%d'
+FREQ_DTYPE = np.dtype([
+    ('edge', '<i8'),
+    ('forward', 'i1'),
+    ('freq', '<i8'),
+])
+
+# Add the staged counts to the table.  Postgres 9.1 has no upsert, so
+# the table is locked against concurrent writers in between.
+UPSERT_FREQUENCIES = [
+    "LOCK TABLE {freqs} IN SHARE ROW EXCLUSIVE MODE",
+    "UPDATE {freqs} AS f SET freq = f.freq + s.freq "
+    "FROM {freqs}_staging AS s "
+    "WHERE f.edge = s.edge AND f.forward = s.forward",
+    "INSERT INTO {freqs} (edge, forward, freq) "
+    "SELECT s.edge, s.forward, s.freq FROM {freqs}_staging AS s "
+    "WHERE NOT EXISTS (SELECT 1 FROM {freqs} AS f "
+    "WHERE f.edge = s.edge AND f.forward = s.forward)",
+]
+UPSERT_FREQUENCIES = [x.format(freqs=FREQ_TABLE) for x in UPSERT_FREQUENCIES]
+
+
+# Rebuild the tables derived from edgefrequencies after a full recount,
+# like edge-frequencies.sql does.  The watermark is set separately.
+REBUILD_DERIVED = [
+    "DELETE FROM edgefrequencies_bothways",
+    "INSERT INTO edgefrequencies_bothways (edge, freq, logfreq, speed, geom) "
+    "SELECT edges.edge, SUM(edges.freq), LOG(SUM(edges.freq)), "
+    "CAST(rawedge.distance AS FLOAT) / CAST(rawedge.weight AS FLOAT), "
+    "geoms.geom "
+    "FROM {freqs} AS edges "
+    "INNER JOIN osrmedgegeoms AS geoms ON geoms.hash = edges.edge "
+    "INNER JOIN osrmedges AS rawedge ON rawedge.hash = edges.edge "
+    "GROUP BY edges.edge, geoms.geom, "
+    "CAST(rawedge.distance AS FLOAT) / CAST(rawedge.weight AS FLOAT)",
+]
+REBUILD_DERIVED = [x.format(freqs=FREQ_TABLE) for x in REBUILD_DERIVED]
+
+# Add the staged delta of (edge, forward) counts to
+# edgefrequencies_bothways, like refresh-edge-frequencies.sql does
+UPSERT_BOTHWAYS = [
+    "UPDATE edgefrequencies_bothways AS edges "
+    "SET freq = edges.freq + delta.freq, "
+    "logfreq = LOG(edges.freq + delta.freq) "
+    "FROM (SELECT edge, SUM(freq) AS freq FROM {freqs}_delta "
+    "GROUP BY edge) AS delta "
+    "WHERE edges.edge = delta.edge",
+    "INSERT INTO edgefrequencies_bothways (edge, freq, logfreq, speed, geom) "
+    "SELECT delta.edge, delta.freq, LOG(delta.freq), "
+    "CAST(rawedge.distance AS FLOAT) / CAST(rawedge.weight AS FLOAT), "
+    "geoms.geom "
+    "FROM (SELECT edge, SUM(freq) AS freq FROM {freqs}_delta "
+    "GROUP BY edge) AS delta "
+    "INNER JOIN osrmedgegeoms AS geoms ON geoms.hash = delta.edge "
+    "INNER JOIN osrmedges AS rawedge ON rawedge.hash = delta.edge "
+    "WHERE NOT EXISTS (SELECT 1 FROM edgefrequencies_bothways AS edges "
+    "WHERE edges.edge = delta.edge)",
+]
+UPSERT_BOTHWAYS = [x.format(freqs=FREQ_TABLE) for x in UPSERT_BOTHWAYS]
+
+
+def has_derived(cursor):
+    """Check if edge-frequencies.sql created the derived tables"""
+    cursor.execute(
+        "SELECT COUNT(*) FROM pg_tables WHERE tablename IN "
+        "('edgefrequencies_bothways', 'edgefrequencies_watermark')")
+    return cursor.fetchone()[0] == 2
+
+
+def advance_watermark(cursor, watermark):
+    """Mark the routes up to watermark as counted
+
+    Sets the watermark of refresh-edge-frequencies.sql, and clears the
+    edgefrequencies_counted marks it covers.
+
+    :param: watermark - seq of the last route counted
+    """
+    cursor.execute("UPDATE edgefrequencies_watermark SET seq = %s",
+                   (watermark,))
+    cursor.execute("DELETE FROM edgefrequencies_counted WHERE seq <= %s",
+                   (watermark,))
+
+
+def rebuild_derived(cursor, watermark):
+    """Bring the tables derived from edgefrequencies up to a recount
+
+    Rebuilds edgefrequencies_bothways, and moves the watermark to the
+    last route seq counted (see :func:`advance_watermark`).  Runs in the
+    cursor's transaction, which should hold osrmroutes in SHARE mode
+    since the routes were read.  Does nothing if edge-frequencies.sql
+    never created the tables.
+
+    :param: watermark - seq of the last route counted
+    """
+    if not has_derived(cursor):
+        log.info("No derived edge frequency tables to rebuild")
+        return
+    for statement in REBUILD_DERIVED:
+        cursor.execute(statement)
+    advance_watermark(cursor, watermark)
+    log.info("Rebuilt edgefrequencies_bothways, watermark at %i", watermark)
+
+
+def add_bothways(cursor, counts):
+    """Add (edge, forward) counts to edgefrequencies_bothways
+
+    Runs in the cursor's transaction, without committing.
+
+    :param: counts - a :attr:`FREQ_DTYPE` array
+    """
+    if not len(counts):
+        return
+    cursor.execute(
+        "CREATE TEMPORARY TABLE %s_delta (LIKE %s) ON COMMIT DROP"
+        % (FREQ_TABLE, FREQ_TABLE))
+    copy_records(cursor, FREQ_TABLE + '_delta', FREQ_COLUMNS, FREQ_FORMAT,
+                 counts, len(counts))
+    for statement in UPSERT_BOTHWAYS:
+        cursor.execute(statement)
+    log.info("Added counts of %i edges to edgefrequencies_bothways",
+             len(counts))
+
+
+def count_edges(edge_ids, forwards, counts=None):
+    """Sum the counts of each distinct (edge, forward)
+
+    Returns a :attr:`FREQ_DTYPE` array, sorted by edge and forward.
+
+    :param: edge_ids - array of edge keys
+    :param: forwards - array of traversal directions
+    :param: counts - count of each entry, default one
+    """
+    edge_ids = np.asarray(edge_ids, dtype=np.int64)
+    forwards = np.asarray(forwards, dtype=np.int8)
+    if counts is None:
+        counts = np.ones(len(edge_ids), dtype=np.int64)
+    result = np.empty(0, dtype=FREQ_DTYPE)
+    if not len(edge_ids):
+        return result
+    order = np.lexsort((forwards, edge_ids))
+    edge_ids, forwards = edge_ids[order], forwards[order]
+    starts = np.concatenate([[0], np.flatnonzero(
+        (edge_ids[1:] != edge_ids[:-1]) |
+        (forwards[1:] != forwards[:-1])) + 1])
+    result = np.empty(len(starts), dtype=FREQ_DTYPE)
+    result['edge'] = edge_ids[starts]
+    result['forward'] = forwards[starts]
+    result['freq'] = np.add.reduceat(np.asarray(counts)[order], starts)
+    return result
+
+
+class EdgeFrequencyAccumulator(object):
+    """In-memory (edge, forward) => count accumulator
+
+    Step arrays are appended as they arrive, and summed into distinct
+    counts once compact_rows of them are pending, which bounds the
+    memory used to about the number of distinct edges.
+
+    :param: compact_rows - number of pending steps triggering a compaction
+    """
+
+    def __init__(self, compact_rows=1000000):
+        self.compact_rows = compact_rows
+        self.steps_added = 0
+        self._counts = np.empty(0, dtype=FREQ_DTYPE)
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, edge_ids, forwards):
+        """Count the traversal of each (edge, forward)"""
+        self._pending.append((np.asarray(edge_ids), np.asarray(forwards)))
+        self._pending_rows += len(edge_ids)
+        self.steps_added += len(edge_ids)
+        if self._pending_rows >= self.compact_rows:
+            self._compact()
+
+    def _compact(self):
+        if not self._pending:
+            return
+        self._counts = count_edges(
+            np.concatenate([self._counts['edge']] +
+                           [x[0] for x in self._pending]),
+            np.concatenate([self._counts['forward']] +
+                           [x[1] for x in self._pending]),
+            np.concatenate([self._counts['freq'], np.ones(
+                self._pending_rows, dtype=np.int64)]))
+        self._pending = []
+        self._pending_rows = 0
+
+    def counts(self):
+        """Get the accumulated :attr:`FREQ_DTYPE` counts"""
+        self._compact()
+        return self._counts
+
+    def __len__(self):
+        """Number of distinct (edge, forward) counted"""
+        return len(self.counts())
+
+    def clear(self):
+        """Forget all the counts, e.g. after writing them"""
+        self._counts = np.empty(0, dtype=FREQ_DTYPE)
+        self._pending = []
+        self._pending_rows = 0
+
+    def write(self, cursor):
+        """Add the counts to the edgefrequencies table
+
+        Runs in the cursor's transaction, without committing.
+        """
+        counts = self.counts()
+        if not len(counts):
+            return
+        cursor.execute(
+            "CREATE TEMPORARY TABLE %s_staging (LIKE %s) ON COMMIT DROP"
+            % (FREQ_TABLE, FREQ_TABLE))
+        copy_records(cursor, FREQ_TABLE + '_staging', FREQ_COLUMNS,
+                     FREQ_FORMAT, counts, len(counts))
+        for statement in UPSERT_FREQUENCIES:
+            cursor.execute(statement)
+        log.info("Added counts of %i edges to %s", len(counts), FREQ_TABLE)
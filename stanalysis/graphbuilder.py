@@ -13,6 +13,7 @@ import igraph
 import numpy as np
 
 from stanalysis.models import OSRMEdgeFrequencies, OSRMEdge, OSRMRouteNode
+from stanalysis.nodeindex import NodeIndex
 import stanalysis.graphtools as gt
 
 log = logging.getLogger(__name__)
@@ -45,22 +46,18 @@ def build_graph(session):
     log.info("Querying data")
     data = np.array(list(query_data(session)), dtype=int)
 
-    # Map OSM node ID => graph vertex index
-    node_idx_lookup = {}
+    # Map OSM node ID => graph vertex index.
     unique_nodes = np.unique(data[:, (0, 1)])
-    for i, node_id in enumerate(unique_nodes):
-        node_idx_lookup[node_id] = i
-    log.info("Found %i nodes", len(node_idx_lookup))
+    log.info("Found %i nodes", len(unique_nodes))
 
     g = igraph.Graph(directed=True)
-    g.add_vertices(len(node_idx_lookup))
+    g.add_vertices(len(unique_nodes))
     g.vs["osm_id"] = unique_nodes
-    del unique_nodes
 
     log.info("Adding %i edges", len(data))
-    g.add_edges([
-        (node_idx_lookup[start], node_idx_lookup[end])
-        for start, end in data[:, (0, 1)]])
+    g.add_edges(NodeIndex.from_ids(unique_nodes).rows(
+        data[:, (0, 1)]).tolist())
+    del unique_nodes
     log.info("Setting edge weights")
     g.es['weight'] = data[:, 2]
     return g
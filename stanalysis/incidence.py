@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+'''
+
+Route by edge incidence matrix
+==============================
+
+A sparse CSR matrix with a row per route, and a column per traversed
+(edge, forward), holding how many times the route takes the edge in that
+direction.  The edge frequencies for any weighting of the routes are
+then a single sparse matrix-vector product:
+
+    freqs = incidence.frequencies(weights)
+
+so the routes need not be run again to try a different origin-destination
+distribution, as long as the weights express it.
+
+The matrix is saved as a directory of .npy files, which are memory mapped
+when loaded.
+
+'''
+
+import itertools
+import logging
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from stanalysis.edgefreq import count_edges
+from stanalysis.packedsteps import unpack_edges
+
+log = logging.getLogger(__name__)
+
+# Route information kept along with the matrix, for computing weights
+ROUTE_DTYPE = np.dtype([
+    ('route_hash', '<i8'),
+    ('start_lat', '<i4'),
+    ('start_lon', '<i4'),
+    ('end_lat', '<i4'),
+    ('end_lon', '<i4'),
+    ('duration', '<i8'),
+])
+ROUTE_COLUMNS = ROUTE_DTYPE.names
+
+EDGE_DTYPE = np.dtype([
+    ('edge', '<i8'),
+    ('forward', 'i1'),
+])
+
+_ARRAYS = ('indptr', 'indices', 'data', 'routes', 'edges')
+
+
+class IncidenceMatrix(object):
+    """Route by (edge, forward) incidence matrix
+
+    :param: matrix - CSR matrix of traversal counts
+    :param: routes - :attr:`ROUTE_DTYPE` array, one per matrix row
+    :param: edges - :attr:`EDGE_DTYPE` array, one per matrix column
+    """
+
+    def __init__(self, matrix, routes, edges):
+        self.matrix = matrix
+        self.routes = routes
+        self.edges = edges
+
+    def frequencies(self, weights=None):
+        """Get the frequency of each (edge, forward) in :attr:`edges`
+
+        :param: weights - weight of each route, default one
+        """
+        if weights is None:
+            weights = np.ones(len(self.routes))
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != (len(self.routes),):
+            raise ValueError("Expected %i route weights, got %s"
+                             % (len(self.routes), weights.shape))
+        return self.matrix.T.dot(weights)
+
+    def save(self, directory):
+        """Save the matrix as .npy files in directory"""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        arrays = dict(indptr=self.matrix.indptr, indices=self.matrix.indices,
+                      data=self.matrix.data, routes=self.routes,
+                      edges=self.edges)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), arrays[name])
+        log.info("Saved %i x %i incidence matrix to %s",
+                 len(self.routes), len(self.edges), directory)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """Load a matrix saved with :meth:`save`, memory mapped by default
+        """
+        arrays = dict(
+            (name, np.load(os.path.join(directory, name + '.npy'),
+                           mmap_mode=mmap_mode))
+            for name in _ARRAYS)
+        matrix = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(len(arrays['routes']), len(arrays['edges'])), copy=False)
+        return cls(matrix, arrays['routes'], arrays['edges'])
+
+
+class _Buffer(object):
+    """A numpy array grown by doubling, to collect many small arrays
+
+    :param: dtype - dtype of the items
+    """
+
+    def __init__(self, dtype, capacity=1024):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        if size > len(self._data):
+            grown = np.empty(max(size, 2 * len(self._data)),
+                             dtype=self._data.dtype)
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+
+    def append(self, item):
+        self._reserve(self._size + 1)
+        self._data[self._size] = item
+        self._size += 1
+
+    def extend(self, values):
+        end = self._size + len(values)
+        self._reserve(end)
+        self._data[self._size:end] = values
+        self._size = end
+
+    def array(self):
+        """The collected items"""
+        return self._data[:self._size]
+
+
+def build_incidence(routes):
+    """Build the incidence matrix of routes
+
+    The entries are collected in typed buffers, taking 13 bytes per
+    distinct edge of each route, and 40 bytes per route.  The buffers
+    grow by doubling, and finding the distinct edges at the end briefly
+    takes a few times as much.
+
+    :param: routes - iterable of (route info, edge keys, forwards), where
+        route info is a tuple of the :attr:`ROUTE_COLUMNS`
+    """
+    infos = _Buffer(ROUTE_DTYPE)
+    edge_ids = _Buffer(np.int64)
+    forwards = _Buffer(np.int8)
+    freqs = _Buffer(np.int32)
+    indptr = _Buffer(np.int64)
+    indptr.append(0)
+    for info, route_edges, route_forwards in routes:
+        infos.append(tuple(info))
+        route_counts = count_edges(route_edges, route_forwards)
+        edge_ids.extend(route_counts['edge'])
+        forwards.extend(route_counts['forward'])
+        freqs.extend(route_counts['freq'])
+        indptr.append(len(edge_ids))
+        if not len(infos) % 100000:
+            log.info("Collected %i routes", len(infos))
+    route_array = infos.array()
+    edges = np.empty(len(edge_ids), dtype=EDGE_DTYPE)
+    edges['edge'] = edge_ids.array()
+    edges['forward'] = forwards.array()
+    del edge_ids, forwards
+    edges, indices = np.unique(edges, return_inverse=True)
+    matrix = csr_matrix(
+        (freqs.array(), indices.astype(np.int32), indptr.array()),
+        shape=(len(route_array), len(edges)))
+    log.info("Built %i x %i incidence matrix with %i entries",
+             len(route_array), len(edges), matrix.nnz)
+    return IncidenceMatrix(matrix, route_array, edges)
+
+
+def iter_step_routes(connection, batch_size=100000):
+    """Read the routes and their steps from osrmroutes and osrmroutesteps
+
+    Yields (route info, edge keys, forwards) for :func:`build_incidence`.
+    Both tables are streamed in route_hash order with server side
+    cursors, and merged.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: batch_size - number of rows fetched at once
+    """
+    routes = connection.cursor('incidence_routes')
+    routes.itersize = batch_size
+    routes.execute("SELECT %s FROM osrmroutes ORDER BY route_hash"
+                   % ', '.join(ROUTE_COLUMNS))
+    steps = connection.cursor('incidence_steps')
+    steps.itersize = batch_size
+    steps.execute("SELECT route_hash, edge_id, forward FROM osrmroutesteps "
+                  "ORDER BY route_hash")
+    step_groups = itertools.groupby(steps, lambda x: x[0])
+    group = next(step_groups, None)
+    for info in routes:
+        # skip steps of routes which are missing
+        while group is not None and group[0] < info[0]:
+            group = next(step_groups, None)
+        if group is not None and group[0] == info[0]:
+            rows = list(group[1])
+            group = next(step_groups, None)
+            yield (info, np.array([x[1] for x in rows], dtype=np.int64),
+                   np.array([x[2] for x in rows], dtype=bool))
+        else:
+            yield info, np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+    routes.close()
+    steps.close()
+
+
+def iter_packed_routes(connection, batch_size=10000):
+    """Read the routes with packed steps from osrmroutes
+
+    Yields (route info, edge keys, forwards) for :func:`build_incidence`.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: batch_size - number of rows fetched at once
+    """
+    cursor = connection.cursor('incidence_packed')
+    cursor.itersize = batch_size
+    cursor.execute("SELECT %s, steps FROM osrmroutes "
+                   "WHERE steps IS NOT NULL" % ', '.join(ROUTE_COLUMNS))
+    for row in cursor:
+        edge_ids, forwards = unpack_edges(row[-1])
+        yield row[:-1], edge_ids, forwards
+    cursor.close()
+
+
+def route_distances(routes):
+    """Straight line start to end distance of routes
+
+    In the 1E-5 degree units of the coordinates, e.g. for distance
+    based weights.
+
+    :param: routes - :attr:`ROUTE_DTYPE` array
+    """
+    return np.hypot(routes['end_lat'] - routes['start_lat'].astype(float),
+                    routes['end_lon'] - routes['start_lon'].astype(float))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+'''
+
+Journal of resumable route runs
+===============================
+
+A run is split into fixed size chunks of route pairs.  Each chunk is
+sampled with its own random generator, seeded from the run seed and the
+chunk index, so any chunk can be regenerated exactly without replaying
+the ones before it.
+
+The journal is a SQLite file recording the configuration of each run,
+which chunks were started, and which were completely written to the
+database.  Restarting a run skips the completed chunks.  Chunks which
+were started but not completed are regenerated, and the routes already
+written from them are skipped before they are queried again.
+
+'''
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def chunk_seed(seed, chunk):
+    """Seed of the random generator of a chunk
+
+    Pass it to numpy.random.RandomState.
+    """
+    return [seed, chunk]
+
+
+class RunJournal(object):
+    """SQLite journal of the progress of a run
+
+    The journal can be used from many threads, each gets its own
+    connection.
+
+    :param: filename - path of the SQLite database
+    :param: run_id - name of the run
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS runs ('
+        'run_id TEXT PRIMARY KEY, config TEXT, created REAL)',
+        'CREATE TABLE IF NOT EXISTS chunks ('
+        'run_id TEXT, chunk INTEGER, routes INTEGER, done INTEGER, '
+        'updated REAL, PRIMARY KEY (run_id, chunk))',
+    ]
+
+    def __init__(self, filename, run_id):
+        self.filename = filename
+        self.run_id = run_id
+        self._local = threading.local()
+        with self.connection as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    @property
+    def connection(self):
+        """The SQLite connection of the calling thread"""
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = sqlite3.connect(
+                self.filename, timeout=60)
+        return self._local.connection
+
+    def start(self, config, check=()):
+        """Register the run, or get the configuration it was started with
+
+        Returns the stored configuration dictionary, which is config
+        itself for a new run.  Raises a ValueError if the run is resumed
+        with a different value of one of the check keys.
+
+        :param: config - JSON serializable run configuration,
+            e.g. the seed and number of routes
+        :param: check - keys of config which must not change on resume,
+            e.g. the :func:`nodes_fingerprint` the routes are sampled from
+        """
+        with self.connection as connection:
+            row = connection.execute(
+                'SELECT config FROM runs WHERE run_id = ?',
+                (self.run_id,)).fetchone()
+            if row is not None:
+                log.info("Resuming run %s", self.run_id)
+                stored = json.loads(row[0])
+                for key in check:
+                    if key not in stored:
+                        log.warning("Run %s has no %s to check",
+                                    self.run_id, key)
+                    elif stored[key] != config[key]:
+                        raise ValueError(
+                            "Run %s was started with %s %r, not %r" %
+                            (self.run_id, key, stored[key], config[key]))
+                return stored
+            log.info("Starting run %s", self.run_id)
+            connection.execute(
+                'INSERT INTO runs VALUES (?, ?, ?)',
+                (self.run_id, json.dumps(config), time.time()))
+        return config
+
+    def chunks(self, done):
+        """Get the set of started chunks, which are done or not"""
+        return set(x for x, in self.connection.execute(
+            'SELECT chunk FROM chunks WHERE run_id = ? AND done = ?',
+            (self.run_id, int(done))))
+
+    def start_chunk(self, chunk, routes):
+        """Record that a chunk of routes is about to be run"""
+        with self.connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, 0, ?)',
+                (self.run_id, chunk, routes, time.time()))
+
+    def complete_chunks(self, chunks):
+        """Record that all the routes of chunks are written"""
+        with self.connection as connection:
+            connection.executemany(
+                'UPDATE chunks SET done = 1, updated = ? '
+                'WHERE run_id = ? AND chunk = ?',
+                [(time.time(), self.run_id, chunk) for chunk in chunks])
+
+
+def nodes_fingerprint(ids, coords):
+    """Identify the nodes the pairs of a run are sampled from
+
+    Returns a string of the node count and the MD5 of the ids and
+    coordinates, in order, since the sampled chunks depend on both.
+    """
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    coords = np.ascontiguousarray(coords, dtype=np.int64)
+    digest = hashlib.md5(ids.tostring())
+    digest.update(coords.tostring())
+    return '%i:%s' % (len(ids), digest.hexdigest())
+
+
+def tagged(func):
+    """Wrap func to pass a tag through a pipeline stage
+
+    The wrapped function takes and returns (tag, item) pairs.  Unlike a
+    plain stage function, it also returns failed items, as (tag, None),
+    so that the end of the pipeline still sees them.
+    """
+    def wrapper(tagged_item):
+        tag, item = tagged_item
+        if item is None:
+            return tag, None
+        return tag, func(item)
+    return wrapper
+
+
+class ChunkTracker(object):
+    """Track which chunks of a run have been written
+
+    This is the final stage of a journaled pipeline.  It passes
+    converted routes tagged with their chunk to a
+    :class:`stanalysis.routewriter.RouteWriter`, and marks a chunk as
+    done in the journal once all its routes have been flushed.
+
+    :param: journal - a :class:`RunJournal`
+    :param: writer - a :class:`stanalysis.routewriter.RouteWriter`
+    """
+
+    def __init__(self, journal, writer):
+        self.journal = journal
+        self.writer = writer
+        writer.on_flush = self._flushed
+        self._expected = {}
+        self._received = {}
+        self._lock = threading.Lock()
+
+    def expect(self, chunk, routes):
+        """Start a chunk, which will be completed by routes items"""
+        self.journal.start_chunk(chunk, routes)
+        if not routes:
+            self.journal.complete_chunks([chunk])
+            return
+        with self._lock:
+            self._expected[chunk] = routes
+            self._received.setdefault(chunk, 0)
+
+    def add(self, tagged_item):
+        """Write a (chunk, converted route) item"""
+        chunk, converted = tagged_item
+        with self._lock:
+            self._received[chunk] = self._received.get(chunk, 0) + 1
+        if converted is not None:
+            self.writer.add(converted)
+
+    __call__ = add
+
+    def _flushed(self):
+        """Complete the chunks all of whose routes have been written"""
+        with self._lock:
+            done = [chunk for chunk, routes in self._expected.items()
+                    if self._received.get(chunk) == routes]
+            for chunk in done:
+                del self._expected[chunk]
+                del self._received[chunk]
+        if done:
+            self.journal.complete_chunks(done)
+            log.info("Completed chunks %s", ', '.join(map(str, done)))
+
+    def close(self):
+        """Flush the writer, and complete the chunks it held"""
+        self.writer.close()
+        self._flushed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def journaled_pairs(journal, tracker, n_chunks, make_chunk, written=None):
+    """Generate the (chunk, coords) items of the unfinished chunks
+
+    :param: journal - a :class:`RunJournal`
+    :param: tracker - a :class:`ChunkTracker`, told about each chunk
+        before its items are generated
+    :param: n_chunks - number of chunks in the run
+    :param: make_chunk - callable returning the list of route coords of
+        a chunk index, as hashable tuples
+    :param: written - callable filtering a list of route coords down to
+        those already written, used for chunks that were started before
+    """
+    done = journal.chunks(done=True)
+    started = journal.chunks(done=False)
+    log.info("%i of %i chunks are done already", len(done), n_chunks)
+    for chunk in range(n_chunks):
+        if chunk in done:
+            continue
+        pairs = make_chunk(chunk)
+        if chunk in started and written is not None:
+            skip = set(written(pairs))
+            log.info("Skipping %i written routes of chunk %i",
+                     len(skip), chunk)
+            pairs = [x for x in pairs if x not in skip]
+        tracker.expect(chunk, len(pairs))
+        for pair in pairs:
+            yield chunk, pair
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''
+
+Deterministic keys for edges and routes.
+
+An edge is identified by its unordered pair of node ids, packed into a
+64 bit integer as ``(min << 32) | max``.  The key is the same on every
+interpreter and platform, can be computed for whole arrays at once, and
+keeps the edges of a node close together in a B-tree.  It is also easy
+to compute in SQL::
+
+    (LEAST(source, sink)::bigint << 32) | GREATEST(source, sink)
+
+A route is identified by the first 64 bits of the MD5 of its comma
+separated integer coordinates, which is likewise reproducible in SQL::
+
+    ('x' || substr(md5(start_lat || ',' || start_lon || ','
+                       || end_lat || ',' || end_lon), 1, 16))::bit(64)::bigint
+
+'''
+
+import hashlib
+
+import numpy as np
+
+_UINT64 = 1 << 64
+_INT64_MAX = (1 << 63) - 1
+
+
+def _to_int64(value):
+    """Reinterpret an unsigned 64 bit value as signed (like BIGINT)"""
+    return int(value - _UINT64 if value > _INT64_MAX else value)
+
+
+def edge_key(source, sink):
+    """The key of the undirected edge between two node ids"""
+    lo, hi = sorted((int(source), int(sink)))
+    return _to_int64((lo << 32) | hi)
+
+
+def edge_keys(sources, sinks):
+    """Vectorized :func:`edge_key` over arrays of node ids
+
+    Returns an int64 array.
+    """
+    sources = np.asarray(sources, dtype=np.uint64)
+    sinks = np.asarray(sinks, dtype=np.uint64)
+    keys = (np.minimum(sources, sinks) << np.uint64(32)) | \
+        np.maximum(sources, sinks)
+    return keys.view(np.int64)
+
+
+def edge_key_nodes(keys):
+    """Unpack edge keys into arrays of (min node id, max node id)"""
+    keys = np.asarray(keys, dtype=np.int64).view(np.uint64)
+    return keys >> np.uint64(32), keys & np.uint64(0xFFFFFFFF)
+
+
+def _flatten(xs):
+    for x in xs:
+        if isinstance(x, (tuple, list, np.ndarray)):
+            for y in _flatten(x):
+                yield y
+        else:
+            yield x
+
+
+def route_hash(*xs):
+    """Hash the integers in xs (which may be nested sequences)
+
+    Returns the first 64 bits of the MD5 of the comma joined integers,
+    as a signed integer.
+    """
+    text = ','.join(str(int(x)) for x in _flatten(xs))
+    digest = hashlib.md5(text.encode('ascii')).hexdigest()
+    return _to_int64(int(digest[:16], 16))
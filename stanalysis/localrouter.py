@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+
+In-process batched routing, instead of an OSRM server
+=====================================================
+
+:class:`LocalRouter` is called like :func:`stanalysis.routerunner.run_route`
+from many pipeline threads, but routes over a
+:class:`stanalysis.routegraph.RouteGraph` in a pool of processes.  The
+pending requests are collected into batches, and the requests of a batch
+leaving from the same node share a single shortest path search.  So do
+those arriving at the same node, with a search over the reversed edges.
+
+Sharing needs several destinations per origin (``per_origin`` in the
+samplers): the forward runs of
+:func:`stanalysis.routerunner.generate_forward_backward_pairs` then share
+a search from their origin, and the backward runs one to it.  A lone
+pair takes a search for each of its runs.  Searches stop once their
+targets are reached, see :mod:`stanalysis.routegraph`.
+
+'''
+
+import collections
+from concurrent import futures
+import logging
+import multiprocessing
+import Queue
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+
+# The graph of a worker process
+_graph = None
+
+# Marks the end of the requests
+_STOP = object()
+
+# Destinations per origin to sample for the router, see above
+DEFAULT_PER_ORIGIN = 10
+
+
+def _init_worker(graph):
+    global _graph
+    _graph = graph
+
+
+def _search(backward, node, others):
+    """Route from (or backward, to) one node row in a worker process
+
+    Returns (routes, None), or (None, formatted traceback) on failure.
+    """
+    try:
+        if backward:
+            return _graph.routes_to(node, others), None
+        return _graph.routes_from(node, others), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class LocalRouter(object):
+    """Route with a :class:`stanalysis.routegraph.RouteGraph` in processes
+
+    Calling the router with a (start, end) pair of coordinates returns
+    (coords, url, steps) like :func:`stanalysis.routerunner.run_route`,
+    or None if there is no route.  It blocks until the batch holding the
+    request is routed, so call it from many threads.
+
+    :param: graph - a :class:`stanalysis.routegraph.RouteGraph`
+    :param: processes - number of worker processes, default one per CPU
+    :param: batch_size - maximum number of requests per batch
+    :param: max_wait - seconds to wait for a batch to fill up
+    """
+
+    # stored as the query of the routes
+    URL = 'local'
+
+    def __init__(self, graph, processes=None, batch_size=1000, max_wait=0.05):
+        self.graph = graph
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.searches = 0
+        self.routes = 0
+        self._pool = multiprocessing.Pool(processes, _init_worker, (graph,))
+        self._requests = Queue.Queue()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name='localrouter')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def __call__(self, coords):
+        future = futures.Future()
+        self._requests.put((coords, future))
+        return future.result()
+
+    def _next_batch(self):
+        """Collect the next batch of requests, None when stopped"""
+        request = self._requests.get()
+        if request is _STOP:
+            return None
+        batch = [request]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                request = self._requests.get(
+                    timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if request is _STOP:
+                # finish this batch first
+                self._requests.put(_STOP)
+                break
+            batch.append(request)
+        return batch
+
+    def _dispatch(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            try:
+                self._route_batch(batch)
+            except Exception as error:
+                log.exception("Routing a batch failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _route_batch(self, batch):
+        """Route a batch of requests, sharing searches where possible
+
+        Requests are grouped by source node, and those left alone are
+        grouped by target node instead, which gathers the backward runs
+        returning to a common origin.
+        """
+        rows = self.graph.snap(
+            [coords[0] for coords, _ in batch] +
+            [coords[1] for coords, _ in batch])
+        by_source = collections.defaultdict(list)
+        for request, source, target in zip(
+                batch, rows[:len(batch)], rows[len(batch):]):
+            by_source[source].append((request, source, target))
+        searches = []
+        by_target = collections.defaultdict(list)
+        for source, requests in by_source.items():
+            if len(requests) > 1:
+                searches.append((False, source,
+                                 [x[2] for x in requests],
+                                 [x[0] for x in requests]))
+            else:
+                by_target[requests[0][2]].append(requests[0])
+        for target, requests in by_target.items():
+            searches.append((True, target, [x[1] for x in requests],
+                             [x[0] for x in requests]))
+        self.searches += len(searches)
+        self.routes += len(batch)
+        for backward, node, others, requests in searches:
+            self._pool.apply_async(_search, (backward, node, others),
+                                   callback=self._resolver(requests))
+
+    def _resolver(self, requests):
+        """Get the callback resolving requests with the routes found"""
+        def resolve(result):
+            routes, error = result
+            for i, (coords, future) in enumerate(requests):
+                if error is not None:
+                    future.set_exception(RuntimeError(error))
+                elif routes[i] is None:
+                    log.error("No route found from %s => %s", *coords)
+                    future.set_result(None)
+                else:
+                    future.set_result((coords, self.URL, routes[i]))
+        return resolve
+
+    def close(self):
+        """Stop routing, after the pending requests"""
+        self._requests.put(_STOP)
+        self._dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+        log.info("Ran %i routes with %i shortest path searches",
+                 self.routes, self.searches)
@@ -9,10 +9,13 @@ from geoalchemy import \
     GeometryColumn, Point, LineString, WKTSpatialElement, GeometryDDL
 from geoalchemy.postgis import PGComparator
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Integer, Boolean, BigInteger, Float, String
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Integer, Boolean, BigInteger, Float, String, \
+    LargeBinary
+from sqlalchemy import Column, ForeignKey, Sequence
 from sqlalchemy.orm import relationship
 
+from stanalysis import keys
+
 Base = declarative_base()
 
 
@@ -63,8 +66,11 @@ class OSRMEdge(Base):
 
     @staticmethod
     def hash_edge(source, sink):
-        """Generate a hash of the identifying info"""
-        return hash(tuple(sorted((source, sink))))
+        """Generate a deterministic key of the identifying info
+
+        See :func:`stanalysis.keys.edge_key`.
+        """
+        return keys.edge_key(source, sink)
 
     @staticmethod
     def is_forward(source, sink):
@@ -85,6 +91,10 @@ class OSRMEdgeGeom(Base):
     edge = relationship("OSRMEdge")
 
 
+# Numbers the routes in the order they are added
+ROUTE_SEQUENCE = Sequence('osrmroutes_seq', metadata=Base.metadata)
+
+
 class OSRMRoute(Base):
     """Definte a toy, random route, run using the OSRM engine"""
     __tablename__ = "osrmroutes"
@@ -97,11 +107,19 @@ class OSRMRoute(Base):
     duration = Column(Integer)
     nsteps = Column(Integer)
     query = Column(String(200))
+    # Also filled in by raw inserts, see refresh-edge-frequencies.sql
+    seq = Column(BigInteger, ROUTE_SEQUENCE,
+                 server_default=ROUTE_SEQUENCE.next_value(), index=True)
+    # The steps, packed by stanalysis.packedsteps, if not in osrmroutesteps
+    steps = Column(LargeBinary)
 
     @staticmethod
     def hash_route(*xs):
-        """Generate an MD5 hash of the route info"""
-        return hash(xs)
+        """Generate an MD5 hash of the route info
+
+        See :func:`stanalysis.keys.route_hash`.
+        """
+        return keys.route_hash(*xs)
 
 
 class OSRMRouteStep(Base):
@@ -130,6 +148,15 @@ class OSRMEdgeFrequencies(Base):
     edgeobj = relationship("OSRMEdge")
 
 
+class OSRMCountedRoute(Base):
+    """A route whose edge counts were added to edgefrequencies as it was
+    written, so refresh-edge-frequencies.sql must not count its steps
+    again.
+    """
+    __tablename__ = "edgefrequencies_counted"
+    seq = Column(BigInteger, primary_key=True, autoincrement=False)
+
+
 class OSRMRouteNode(Base):
     __tablename__ = "routenodes"
     osm_id = Column(Integer, ForeignKey('osrmnodes.osm_id'), primary_key=True)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+'''
+
+Sorted index of OSRM nodes, for batched OSM id => node lookups.
+
+The index is built from the node section of an OSRM binary file and
+stored next to it, so later stages can resolve node ids to rows,
+coordinates and flags without a database round trip.
+
+'''
+
+import logging
+import os
+
+import numpy as np
+
+from stanalysis.osrmbinary import OSRMFile
+from stanalysis.osrmcache import is_cache_valid, write_source_manifest
+
+log = logging.getLogger(__name__)
+
+# Index record: the node data, sorted by id, plus the original row.
+INDEX_DTYPE = np.dtype([
+    ('id', '<u4'),
+    ('row', '<i8'),
+    ('lat', '<i4'),
+    ('lon', '<i4'),
+    ('bollard', 'i1'),
+    ('traffic_light', 'i1'),
+])
+
+INDEX_SUFFIX = '.nodeidx.npy'
+# Records the source file the index was built from, see osrmcache
+INDEX_MANIFEST_SUFFIX = '.nodeidx.json'
+
+
+class NodeIndex(object):
+    """Node records sorted by OSM id, with vectorized lookups
+
+    :param: index - structured array with dtype :data:`INDEX_DTYPE`,
+        sorted by id
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """Build an index from an array of :class:`OSRMNode` records"""
+        order = np.argsort(nodes['id'], kind='mergesort')
+        index = np.empty(len(nodes), dtype=INDEX_DTYPE)
+        index['row'] = order
+        for field in ('id', 'lat', 'lon', 'bollard', 'traffic_light'):
+            index[field] = nodes[field][order]
+        return cls(index)
+
+    @classmethod
+    def from_ids(cls, ids):
+        """Build an index of bare ids, e.g. graph vertices
+
+        The rows are the positions in ids, and the coordinates and flags
+        are zero.
+        """
+        ids = np.asarray(ids)
+        order = np.argsort(ids, kind='mergesort')
+        index = np.zeros(len(ids), dtype=INDEX_DTYPE)
+        index['id'] = ids[order]
+        index['row'] = order
+        return cls(index)
+
+    @classmethod
+    def load(cls, filename):
+        """Memory-map a saved index"""
+        return cls(np.load(filename, mmap_mode='r'))
+
+    def save(self, filename):
+        """Write the index to filename"""
+        np.save(filename, self.index)
+
+    @classmethod
+    def for_osrm_file(cls, filename):
+        """Get the index for an .osrm file, building it if necessary
+
+        The index is cached as filename + :data:`INDEX_SUFFIX`, and
+        rebuilt when the size or SHA1 of the .osrm file changes, like
+        the column cache of :mod:`stanalysis.osrmcache`.
+        """
+        cache = filename + INDEX_SUFFIX
+        directory, name = os.path.split(filename)
+        manifest = name + INDEX_MANIFEST_SUFFIX
+        if os.path.exists(cache) and \
+                is_cache_valid(filename, directory, manifest):
+            log.info("Loading node index from %s", cache)
+            return cls.load(cache)
+        log.info("Building node index for %s", filename)
+        with OSRMFile(filename) as osrm:
+            node_index = cls.from_nodes(osrm.nodes)
+        node_index.save(cache)
+        write_source_manifest(filename, directory, manifest)
+        return node_index
+
+    def positions(self, ids):
+        """Find the positions of ids in the sorted index
+
+        Returns a tuple of (positions, found), where found is a boolean
+        mask of the ids which exist in the index.
+        """
+        ids = np.asarray(ids)
+        positions = np.searchsorted(self.index['id'], ids)
+        # clip so the missing ids past the end can be compared safely
+        positions = np.minimum(positions, max(len(self.index) - 1, 0))
+        found = self.index['id'][positions] == ids \
+            if len(self.index) else np.zeros(ids.shape, dtype=bool)
+        return positions, found
+
+    def rows(self, ids):
+        """Map OSM ids to rows in the node section
+
+        Missing ids are mapped to -1.
+        """
+        positions, found = self.positions(ids)
+        return np.where(found, self.index['row'][positions], -1)
+
+    def lookup(self, ids):
+        """Get the index records (row, coordinates, flags) for ids
+
+        Raises :class:`KeyError` if any of the ids are not in the index.
+        """
+        positions, found = self.positions(ids)
+        if not found.all():
+            missing = np.asarray(ids)[~found]
+            raise KeyError("%i node ids not in index, e.g. %i" %
+                           (len(missing), missing.flat[0]))
+        return self.index[positions]
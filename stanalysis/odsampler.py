@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+'''
+
+Distance weighted origin-destination sampling on a grid
+=======================================================
+
+The points are bucketed into square grid cells.  A pair of points (i, j)
+is drawn with probability proportional to
+
+    exp(-(d_ij / scale)**2)
+
+where the distance between two points is approximated by the distance
+between their cells.  Origins are drawn from the cells weighted by the
+number of points around them, destinations from the cells around the
+origin, so nothing is rejected (except the rare pair of a point with
+itself), and the cost of a sample does not depend on the number of points.
+
+'''
+
+import itertools
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class GridSampler(object):
+    """Distance weighted pair sampler over grid buckets
+
+    :param: points - (N, 2) array of points
+    :param: scale - distance scale of the pair distribution
+    :param: cell_size - grid cell size, default half the scale.  Smaller
+        cells are more precise, but there are more of them to weigh.
+    :param: radius - pairs further apart than radius * scale are never
+        drawn
+    :param: chunk_size - number of cells weighed at once while building
+    """
+
+    def __init__(self, points, scale, cell_size=None, radius=3.,
+                 chunk_size=10000):
+        self.points = np.asarray(points)
+        self.scale = float(scale)
+        self.cell_size = float(cell_size or self.scale / 2.)
+        reach = int(np.ceil(radius * self.scale / self.cell_size))
+        # pad the grid by reach, so neighbouring cells are always in range
+        cells = np.floor((self.points - self.points.min(axis=0)) /
+                         self.cell_size).astype(np.int64) + reach
+        shape = tuple(cells.max(axis=0) + reach + 1)
+        flat = np.ravel_multi_index(tuple(cells.T), shape)
+        # only the occupied cells are kept, sorted by flat cell id, so
+        # the memory used does not grow with the extent of the grid
+        self.cells, cell_rows = np.unique(flat, return_inverse=True)
+        # point indices, grouped by cell
+        self.order = np.argsort(cell_rows, kind='mergesort')
+        self.counts = np.bincount(cell_rows)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+        dx, dy = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+        distances = np.hypot(dx, dy).ravel() * self.cell_size
+        in_range = distances <= radius * self.scale
+        self.offsets = (dx * shape[1] + dy).ravel()[in_range]
+        self.kernel = np.exp(-(distances[in_range] / self.scale) ** 2)
+
+        # the origin cell is weighted by all the pairs it starts
+        totals = np.concatenate([
+            self._neighbour_weights(rows).sum(axis=1)
+            for rows in np.array_split(
+                np.arange(len(self.cells)),
+                max(len(self.cells) // chunk_size, 1))])
+        self.origin_cumulative = np.cumsum(self.counts * totals)
+        log.info("Bucketed %i points in %i cells, %i neighbours each",
+                 len(self.points), len(self.cells), len(self.offsets))
+
+    def _cell_rows(self, cells):
+        """Find the rows of flat cell ids, -1 for unoccupied cells"""
+        rows = np.minimum(np.searchsorted(self.cells, cells),
+                          len(self.cells) - 1)
+        return np.where(self.cells[rows] == cells, rows, -1)
+
+    def _neighbour_weights(self, rows):
+        """Destination cell weights, for each of the cell rows
+
+        Returns a (len(rows), len(offsets)) array.
+        """
+        neighbours = self._cell_rows(
+            self.cells[rows][:, np.newaxis] + self.offsets)
+        return np.where(neighbours >= 0, self.counts[neighbours], 0) * \
+            self.kernel
+
+    def _pick_points(self, rows, random):
+        """Pick a random point in each of the cell rows"""
+        picks = (random.random_sample(len(rows)) *
+                 self.counts[rows]).astype(np.int64)
+        return self.order[self.starts[rows] + picks]
+
+    def sample(self, size, random=np.random, per_origin=1):
+        """Sample up to size pairs of point indices
+
+        Returns a tuple of (origin, destination) index arrays.  Pairs of
+        a point with itself are dropped, so fewer than size pairs may be
+        returned.
+
+        :param: size - number of pairs to draw
+        :param: random - random generator, e.g. a numpy RandomState
+        :param: per_origin - number of consecutive pairs drawn from each
+            origin, so a router can reuse its shortest path tree
+        """
+        total = self.origin_cumulative[-1]
+        origin_rows = np.searchsorted(
+            self.origin_cumulative,
+            random.random_sample(-(-size // per_origin)) * total,
+            side='right')
+        origin_rows = np.repeat(origin_rows, per_origin)[:size]
+        # weigh each distinct origin cell once
+        unique_rows, inverse = np.unique(origin_rows, return_inverse=True)
+        cumulative = np.cumsum(
+            self._neighbour_weights(unique_rows), axis=1)[inverse]
+        throws = random.random_sample(size) * cumulative[:, -1]
+        choices = (cumulative <= throws[:, np.newaxis]).sum(axis=1)
+        destination_rows = self._cell_rows(
+            self.cells[origin_rows] + self.offsets[choices])
+        origins = np.repeat(self._pick_points(
+            origin_rows[::per_origin], random), per_origin)[:size]
+        destinations = self._pick_points(destination_rows, random)
+        distinct = origins != destinations
+        return origins[distinct], destinations[distinct]
+
+    def generate_pairs(self, block_size=100000, seed=None, per_origin=1):
+        """Sample blocks of point index pairs
+
+        Don't stop.  Ever.
+
+        :param: block_size - number of pairs drawn at once
+        :param: seed - seed of the random generator, for reproducible runs
+        :param: per_origin - number of consecutive pairs per origin
+        """
+        random = np.random.RandomState(seed)
+        while True:
+            yield self.sample(block_size, random, per_origin)
+
+    def choices(self, N, block_size=100000, seed=None, per_origin=1):
+        """Generate N (origin, destination) pairs of points
+
+        :param: N - number of pairs to generate
+        :param: block_size - number of pairs drawn at once
+        :param: seed - seed of the random generator, for reproducible runs
+        :param: per_origin - number of consecutive pairs per origin
+        """
+        remaining = N
+        for starts, ends in self.generate_pairs(block_size, seed,
+                                                per_origin):
+            if remaining <= 0:
+                break
+            starts, ends = starts[:remaining], ends[:remaining]
+            remaining -= len(starts)
+            for start, end in itertools.izip(self.points[starts],
+                                             self.points[ends]):
+                yield (start, end)
+
+
+def generate_random_choices_grid(N, alist, scale, block_size=100000,
+                                 seed=None, per_origin=1, **kwargs):
+    """Generate N random choices from a list, distributed by distance
+
+    Like :func:`stanalysis.routerunner.generate_random_choices_batched`,
+    but sampled with a :class:`GridSampler`, without rejection.
+
+    :param: N - number of choices to generate
+    :param: alist - (N, 2) array of points
+    :param: scale - distance scale of the pair distribution
+    :param: block_size - number of pairs drawn at once
+    :param: seed - seed of the random generator, for reproducible runs
+    :param: per_origin - number of consecutive pairs per origin
+
+    Other keyword arguments are passed to :class:`GridSampler`.
+    """
+    sampler = GridSampler(alist, scale, **kwargs)
+    return sampler.choices(N, block_size, seed, per_origin)
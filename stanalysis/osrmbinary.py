@@ -12,9 +12,14 @@ into a PostGIS database.
 '''
 
 import collections
+from concurrent import futures
 import logging
 import struct
 
+import numpy as np
+
+from stanalysis.keys import edge_keys
+
 log = logging.getLogger(__name__)
 
 # Node datum and its packing
@@ -40,6 +45,33 @@ OSRMEdge = collections.namedtuple(
 )
 OSRMEdge.PACKING = struct.Struct('<IIihihIbbbb')
 
+# Map struct format codes onto little-endian numpy type codes
+_STRUCT_TO_NUMPY = {
+    'b': 'i1',
+    'h': '<i2',
+    'i': '<i4',
+    'I': '<u4',
+}
+
+
+def packing_dtype(DataType):
+    """Build a numpy structured dtype equivalent to DataType.PACKING
+
+    The fields are named after the namedtuple fields, and the
+    resulting itemsize is identical to the struct size.
+
+    :param: :class:`DataType` - a namedtuple with a PACKING attribute
+    """
+    codes = DataType.PACKING.format.lstrip('<')
+    dtype = np.dtype([
+        (name, _STRUCT_TO_NUMPY[code])
+        for name, code in zip(DataType._fields, codes)])
+    assert dtype.itemsize == DataType.PACKING.size
+    return dtype
+
+OSRMNode.DTYPE = packing_dtype(OSRMNode)
+OSRMEdge.DTYPE = packing_dtype(OSRMEdge)
+
 
 def read_uint32(inputfd, offset):
     """Read a 32bit integer at the given location"""
@@ -47,30 +79,139 @@ def read_uint32(inputfd, offset):
     return int(struct.unpack_from('<I', inputfd.read(4))[0])
 
 
-def unpack_osrm_data(DataType, inputfd, offset=0):
+def read_osrm_array(DataType, inputfd, offset=0):
+    """Read a whole section of OSRM data from an input stream
+
+    Returns a numpy structured array with dtype :attr:`DataType.DTYPE`.
+
+    :param: :class:`DataType` - the record type in the section
+    :param: inputfd - input data stream. Must be seek-able.
+    :param: offset - integer offset for the start of the data
+    """
+    num_objects = read_uint32(inputfd, offset)
+    log.info("Detected %i %s objects", num_objects, DataType.__name__)
+    inputfd.seek(offset + 4, 0)
+    return _read_records(DataType, inputfd, num_objects)
+
+
+def _read_records(DataType, inputfd, count):
+    """Read count DataType records from the current position"""
+    expected = count * DataType.DTYPE.itemsize
+    data = inputfd.read(expected)
+    if len(data) < expected:  # pragma: nocover
+        raise IOError(
+            "%s section truncated, expected length %i, got %i" %
+            (DataType.__name__, expected, len(data)))
+    return np.frombuffer(data, dtype=DataType.DTYPE, count=count)
+
+
+def edge_section_offset(inputfd):
+    """Find the offset where the edge section starts
+
+    :param: inputfd - input file descriptor
+    """
+    num_nodes = read_uint32(inputfd, 0)
+    # NB the + 4 is for the "num_nodes" bytes
+    return num_nodes * OSRMNode.PACKING.size + 4
+
+
+def read_osrm_nodes(inputfd):
+    """Read all OSRM nodes from an OSRM binary data file
+
+    Returns a structured array with dtype :attr:`OSRMNode.DTYPE`.
+
+    :param: inputfd - input file descriptor.
+    """
+    return read_osrm_array(OSRMNode, inputfd, 0)
+
+
+def read_osrm_edges(inputfd):
+    """Read all OSRM edges from an OSRM binary data file
+
+    Returns a structured array with dtype :attr:`OSRMEdge.DTYPE`.
+
+    :param: inputfd - input file descriptor
+    """
+    return read_osrm_array(OSRMEdge, inputfd, edge_section_offset(inputfd))
+
+
+def _copy_edge_range(task):
+    """Pool worker: copy a (osrm, start, stop) range of edges
+
+    The :class:`OSRMFile` is re-mapped in the worker, so only the range
+    is decoded there.
+    """
+    osrm, start, stop = task
+    return np.array(osrm.edges[start:stop])
+
+
+def read_osrm_edges_parallel(filename, processes=None, chunk_size=1000000,
+                             concatenate=True):
+    """Read the OSRM edge section using a pool of processes
+
+    The fixed-width edge section is split into byte ranges of
+    chunk_size edges, which are decoded independently from a memory map
+    of the file.
+
+    Returns a structured array with dtype :attr:`OSRMEdge.DTYPE`, or, if
+    concatenate is False, the list of per-chunk arrays in file order.
+
+    :param: filename - path to the .osrm file
+    :param: processes - number of worker processes, default is one per CPU
+    :param: chunk_size - number of edges decoded by each task
+    :param: concatenate - join the chunks into a single array
+    """
+    with OSRMFile(filename) as osrm:
+        num_edges = len(osrm.edges)
+        log.info("Reading %i edges in chunks of %i", num_edges, chunk_size)
+        tasks = [(osrm, start, min(start + chunk_size, num_edges))
+                 for start in range(0, num_edges, chunk_size)]
+        with futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = list(executor.map(_copy_edge_range, tasks))
+    if not concatenate:
+        return chunks
+    if not chunks:
+        return np.empty(0, dtype=OSRMEdge.DTYPE)
+    return np.concatenate(chunks)
+
+
+def unique_edge_rows(edges):
+    """Find the rows of the first occurrence of each undirected edge
+
+    Edges are identified by their (min, max) node pair, so a => b and
+    b => a are duplicates.
+
+    Returns a tuple of (rows, number of duplicates dropped), where rows
+    is a sorted integer array.
+
+    :param: edges - edge records with node_a and node_b fields
+    """
+    pairs = edge_keys(edges['node_a'], edges['node_b'])
+    _, rows = np.unique(pairs, return_index=True)
+    rows.sort()
+    return rows, len(pairs) - len(rows)
+
+
+def unpack_osrm_data(DataType, inputfd, offset=0, chunk_size=65536):
     """Unpack a OSRM data from an input stream
 
-    Yields each data object.
+    Yields each data object.  The records are decoded chunk_size at a
+    time, so memory use does not grow with the section.
 
     :param: :class:`DataType` - the class used to create
     each object.
     :param: inputfd - input data stream. Must be seek-able.
     :param: offset - integer offset for the start of the data
+    :param: chunk_size - number of records read at once
     """
     num_objects = read_uint32(inputfd, offset)
-    log.info("Detected %i %s objects", num_objects, DataType)
+    log.info("Detected %i %s objects", num_objects, DataType.__name__)
     inputfd.seek(offset + 4, 0)
-    datum_size = DataType.PACKING.size
-    for i in range(num_objects):
-        data = inputfd.read(datum_size)
-        if not data:  # pragma: nocover
-            # EOF
-            break
-        if len(data) < datum_size:  # pragma: nocover
-            raise IOError(
-                "datum #%i, expected length %i, got %i, (%s)" %
-                (i, datum_size, len(data), data))
-        yield DataType(*DataType.PACKING.unpack(data))
+    for start in range(0, num_objects, chunk_size):
+        chunk = _read_records(DataType, inputfd,
+                              min(chunk_size, num_objects - start))
+        for record in chunk.tolist():
+            yield DataType(*record)
 
 
 def unpack_osrm_nodes(inputfd):
@@ -91,10 +232,71 @@ def unpack_osrm_edges(inputfd):
 
     :param: inputfd - input file descriptor
     """
-    # find offset where edge data starts
-    num_nodes = read_uint32(inputfd, 0)
-    log.info("Skipping over %i nodes to read edges", num_nodes)
-    # NB the + 4 is for the "num_nodes" bytes
     for edge in unpack_osrm_data(OSRMEdge, inputfd,
-                                 num_nodes * OSRMNode.PACKING.size + 4):
+                                 edge_section_offset(inputfd)):
         yield edge
+
+
+class OSRMFile(object):
+    """Memory-mapped, random access view of an OSRM binary data file
+
+    The node and edge sections are exposed as structured arrays
+    (:attr:`nodes` and :attr:`edges`) backed by a read-only memory map,
+    so pages are only read from disk when touched, indexing is O(1), and
+    slicing returns views instead of copies.  Processes mapping the same
+    file share the OS page cache; pickling an :class:`OSRMFile` only
+    sends the filename, and the receiving process re-maps it.
+
+    :param: filename - path to the .osrm file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._map()
+
+    def _map(self):
+        self._mmap = np.memmap(self.filename, dtype=np.uint8, mode='r')
+        self.nodes = self._section(OSRMNode, 0)
+        self.edges = self._section(OSRMEdge, self.edge_offset)
+
+    def _section(self, DataType, offset):
+        """Map the section of DataType records starting at offset"""
+        count = int(self._mmap[offset:offset + 4].view('<u4')[0])
+        start = offset + 4
+        stop = start + count * DataType.DTYPE.itemsize
+        if stop > len(self._mmap):
+            raise IOError(
+                "%s: %s section truncated, expected %i bytes, got %i" %
+                (self.filename, DataType.__name__, stop, len(self._mmap)))
+        log.info("Mapped %i %s objects", count, DataType.__name__)
+        return self._mmap[start:stop].view(DataType.DTYPE)
+
+    @property
+    def edge_offset(self):
+        """Byte offset of the edge section"""
+        return 4 + len(self.nodes) * OSRMNode.DTYPE.itemsize
+
+    def node(self, i):
+        """Get the i-th node as a :class:`OSRMNode`"""
+        return OSRMNode(*self.nodes[i].tolist())
+
+    def edge(self, i):
+        """Get the i-th edge as a :class:`OSRMEdge`"""
+        return OSRMEdge(*self.edges[i].tolist())
+
+    def close(self):
+        """Release the memory map"""
+        self.nodes = self.edges = self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.filename = state['filename']
+        self._map()
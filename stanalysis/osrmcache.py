@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+
+Columnar cache of parsed OSRM binary files.
+
+The first time an .osrm file is loaded, each node and edge field is
+written to its own .npy file in a cache directory, along with a manifest
+recording the size, modification time and SHA1 of the source.  Later
+loads memory-map the columns instead of decoding the file again.
+
+An unchanged size and modification time is only trusted if the manifest
+was written well after the modification time, since a rewrite within
+the timestamp resolution keeps the time.  Otherwise the source is
+hashed, like git does for "racily clean" files.
+
+'''
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from stanalysis.osrmbinary import OSRMFile, OSRMNode, OSRMEdge, \
+    read_osrm_edges_parallel
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.cache'
+MANIFEST = 'manifest.json'
+
+# Seconds between a modification and a manifest trusting its time
+MTIME_RESOLUTION = 2
+
+SECTIONS = (('nodes', OSRMNode), ('edges', OSRMEdge))
+
+
+class ColumnTable(object):
+    """A set of equal length columns, accessed by field name
+
+    Supports the ``table[field]`` and ``len(table)`` subset of the
+    structured array interface.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    @property
+    def names(self):
+        return tuple(self.columns)
+
+
+def file_fingerprint(filename, blocksize=1 << 20):
+    """Compute the SHA1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as inputfd:
+        for block in iter(lambda: inputfd.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _column_path(cache_dir, section, field):
+    return os.path.join(cache_dir, '%s.%s.npy' % (section, field))
+
+
+def _read_manifest(cache_dir, name=MANIFEST):
+    try:
+        with open(os.path.join(cache_dir, name)) as inputfd:
+            return json.load(inputfd)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_manifest(cache_dir, manifest, name=MANIFEST):
+    path = os.path.join(cache_dir, name)
+    with open(path + '.tmp', 'w') as outputfd:
+        json.dump(manifest, outputfd)
+    os.rename(path + '.tmp', path)
+
+
+def write_source_manifest(filename, cache_dir, name=MANIFEST):
+    """Record the size, mtime and SHA1 of filename in a cache manifest
+
+    Write it after the cached data, so a partial cache is never valid.
+    """
+    stat = os.stat(filename)
+    _write_manifest(cache_dir, {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': file_fingerprint(filename),
+        'checked': time.time(),
+    }, name)
+
+
+def is_cache_valid(filename, cache_dir, name=MANIFEST):
+    """Check if the cache in cache_dir matches filename
+
+    The size and mtime are checked first.  If the mtime differs, or
+    the manifest was written too soon after it to tell a rewrite apart,
+    the contents are hashed, and the cache is kept (and its manifest
+    updated) if the hash is unchanged.
+
+    :param: name - file name of the manifest in cache_dir
+    """
+    manifest = _read_manifest(cache_dir, name)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    stat = os.stat(filename)
+    if manifest['size'] != stat.st_size:
+        log.info("Cache %s is stale: size changed", cache_dir)
+        return False
+    if manifest['mtime'] == stat.st_mtime and \
+            manifest.get('checked', 0) - stat.st_mtime > MTIME_RESOLUTION:
+        return True
+    if manifest['sha1'] != file_fingerprint(filename):
+        log.info("Cache %s is stale: content changed", cache_dir)
+        return False
+    manifest['mtime'] = stat.st_mtime
+    manifest['checked'] = time.time()
+    _write_manifest(cache_dir, manifest, name)
+    return True
+
+
+def build_cache(filename, cache_dir):
+    """Decode filename and write its columns to cache_dir"""
+    log.info("Building OSRM column cache in %s", cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Invalidate first, so a partial rebuild is never used.
+    if os.path.exists(os.path.join(cache_dir, MANIFEST)):
+        os.remove(os.path.join(cache_dir, MANIFEST))
+    with OSRMFile(filename) as osrm:
+        for section, DataType in SECTIONS:
+            data = getattr(osrm, section)
+            for field in DataType._fields:
+                np.save(_column_path(cache_dir, section, field), data[field])
+    write_source_manifest(filename, cache_dir)
+
+
+def load_cache(cache_dir):
+    """Memory-map the cached columns
+
+    Returns a tuple of (nodes, edges) :class:`ColumnTable`.
+    """
+    return tuple(
+        ColumnTable(dict(
+            (field, np.load(_column_path(cache_dir, section, field),
+                            mmap_mode='r'))
+            for field in DataType._fields))
+        for section, DataType in SECTIONS)
+
+
+def load_osrm_columns(filename, cache_dir=None):
+    """Load the nodes and edges of an .osrm file via the column cache
+
+    The cache is (re)built if it is missing or stale.
+
+    Returns a tuple of (nodes, edges) :class:`ColumnTable`.
+
+    :param: filename - path to the .osrm file
+    :param: cache_dir - cache location, default filename + CACHE_SUFFIX
+    """
+    if cache_dir is None:
+        cache_dir = filename + CACHE_SUFFIX
+    if not is_cache_valid(filename, cache_dir):
+        build_cache(filename, cache_dir)
+    else:
+        log.info("Using OSRM column cache in %s", cache_dir)
+    return load_cache(cache_dir)
+
+
+def open_osrm(filename, cache_dir=None, use_cache=True, processes=None):
+    """Get the (nodes, edges) of an .osrm file
+
+    Either through the column cache, or by mapping the file directly.
+
+    :param: processes - without the cache, decode the edges in memory
+        with this many processes, see
+        :func:`stanalysis.osrmbinary.read_osrm_edges_parallel`, instead
+        of mapping them
+    """
+    if use_cache:
+        return load_osrm_columns(filename, cache_dir)
+    osrm = OSRMFile(filename)
+    if processes is None:
+        return osrm.nodes, osrm.edges
+    return osrm.nodes, read_osrm_edges_parallel(filename, processes)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+'''
+
+Packed storage of route steps.
+
+Instead of one osrmroutesteps row per step, the steps of a route can be
+stored as a single compressed array in the steps column of osrmroutes.
+The array holds the route's node ids, from which the edge keys and
+directions follow (see :func:`stanalysis.routerunner.convert_steps`).
+The ids are delta encoded, since consecutive nodes tend to have close
+ids, and zlib compressed.
+
+'''
+
+import binascii
+import logging
+import zlib
+
+import numpy as np
+
+from stanalysis.edgefreq import EdgeFrequencyAccumulator, FREQ_TABLE, \
+    rebuild_derived, has_derived, add_bothways, advance_watermark
+from stanalysis.keys import edge_keys
+
+log = logging.getLogger(__name__)
+
+PACKED_DTYPE = np.dtype('<i8')
+
+
+def pack_route(node_ids):
+    """Pack the node ids of a route into a compressed string"""
+    node_ids = np.asarray(node_ids, dtype=PACKED_DTYPE)
+    deltas = np.empty_like(node_ids)
+    deltas[:1] = node_ids[:1]
+    deltas[1:] = np.diff(node_ids)
+    return zlib.compress(deltas.tostring())
+
+
+def unpack_route(packed):
+    """Get the node ids of a route packed by :func:`pack_route`"""
+    return np.cumsum(np.frombuffer(zlib.decompress(packed),
+                                   dtype=PACKED_DTYPE))
+
+
+def unpack_edges(packed):
+    """Get the (edge keys, forward flags) of a packed route"""
+    node_ids = unpack_route(packed)
+    starts, ends = node_ids[:-1], node_ids[1:]
+    return edge_keys(starts, ends), starts < ends
+
+
+def copy_literal(packed):
+    """Format a packed route as a bytea in a COPY text-format row"""
+    if packed is None:
+        return '\\N'
+    # hex bytea input, with the backslash escaped for COPY
+    return '\\\\x' + binascii.hexlify(packed)
+
+
+# The packed routes of a seq window, and whether they are in
+# edgefrequencies_counted
+PACKED_ROUTES = (
+    "SELECT route.steps, counted.seq IS NOT NULL "
+    "FROM osrmroutes AS route "
+    "LEFT JOIN edgefrequencies_counted AS counted "
+    "ON counted.seq = route.seq "
+    "WHERE route.steps IS NOT NULL AND route.seq > %s AND route.seq <= %s")
+
+# The osrmroutesteps rows of the routes of a seq window without packed steps
+UNPACKED_STEPS = (
+    "SELECT step.edge_id, step.forward, counted.seq IS NOT NULL "
+    "FROM osrmroutes AS route "
+    "INNER JOIN osrmroutesteps AS step "
+    "ON step.route_hash = route.route_hash "
+    "LEFT JOIN edgefrequencies_counted AS counted "
+    "ON counted.seq = route.seq "
+    "WHERE route.steps IS NULL AND route.seq > %s AND route.seq <= %s")
+
+
+def iter_packed_routes(connection, low, high, batch_size=10000):
+    """Iterate over the packed steps of the routes in osrmroutes
+
+    The routes are read with a server side cursor, in batches.  Yields
+    (packed route, counted) for each route with low < seq <= high, where
+    counted is True if the route is in edgefrequencies_counted.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: low, high - bounds of the route seqs
+    :param: batch_size - number of routes fetched at once
+    """
+    cursor = connection.cursor('packed_routes')
+    cursor.itersize = batch_size
+    cursor.execute(PACKED_ROUTES, (low, high))
+    for packed, counted in cursor:
+        yield packed, counted
+    cursor.close()
+
+
+def iter_unpacked_steps(connection, low, high, batch_size=100000):
+    """Iterate over the step rows of the routes without packed steps
+
+    Yields (edge ids, forwards, counted) arrays of up to batch_size
+    steps, of the routes with low < seq <= high.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: low, high - bounds of the route seqs
+    :param: batch_size - number of steps fetched at once
+    """
+    cursor = connection.cursor('unpacked_steps')
+    cursor.execute(UNPACKED_STEPS, (low, high))
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+        yield rows[:, 0], rows[:, 1] != 0, rows[:, 2] != 0
+    cursor.close()
+
+
+def count_packed_edges(packed_routes, accumulator, uncounted=None):
+    """Count the edge traversals of packed routes
+
+    Returns the number of routes counted.
+
+    :param: packed_routes - iterable of (packed route, counted)
+    :param: accumulator - a
+        :class:`stanalysis.edgefreq.EdgeFrequencyAccumulator`
+    :param: uncounted - an accumulator for the routes which are not
+        counted yet, or None
+    """
+    nroutes = 0
+    for packed, counted in packed_routes:
+        edges = unpack_edges(packed)
+        accumulator.add(*edges)
+        if uncounted is not None and not counted:
+            uncounted.add(*edges)
+        nroutes += 1
+        if not nroutes % 100000:
+            log.info("Counted %i packed routes", nroutes)
+    return nroutes
+
+
+def count_route_edges(connection, low, high, accumulator, uncounted=None,
+                      batch_size=10000):
+    """Count the edge traversals of the routes with low < seq <= high
+
+    Routes are counted from their packed steps, or from their
+    osrmroutesteps rows if they have none, so each is counted once.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: accumulator - an
+        :class:`stanalysis.edgefreq.EdgeFrequencyAccumulator` for all the
+        routes
+    :param: uncounted - an accumulator for the routes which are not in
+        edgefrequencies_counted, or None
+    :param: batch_size - number of routes fetched at once
+    """
+    nroutes = count_packed_edges(
+        iter_packed_routes(connection, low, high, batch_size),
+        accumulator, uncounted)
+    nsteps = 0
+    for edge_ids, forwards, counted in iter_unpacked_steps(
+            connection, low, high):
+        accumulator.add(edge_ids, forwards)
+        if uncounted is not None:
+            uncounted.add(edge_ids[~counted], forwards[~counted])
+        nsteps += len(edge_ids)
+    log.info("Counted %i packed routes and %i steps of unpacked routes, "
+             "with seq in (%i, %i]", nroutes, nsteps, low, high)
+
+
+def _lock_routes(cursor):
+    """Hold off new routes, returning the last route seq"""
+    cursor.execute("LOCK TABLE osrmroutes IN SHARE MODE")
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM osrmroutes")
+    return cursor.fetchone()[0]
+
+
+def recount_frequencies(connection, batch_size=10000):
+    """Replace edgefrequencies with the counts of every route
+
+    Also rebuilds the tables derived from it, see
+    :func:`stanalysis.edgefreq.rebuild_derived`.  Commits.
+    """
+    cursor = connection.cursor()
+    high = _lock_routes(cursor)
+    accumulator = EdgeFrequencyAccumulator()
+    count_route_edges(connection, 0, high, accumulator,
+                      batch_size=batch_size)
+    cursor.execute("DELETE FROM %s" % FREQ_TABLE)
+    accumulator.write(cursor)
+    rebuild_derived(cursor, high)
+    connection.commit()
+
+
+def refresh_frequencies(connection, batch_size=10000):
+    """Add the routes past the watermark to the edge frequency tables
+
+    Like refresh-edge-frequencies.sql, the routes in
+    edgefrequencies_counted are only added to edgefrequencies_bothways,
+    and the watermark is moved to the last route.  Commits.
+    """
+    cursor = connection.cursor()
+    if not has_derived(cursor):
+        raise ValueError("No edgefrequencies_watermark to refresh from, "
+                         "run edge-frequencies.sql first")
+    high = _lock_routes(cursor)
+    cursor.execute("SELECT seq FROM edgefrequencies_watermark")
+    low = cursor.fetchone()[0]
+    accumulator = EdgeFrequencyAccumulator()
+    uncounted = EdgeFrequencyAccumulator()
+    count_route_edges(connection, low, high, accumulator, uncounted,
+                      batch_size)
+    uncounted.write(cursor)
+    add_bothways(cursor, accumulator.counts())
+    advance_watermark(cursor, high)
+    connection.commit()
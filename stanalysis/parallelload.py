@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+'''
+
+Parallel, multi-connection bulk loading of OSRM data.
+
+The node and edge rows are split into partitions, and each partition is
+copied into PostGIS by a worker process over its own connection.  The
+workers map the .osrm file (or its column cache) themselves, so only the
+row indices of each partition are sent to them.  The cache is validated
+or built once, before the workers start, and they only read it.
+
+'''
+
+from concurrent import futures
+import logging
+import os
+import time
+
+import numpy as np
+from sqlalchemy import create_engine
+
+from stanalysis.bulkload import copy_records, node_records, edge_records, \
+    create_bare_tables, finalize_tables, NODE_COLUMNS, NODE_FORMAT, \
+    BARE_NODE_COLUMNS, BARE_NODE_FORMAT, EDGE_COLUMNS, EDGE_FORMAT, \
+    NODE_GEOMETRY
+from stanalysis.models import OSRMNode, OSRMEdge
+from stanalysis.osrmbinary import unique_edge_rows
+from stanalysis.osrmcache import open_osrm, load_cache, ColumnTable, \
+    CACHE_SUFFIX
+
+log = logging.getLogger(__name__)
+
+
+def _take(table, rows):
+    """Select rows from every column of a node or edge table"""
+    names = table.dtype.names if hasattr(table, 'dtype') else table.names
+    return ColumnTable(dict(
+        (field, np.asarray(table[field][rows])) for field in names))
+
+
+def _copy_partition(task):
+    """Worker: COPY one partition of nodes or edges
+
+    Returns a tuple of (partition, pid, rows copied, seconds).
+    """
+    (connection_string, filename, cache_dir, use_cache, kind, geometry,
+     partition, rows, batch_size) = task
+    start = time.time()
+    if use_cache:
+        nodes, edges = load_cache(cache_dir)
+    else:
+        nodes, edges = open_osrm(filename, use_cache=False)
+    if kind == 'nodes':
+        table, columns = OSRMNode.__tablename__, NODE_COLUMNS
+        fmt = NODE_FORMAT
+        if not geometry:
+            columns, fmt = BARE_NODE_COLUMNS, BARE_NODE_FORMAT
+        records = node_records(_take(nodes, rows), geometry)
+    else:
+        table, columns, fmt = OSRMEdge.__tablename__, EDGE_COLUMNS, \
+            EDGE_FORMAT
+        records = edge_records(_take(edges, rows))
+    connection = create_engine(connection_string).raw_connection()
+    try:
+        copied = copy_records(connection.cursor(), table, columns, fmt,
+                              records, batch_size)
+        connection.commit()
+    finally:
+        connection.close()
+    return partition, os.getpid(), copied, time.time() - start
+
+
+def _run_partitions(executor, kind, partitions, task_args):
+    """Copy the partitions of a table, and log the throughput"""
+    start = time.time()
+    tasks = [
+        task_args[:4] + (kind, task_args[4], i, rows, task_args[5])
+        for i, rows in enumerate(partitions)]
+    total = 0
+    for partition, pid, copied, elapsed in executor.map(
+            _copy_partition, tasks):
+        log.info("Worker %i copied %i %s in partition %i, %0.0f rows/s",
+                 pid, copied, kind, partition,
+                 copied / elapsed if elapsed else 0)
+        total += copied
+    elapsed = time.time() - start
+    log.info("Copied %i %s with %i partitions, %0.0f rows/s aggregate",
+             total, kind, len(partitions), total / elapsed if elapsed else 0)
+    return total
+
+
+def parallel_upload_osrm(connection_string, filename, workers,
+                         cache_dir=None, use_cache=True,
+                         defer_constraints=False, batch_size=100000):
+    """Load an .osrm file into PostGIS over several connections
+
+    If defer_constraints is set, the tables are created bare first, and
+    finalized once all partitions are loaded (see
+    :func:`stanalysis.bulkload.deferred_upload_osrm`); otherwise the
+    tables must already exist, and the nodes are loaded before the
+    edges, so the foreign keys are satisfied.
+
+    :param: connection_string - SQLAlchemy database URL
+    :param: filename - the .osrm file
+    :param: workers - number of worker processes and connections
+    :param: cache_dir, use_cache - see :func:`stanalysis.osrmcache.open_osrm`
+    :param: defer_constraints - create and finalize bare tables
+    :param: batch_size - number of rows sent per COPY
+    """
+    if use_cache and cache_dir is None:
+        cache_dir = filename + CACHE_SUFFIX
+    # without the cache, the edges are decoded by the workers too
+    nodes, edges = open_osrm(filename, cache_dir, use_cache, workers)
+    edge_rows, dropped = unique_edge_rows(edges)
+    log.info("Dropped %i duplicate edges", dropped)
+    node_partitions = np.array_split(np.arange(len(nodes)), workers)
+    edge_partitions = np.array_split(edge_rows, workers)
+
+    tables = (OSRMNode.__table__, OSRMEdge.__table__)
+    engine = create_engine(connection_string)
+    if defer_constraints:
+        connection = engine.raw_connection()
+        try:
+            create_bare_tables(connection.cursor(), tables)
+            connection.commit()
+        finally:
+            connection.close()
+
+    task_args = (connection_string, filename, cache_dir, use_cache,
+                 not defer_constraints, batch_size)
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        _run_partitions(executor, 'nodes', node_partitions, task_args)
+        _run_partitions(executor, 'edges', edge_partitions, task_args)
+
+    if defer_constraints:
+        log.info("Finalizing OSRM tables")
+        connection = engine.raw_connection()
+        try:
+            finalize_tables(connection.cursor(), tables,
+                            {OSRMNode.__tablename__: NODE_GEOMETRY})
+            connection.commit()
+        finally:
+            connection.close()
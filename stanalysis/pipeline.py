@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+'''
+
+A small threaded pipeline of stages connected by bounded queues.
+
+Items from a source iterable flow through each stage in turn.  Every
+stage has its own pool of worker threads, and a full queue blocks the
+stage feeding it, so a slow stage applies backpressure instead of
+letting work pile up in memory.  The queue depths are logged
+periodically, which shows which stage is the bottleneck.
+
+'''
+
+import logging
+import Queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the items in a queue
+_STOP = object()
+
+
+class Stage(object):
+    """A step in a :class:`Pipeline`
+
+    :param: name - used in log messages
+    :param: func - called with each input item.  The return value is
+        passed on to the next stage, unless it is None.
+    :param: workers - number of threads running func
+    :param: maxsize - capacity of the stage's input queue
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=1000):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize)
+        self.processed = 0
+        self._finished = 0
+        self._lock = threading.Lock()
+
+
+class Pipeline(object):
+    """Run items from a source through a sequence of stages
+
+    :param: source - iterable of input items
+    :param: report_every - seconds between queue depth log messages
+    """
+
+    def __init__(self, source, report_every=10):
+        self.source = source
+        self.report_every = report_every
+        self.stages = []
+        self.error = None
+
+    def add_stage(self, name, func, workers=1, maxsize=1000):
+        """Append a stage, see :class:`Stage`"""
+        self.stages.append(Stage(name, func, workers, maxsize))
+        return self
+
+    def _put(self, stage_idx, item):
+        """Queue an item for a stage, dropping it if past the last"""
+        if stage_idx < len(self.stages):
+            self.stages[stage_idx].queue.put(item)
+
+    def _stop(self, stage_idx):
+        """Tell all the workers of a stage there is no more input"""
+        if stage_idx < len(self.stages):
+            for _ in range(self.stages[stage_idx].workers):
+                self.stages[stage_idx].queue.put(_STOP)
+
+    def _feed(self):
+        try:
+            for item in self.source:
+                if self.error is not None:
+                    break
+                self._put(0, item)
+        except Exception as error:
+            log.exception("Pipeline source failed")
+            self.error = error
+        self._stop(0)
+
+    def _work(self, stage_idx):
+        stage = self.stages[stage_idx]
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            # After a failure, the queues are only drained.
+            if self.error is not None:
+                continue
+            try:
+                result = stage.func(item)
+            except Exception as error:
+                log.exception("Pipeline stage %s failed", stage.name)
+                self.error = error
+                continue
+            with stage._lock:
+                stage.processed += 1
+            if result is not None:
+                self._put(stage_idx + 1, result)
+        with stage._lock:
+            stage._finished += 1
+            last = stage._finished == stage.workers
+        if last:
+            self._stop(stage_idx + 1)
+
+    def queue_depths(self):
+        """Get a list of (stage name, queued items, processed items)"""
+        return [(stage.name, stage.queue.qsize(), stage.processed)
+                for stage in self.stages]
+
+    def report(self):
+        log.info("Queue depths: %s", ', '.join(
+            '%s=%i (%i done)' % x for x in self.queue_depths()))
+
+    def run(self):
+        """Run the pipeline until the source is exhausted
+
+        Raises the first exception raised by the source or a stage.
+        """
+        threads = [threading.Thread(target=self._feed, name='source')]
+        for i, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=self._work, args=(i,),
+                                 name='%s-%i' % (stage.name, j))
+                for j in range(stage.workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        last_report = time.time()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+                if time.time() - last_report > self.report_every:
+                    self.report()
+                    last_report = time.time()
+        self.report()
+        if self.error is not None:
+            raise self.error
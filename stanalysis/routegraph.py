@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+'''
+
+Shortest path routing over an in-memory road graph
+==================================================
+
+The graph is a sparse matrix of edge durations between node rows, and
+routes are found with Dijkstra's algorithm from scipy.  Routes are
+returned as the same (node_id, duration, lat, lon) step arrays that
+:func:`stanalysis.routerunner.parse_osrm_output` makes from OSRM output,
+so they can stand in for a real OSRM server.
+
+Searches stop at about the duration the targets are expected to take,
+judging by their straight line distance and the typical pace of the
+edges, and are only widened if some targets are not reached.
+
+'''
+
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from stanalysis.nodeindex import NodeIndex
+
+log = logging.getLogger(__name__)
+
+
+def _supports_limit():
+    """Check if dijkstra takes a distance limit, new in scipy 0.14"""
+    try:
+        dijkstra(csr_matrix((1, 1)), indices=0, limit=1.)
+    except TypeError:
+        return False
+    return True
+
+# Without it, searches always span the whole graph
+DIJKSTRA_LIMIT = _supports_limit()
+
+
+class RouteGraph(object):
+    """A directed road graph
+
+    Parallel edges are reduced to the fastest one.
+
+    :param: node_ids - OSRM node ids, one per node row
+    :param: coords - (N, 2) array of integer (lat, lon), scaled by 1E5
+    :param: sources - source node row of each directed edge
+    :param: targets - target node row of each directed edge
+    :param: durations - duration of each directed edge
+    """
+
+    def __init__(self, node_ids, coords, sources, targets, durations):
+        self.node_ids = np.asarray(node_ids)
+        self.coords = np.asarray(coords)
+        sources = np.asarray(sources)
+        targets = np.asarray(targets)
+        # zeros would be taken as missing edges
+        durations = np.maximum(np.asarray(durations), 1)
+        # keep the fastest of parallel edges, since the matrix sums them
+        order = np.lexsort((durations, targets, sources))
+        sources, targets, durations = \
+            sources[order], targets[order], durations[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | \
+            (targets[1:] != targets[:-1])
+        sources, targets, durations = \
+            sources[first], targets[first], durations[first]
+        self.matrix = csr_matrix(
+            (durations.astype(float), (sources, targets)),
+            shape=(len(self.node_ids),) * 2)
+        # typical duration per unit of straight line distance
+        lengths = np.hypot(*(self.coords[targets] -
+                             self.coords[sources]).T.astype(float))
+        moving = lengths > 0
+        self.pace = np.median(durations[moving] / lengths[moving]) \
+            if moving.any() else np.inf
+        self._reverse = None
+        self._tree = cKDTree(self.coords)
+        log.info("Built route graph of %i nodes, %i edges",
+                 len(self.node_ids), self.matrix.nnz)
+
+    @classmethod
+    def from_osrm(cls, nodes, edges):
+        """Build the graph of an OSRM file
+
+        :param: nodes - structured array of
+            :attr:`stanalysis.osrmbinary.OSRMNode.DTYPE`
+        :param: edges - structured array of
+            :attr:`stanalysis.osrmbinary.OSRMEdge.DTYPE`
+        """
+        return cls._from_edges(
+            NodeIndex.from_nodes(nodes), nodes['id'],
+            np.column_stack([nodes['lat'], nodes['lon']]),
+            edges['node_a'], edges['node_b'], edges['weight'],
+            edges['bidirectional'])
+
+    @classmethod
+    def from_db(cls, connection):
+        """Build the graph of the osrmnodes and osrmedges tables
+
+        :param: connection - a DBAPI (psycopg2) connection
+        """
+        cursor = connection.cursor()
+        cursor.execute("SELECT osm_id, lat, lon FROM osrmnodes "
+                       "ORDER BY osm_id")
+        nodes = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 3)
+        cursor.execute("SELECT source, sink, weight, bidirectional "
+                       "FROM osrmedges")
+        edges = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 4)
+        return cls._from_edges(
+            NodeIndex.from_ids(nodes[:, 0]), nodes[:, 0], nodes[:, 1:],
+            edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3])
+
+    @classmethod
+    def _from_edges(cls, index, node_ids, coords, node_a, node_b, weights,
+                    bidirectional):
+        """Build the graph of undirected edges between node ids
+
+        Edges with a node missing from the index are dropped.
+
+        :param: index - :class:`stanalysis.nodeindex.NodeIndex` mapping
+            the node ids to rows of node_ids and coords
+        """
+        rows_a = index.rows(node_a)
+        rows_b = index.rows(node_b)
+        known = (rows_a >= 0) & (rows_b >= 0)
+        if not known.all():
+            log.warning("Dropping %i edges with unknown nodes",
+                        np.count_nonzero(~known))
+        rows_a, rows_b = rows_a[known], rows_b[known]
+        weights = np.asarray(weights)[known]
+        both = np.asarray(bidirectional)[known] != 0
+        return cls(node_ids, coords,
+                   np.concatenate([rows_a, rows_b[both]]),
+                   np.concatenate([rows_b, rows_a[both]]),
+                   np.concatenate([weights, weights[both]]))
+
+    @classmethod
+    def grid(cls, nx, ny, spacing=100, origin=(3400000, -11800000),
+             duration=10):
+        """Build a synthetic grid of two way streets
+
+        :param: nx, ny - number of nodes along each axis
+        :param: spacing - distance between neighbouring nodes
+        :param: origin - (lat, lon) of the first node
+        :param: duration - duration of each edge
+        """
+        rows = np.arange(nx * ny).reshape(nx, ny)
+        coords = np.column_stack([
+            origin[0] + spacing * (rows // ny).ravel(),
+            origin[1] + spacing * (rows % ny).ravel()])
+        sources = np.concatenate([rows[:-1, :].ravel(), rows[:, :-1].ravel()])
+        targets = np.concatenate([rows[1:, :].ravel(), rows[:, 1:].ravel()])
+        durations = np.ones(2 * len(sources)) * duration
+        return cls(rows.ravel(), coords,
+                   np.concatenate([sources, targets]),
+                   np.concatenate([targets, sources]), durations)
+
+    def snap(self, coords):
+        """Get the rows of the nodes nearest to (lat, lon) coords"""
+        return self._tree.query(np.atleast_2d(coords))[1]
+
+    def _steps(self, path, elapsed):
+        """Build the step array of a path of node rows
+
+        :param: elapsed - duration from the start to each node of the path
+        """
+        steps = np.empty((len(path), 4), dtype=int)
+        steps[:, 0] = self.node_ids[path]
+        steps[0, 1] = 0
+        steps[1:, 1] = np.diff(elapsed)
+        steps[:, 2:] = self.coords[path]
+        return steps
+
+    def route(self, start, end):
+        """Route between the nodes nearest to two (lat, lon) coordinates
+
+        Returns the route as an array of (node_id, duration, lat, lon)
+        steps, or None if there is no route.
+        """
+        source, target = self.snap([start, end])
+        return self.routes_from(source, [target])[0]
+
+    def _search(self, matrix, node, others, widen=4, tries=3):
+        """Run Dijkstra from node until the others are reached
+
+        The search is limited to 1.5 times the expected duration to the
+        furthest of the others, and the limit widened by a factor of
+        widen for each try, before a last unlimited search.  Searches
+        are unlimited with scipy versions before 0.14.
+
+        Returns the (distances, predecessors) of the search.
+        """
+        distance = np.hypot(*(self.coords[others] -
+                              self.coords[node]).T.astype(float)).max()
+        if not DIJKSTRA_LIMIT or not np.isfinite(self.pace):
+            tries = 0
+        limit = max(1.5 * self.pace * distance, 1.)
+        for _ in range(tries):
+            distances, predecessors = dijkstra(
+                matrix, indices=node, return_predecessors=True,
+                limit=limit)
+            if np.isfinite(distances[others]).all():
+                return distances, predecessors
+            limit *= widen
+        return dijkstra(matrix, indices=node, return_predecessors=True)
+
+    def routes_from(self, source, targets):
+        """Route from one node row to many
+
+        Returns a list of step arrays, or None for unreachable targets.
+        """
+        distances, predecessors = self._search(self.matrix, source, targets)
+        routes = []
+        for target in targets:
+            if np.isinf(distances[target]):
+                routes.append(None)
+                continue
+            path = [target]
+            while path[-1] != source:
+                path.append(predecessors[path[-1]])
+            path = path[::-1]
+            routes.append(self._steps(path, distances[path]))
+        return routes
+
+    def routes_to(self, target, sources):
+        """Route from many node rows to one
+
+        Searches backwards from the target over the reversed edges.
+        Returns a list of step arrays, or None for unreachable sources.
+        """
+        if self._reverse is None:
+            self._reverse = self.matrix.T.tocsr()
+        distances, successors = self._search(self._reverse, target, sources)
+        routes = []
+        for source in sources:
+            if np.isinf(distances[source]):
+                routes.append(None)
+                continue
+            path = [source]
+            while path[-1] != target:
+                path.append(successors[path[-1]])
+            routes.append(self._steps(
+                path, distances[source] - distances[path]))
+        return routes
@@ -6,8 +6,15 @@ Tools to run random routes using the OSRM
 import itertools
 import logging
 import math
+import sqlite3
+import threading
+import time
+import zlib
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+
+from stanalysis.keys import edge_keys
 
 log = logging.getLogger(__name__)
 
@@ -68,6 +75,80 @@ def generate_random_choices_exponential(N, alist):
         yield output
 
 
+def max_step_distance(alist):
+    """Largest distance between consecutive points of alist
+
+    This is the distance scale used by the exponential samplers.
+
+    :param: alist - (N, 2) array of points
+    """
+    alist = np.asarray(alist)
+    return np.hypot(*(alist[1:] - alist[:-1]).T).max()
+
+
+def sample_pairs_exponential(alist, block_size=100000, seed=None,
+                             per_origin=1):
+    """Sample index pairs in blocks, weighted by their distance
+
+    Vectorized equivalent of :func:`generate_random_choices_exponential`.
+    Candidate pairs are drawn block_size at a time, and each pair is kept
+    with probability exp(-(d/max_distance)**2), where max_distance is the
+    largest distance between consecutive points.  The accepted pairs of
+    each block are yielded as a tuple of (start, end) index arrays.
+
+    Each candidate origin can be paired with several candidate
+    destinations, which leaves the distribution of each pair unchanged,
+    but lets a router reuse a shortest path tree for the pairs of an
+    origin.
+
+    Don't stop.  Ever.
+
+    :param: alist - (N, 2) array of points
+    :param: block_size - number of candidate pairs drawn at once
+    :param: seed - seed of the random generator, for reproducible runs
+    :param: per_origin - number of consecutive candidates per origin
+    """
+    alist = np.asarray(alist)
+    max_distance = max_step_distance(alist)
+    random = np.random.RandomState(seed)
+    norigins = -(-block_size // per_origin)
+    while True:
+        # like randint(0, len(alist)-1) above, the last point is never drawn
+        starts = np.repeat(random.randint(0, len(alist) - 1, size=norigins),
+                           per_origin)[:block_size]
+        ends = random.randint(0, len(alist) - 1, size=block_size)
+        throws = random.random_sample(block_size)
+        distances = np.hypot(*(alist[starts] - alist[ends]).T)
+        accept = (starts != ends) & (
+            throws < np.exp(-(distances / max_distance) ** 2))
+        yield starts[accept], ends[accept]
+
+
+def generate_random_choices_batched(N, alist, block_size=100000, seed=None,
+                                    per_origin=1):
+    """Generate N random choices from a list, exponentially distributed
+
+    Like :func:`generate_random_choices_exponential`, but the pairs are
+    drawn and accepted in blocks with :func:`sample_pairs_exponential`.
+
+    :param: N - number of choices to generate
+    :param: alist - (N, 2) array of points
+    :param: block_size - number of candidate pairs drawn at once
+    :param: seed - seed of the random generator, for reproducible runs
+    :param: per_origin - number of consecutive candidates per origin
+    """
+    alist = np.asarray(alist)
+    remaining = N
+    for starts, ends in sample_pairs_exponential(alist, block_size, seed,
+                                                 per_origin):
+        if remaining <= 0:
+            break
+        starts, ends = starts[:remaining], ends[:remaining]
+        remaining -= len(starts)
+        for start, end in itertools.izip(alist[starts], alist[ends]):
+            yield (start, end)
+
+
 def generate_forward_backward_pairs(iterable):
     """ Takes an iterable of pairs, and yields it both forward and backwards.
 
@@ -114,6 +195,25 @@ def parse_osrm_output(response):
     return np.array(response.json()['raw_data'], dtype=int)
 
 
+def convert_steps(steps):
+    """Convert raw OSRM node steps into edge steps
+
+    Each consecutive pair of nodes in steps is one traversed edge.
+
+    Returns a tuple of arrays (edge keys, forward flags, step indices),
+    with one entry per edge, matching the columns of
+    :class:`stanalysis.models.OSRMRouteStep`.
+
+    :param: steps - array of (node_id, duration, lat, lon) rows, as
+        returned by :func:`parse_osrm_output`
+    """
+    node_ids = np.asarray(steps)[:, 0]
+    starts, ends = node_ids[:-1], node_ids[1:]
+    # forward is low => high, see OSRMEdge.is_forward
+    return (edge_keys(starts, ends), starts < ends,
+            np.arange(len(starts), dtype=np.int32))
+
+
 def run_route(coords, host='localhost', port=5000):  # pragma: nocover
     """Query an OSRM server for a route
 
@@ -132,3 +232,226 @@ def run_route(coords, host='localhost', port=5000):  # pragma: nocover
                   url, response.status_code)
         return None
     return coords, url, parse_osrm_output(response)
+
+
+class RouteClient(object):
+    """OSRM client which keeps its connections alive in a pool
+
+    Calling the client runs a route, like :func:`run_route`, but reuses
+    pooled keep-alive connections to the server instead of opening one
+    per request.  It is safe to call from many threads.
+
+    :param: host - hostname of OSRM server
+    :param: port - port of OSRM server
+    :param: pool_size - maximum number of connections kept open
+    """
+
+    def __init__(self, host='localhost', port=5000, pool_size=100):
+        self.host = host
+        self.port = port
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size))
+
+    def __call__(self, coords):  # pragma: nocover
+        log.debug("Running route from %s => %s", coords[0], coords[1])
+        url = build_osrm_url(coords, self.host, self.port)
+        response = self.session.get(url)
+        if response.status_code != 200:
+            log.error("Route lookup with %s failed with %i.",
+                      url, response.status_code)
+            return None
+        return coords, url, parse_osrm_output(response)
+
+    def close(self):
+        """Close the pooled connections"""
+        self.session.close()
+
+
+class RouteCache(object):
+    """On-disk cache of OSRM routes
+
+    Routes are stored in a SQLite database, keyed by the fingerprint of
+    the OSRM dataset and the directed (start, end) coordinates, with the
+    steps as zlib compressed int64 arrays.  Once the stored steps exceed
+    max_bytes, the least recently used routes are evicted.  The reverse
+    of a route is not reused, as one way streets can make it differ.
+
+    The total size is kept in a one row table, updated along with the
+    routes, and the use times of hits are written in batches of
+    touch_batch, or by :meth:`flush`.
+
+    Each thread uses its own connection, and SQLite locks the file, so
+    the cache can be shared by many threads and processes.
+
+    :param: filename - path of the SQLite database
+    :param: fingerprint - identifies the OSRM dataset, e.g. the
+        :func:`stanalysis.osrmcache.file_fingerprint` of its .osrm file
+    :param: max_bytes - size bound of the stored steps, None for no bound
+    :param: touch_batch - number of hits whose use times are batched
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS routes ('
+        'fingerprint TEXT, start_lat INTEGER, start_lon INTEGER, '
+        'end_lat INTEGER, end_lon INTEGER, url TEXT, steps BLOB, '
+        'size INTEGER, last_used REAL, '
+        'PRIMARY KEY (fingerprint, start_lat, start_lon, end_lat, end_lon))',
+        'CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)',
+        'CREATE TABLE IF NOT EXISTS routes_size (total INTEGER NOT NULL)',
+        # caches made before the size table are summed once
+        'INSERT INTO routes_size SELECT COALESCE(SUM(size), 0) FROM routes '
+        'WHERE NOT EXISTS (SELECT 1 FROM routes_size)',
+    ]
+
+    KEY_CLAUSE = ('fingerprint = ? AND start_lat = ? AND start_lon = ? AND '
+                  'end_lat = ? AND end_lon = ?')
+
+    def __init__(self, filename, fingerprint='', max_bytes=None,
+                 touch_batch=1000):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.touch_batch = touch_batch
+        self._local = threading.local()
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+        with self.connection as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    @property
+    def connection(self):
+        """The SQLite connection of the calling thread"""
+        if getattr(self._local, 'connection', None) is None:
+            connection = sqlite3.connect(self.filename, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return self._local.connection
+
+    def _key(self, coords):
+        (start_lat, start_lon), (end_lat, end_lon) = coords
+        return (self.fingerprint, int(start_lat), int(start_lon),
+                int(end_lat), int(end_lon))
+
+    def get(self, coords):
+        """Get a cached route, or None
+
+        Returns (coords, url, steps), like :func:`run_route`.
+        """
+        key = self._key(coords)
+        row = self.connection.execute(
+            'SELECT url, steps FROM routes WHERE ' + self.KEY_CLAUSE,
+            key).fetchone()
+        if row is None:
+            return None
+        with self._touch_lock:
+            self._touched[key] = time.time()
+            full = len(self._touched) >= self.touch_batch
+        if full:
+            self.flush()
+        url, blob = row
+        steps = np.frombuffer(zlib.decompress(blob), dtype=np.int64)
+        return coords, url, steps.reshape(-1, 4).astype(int)
+
+    def flush(self):
+        """Write the use times of the hits since the last flush"""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        with self.connection as connection:
+            connection.executemany(
+                'UPDATE routes SET last_used = ? WHERE ' + self.KEY_CLAUSE,
+                [(used,) + key for key, used in touched.iteritems()])
+
+    def put(self, coords, url, steps):
+        """Store a route
+
+        :param: coords - the (start, end) coordinates of the route
+        :param: url - the query URL
+        :param: steps - array of raw OSRM steps,
+            see :func:`parse_osrm_output`
+        """
+        steps = np.asarray(steps, dtype=np.int64).reshape(-1, 4)
+        blob = zlib.compress(steps.tostring())
+        key = self._key(coords)
+        if self.max_bytes is not None:
+            # evict by up to date use times
+            self.flush()
+        with self.connection as connection:
+            # net of the size of a route being replaced
+            connection.execute(
+                'UPDATE routes_size SET total = total + ? - COALESCE('
+                '(SELECT size FROM routes WHERE ' + self.KEY_CLAUSE +
+                '), 0)', (len(blob),) + key)
+            connection.execute(
+                'INSERT OR REPLACE INTO routes VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (url, sqlite3.Binary(blob), len(blob), time.time()))
+            if self.max_bytes is not None:
+                self._evict(connection)
+
+    def size(self):
+        """Total size of the stored steps"""
+        return self.connection.execute(
+            'SELECT total FROM routes_size').fetchone()[0]
+
+    def _evict(self, connection):
+        total = connection.execute(
+            'SELECT total FROM routes_size').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict down to 90% of the bound, so we don't evict on every put
+        excess = total - int(0.9 * self.max_bytes)
+        evicted = 0
+        cursor = connection.execute(
+            'SELECT rowid, size FROM routes ORDER BY last_used')
+        rowids = []
+        for rowid, size in cursor:
+            if evicted >= excess:
+                break
+            rowids.append((rowid,))
+            evicted += size
+        connection.executemany('DELETE FROM routes WHERE rowid = ?', rowids)
+        connection.execute('UPDATE routes_size SET total = total - ?',
+                           (evicted,))
+        log.info("Evicted %i cached routes", len(rowids))
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM routes WHERE fingerprint = ?',
+            (self.fingerprint,)).fetchone()[0]
+
+
+class CachedRouteRunner(object):
+    """Run routes through a :class:`RouteCache`
+
+    Only routes missing from the cache are passed to route_runner, and
+    successful results are stored.
+
+    :param: route_runner - callable running one route,
+        e.g. a :class:`RouteClient`
+    :param: cache - a :class:`RouteCache`
+    """
+
+    def __init__(self, route_runner, cache):
+        self.route_runner = route_runner
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, coords):
+        cached = self.cache.get(coords)
+        with self._lock:
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if cached is not None:
+            return cached
+        result = self.route_runner(coords)
+        if result is not None:
+            self.cache.put(*result)
+        return result
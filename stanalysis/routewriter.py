@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+'''
+
+Buffered COPY writer for routes and their steps.
+
+Routes are collected in memory, along with their step arrays, and
+flushed to osrmroutes and osrmroutesteps with COPY when enough rows
+have accumulated, or enough time has passed since the last flush.
+
+'''
+
+import collections
+import logging
+import time
+
+import numpy as np
+
+from stanalysis.bulkload import copy_records
+from stanalysis.keys import route_hash
+from stanalysis.models import OSRMRoute, OSRMRouteStep, OSRMCountedRoute
+from stanalysis.packedsteps import pack_route, copy_literal
+from stanalysis.routerunner import convert_steps
+
+log = logging.getLogger(__name__)
+
+ROUTE_COLUMNS = ('route_hash', 'start_lat', 'start_lon', 'end_lat',
+                 'end_lon', 'duration', 'nsteps', 'query')
+ROUTE_FORMAT = '%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s'
+ROUTE_DTYPE = np.dtype([
+    ('route_hash', '<i8'),
+    ('start_lat', '<i4'),
+    ('start_lon', '<i4'),
+    ('end_lat', '<i4'),
+    ('end_lon', '<i4'),
+    ('duration', '<i8'),
+    ('nsteps', '<i4'),
+    ('query', 'S200'),
+])
+
+# The rows copied into osrmroutes also hold the packed steps, or NULL
+STORED_ROUTE_COLUMNS = ROUTE_COLUMNS + ('steps',)
+STORED_ROUTE_FORMAT = ROUTE_FORMAT + '\t%s'
+STORED_ROUTE_DTYPE = np.dtype(ROUTE_DTYPE.descr + [('steps', object)])
+
+STEP_COLUMNS = ('route_hash', 'step_idx', 'edge_id', 'forward')
+STEP_FORMAT = '%d\t%d\t%d\t%d'
+STEP_DTYPE = np.dtype([
+    ('route_hash', '<i8'),
+    ('step_idx', '<i4'),
+    ('edge_id', '<i8'),
+    ('forward', 'i1'),
+])
+
+ROUTE_TABLE = OSRMRoute.__tablename__
+STEP_TABLE = OSRMRouteStep.__tablename__
+
+# Insert the staged routes which are not in the table yet
+INSERT_NEW_ROUTES = (
+    "INSERT INTO {routes} ({columns}) "
+    "SELECT {columns} FROM {routes}_staging AS s "
+    "WHERE NOT EXISTS (SELECT 1 FROM {routes} AS r "
+    "WHERE r.route_hash = s.route_hash) "
+    "RETURNING route_hash, seq").format(
+        routes=ROUTE_TABLE, columns=', '.join(STORED_ROUTE_COLUMNS))
+
+# Mark routes whose edge counts are already in edgefrequencies
+MARK_COUNTED = "INSERT INTO {counted} (seq) SELECT unnest(%s::bigint[])" \
+    .format(counted=OSRMCountedRoute.__tablename__)
+
+# A route ready to be written
+ConvertedRoute = collections.namedtuple(
+    'ConvertedRoute',
+    ROUTE_COLUMNS + ('edge_ids', 'forwards', 'step_idxs', 'node_ids'))
+
+
+def written_routes(connection, coords_list):
+    """Filter a list of route coordinates down to the routes in the DB
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: coords_list - list of (start, end) coordinates
+    """
+    hashes = dict((route_hash(tuple(start), tuple(end)), (start, end))
+                  for start, end in coords_list)
+    if not hashes:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT route_hash FROM %s WHERE route_hash = ANY(%%s)" % ROUTE_TABLE,
+        (list(hashes),))
+    return [hashes[x] for x, in cursor]
+
+
+def convert_route(route):
+    """Convert the result of a route query into a :class:`ConvertedRoute`
+
+    Returns None if the route has no steps.
+
+    :param: route - (coords, query url, steps) as returned by
+        :func:`stanalysis.routerunner.run_route`
+    """
+    coords, query_url, steps = route
+    if not len(steps):
+        log.error("No steps returned for route: %s", coords)
+        return None
+    edge_ids, forwards, step_idxs = convert_steps(steps)
+    return ConvertedRoute(
+        route_hash(tuple(coords[0]), tuple(coords[1])),
+        coords[0][0], coords[0][1], coords[1][0], coords[1][1],
+        steps[:, 1].sum(), len(steps), query_url,
+        edge_ids, forwards, step_idxs, steps[:, 0])
+
+
+class RouteWriter(object):
+    """Buffer routes and write them in batches with COPY
+
+    A flush happens when the buffered step rows reach max_rows, or when a
+    route is added more than max_seconds after the last flush.  Call
+    :meth:`close` (or use the writer as a context manager) to flush the
+    rest on shutdown.
+
+    The routes are copied into a temporary table first, and only routes
+    not already in osrmroutes are inserted, along with their steps and
+    edge counts.
+
+    :param: connection - a DBAPI (psycopg2) connection
+    :param: max_rows - flush threshold on the number of buffered steps
+    :param: max_seconds - flush threshold on the time since the last flush
+    :param: on_flush - called without arguments after each committed flush
+    :param: write_steps - if False, the steps are not written to
+        osrmroutesteps
+    :param: frequencies - a
+        :class:`stanalysis.edgefreq.EdgeFrequencyAccumulator`, adding the
+        edge counts of the new routes to edgefrequencies with each flush.
+        The routes are recorded in edgefrequencies_counted, so refreshes
+        don't count them again.
+    :param: packed_steps - if True, the steps are also stored packed in
+        osrmroutes, see :mod:`stanalysis.packedsteps`
+    """
+
+    def __init__(self, connection, max_rows=100000, max_seconds=10,
+                 on_flush=None, write_steps=True, frequencies=None,
+                 packed_steps=False):
+        self.connection = connection
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.on_flush = on_flush
+        self.write_steps = write_steps
+        self.frequencies = frequencies
+        self.packed_steps = packed_steps
+        self.routes_written = 0
+        self.steps_written = 0
+        self._routes = collections.OrderedDict()
+        self._buffered_steps = 0
+        self._last_flush = time.time()
+
+    def add(self, converted):
+        """Buffer a :class:`ConvertedRoute`, flushing if needed"""
+        if converted.route_hash in self._routes:
+            log.warning("Skipping duplicate route %i", converted.route_hash)
+            return
+        self._routes[converted.route_hash] = converted
+        self._buffered_steps += len(converted.edge_ids)
+        if self._buffered_steps >= self.max_rows or \
+                time.time() - self._last_flush >= self.max_seconds:
+            self.flush()
+
+    __call__ = add
+
+    def _route_records(self):
+        routes = np.empty(len(self._routes), dtype=STORED_ROUTE_DTYPE)
+        for i, converted in enumerate(self._routes.values()):
+            packed = None
+            if self.packed_steps:
+                packed = pack_route(converted.node_ids)
+            routes[i] = converted[:len(ROUTE_COLUMNS)] + \
+                (copy_literal(packed),)
+        return routes
+
+    def _step_records(self, routes):
+        steps = np.empty(sum(len(x.edge_ids) for x in routes),
+                         dtype=STEP_DTYPE)
+        offset = 0
+        for converted in routes:
+            end = offset + len(converted.edge_ids)
+            steps['route_hash'][offset:end] = converted.route_hash
+            steps['step_idx'][offset:end] = converted.step_idxs
+            steps['edge_id'][offset:end] = converted.edge_ids
+            steps['forward'][offset:end] = converted.forwards
+            offset = end
+        return steps
+
+    def _write(self, cursor):
+        """Insert the new routes, then their steps and edge counts
+
+        The routes are copied into a staging table first, so routes
+        which are already in the table are skipped, along with their
+        steps and edge counts.
+
+        Returns the list of routes which were new.
+        """
+        cursor.execute(
+            "CREATE TEMPORARY TABLE %s_staging (LIKE %s) ON COMMIT DROP"
+            % (ROUTE_TABLE, ROUTE_TABLE))
+        records = self._route_records()
+        copy_records(cursor, ROUTE_TABLE + '_staging', STORED_ROUTE_COLUMNS,
+                     STORED_ROUTE_FORMAT, records, max(len(records), 1))
+        cursor.execute(INSERT_NEW_ROUTES)
+        inserted = cursor.fetchall()
+        new_routes = [self._routes[x] for x, _ in inserted]
+        if len(new_routes) < len(self._routes):
+            log.info("Skipping %i routes which are already written",
+                     len(self._routes) - len(new_routes))
+        if self.write_steps:
+            steps = self._step_records(new_routes)
+            copy_records(cursor, STEP_TABLE, STEP_COLUMNS, STEP_FORMAT,
+                         steps, max(len(steps), 1))
+        if self.frequencies is not None:
+            for converted in new_routes:
+                self.frequencies.add(converted.edge_ids, converted.forwards)
+            self.frequencies.write(cursor)
+            # so refreshes skip their steps, packed or not
+            cursor.execute(MARK_COUNTED, ([x for _, x in inserted],))
+        return new_routes
+
+    def flush(self):
+        """Write all the buffered routes and steps"""
+        self._last_flush = time.time()
+        if not self._routes:
+            return
+        start = time.time()
+        try:
+            new_routes = self._write(self.connection.cursor())
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            # the counts are written with the routes, or not at all
+            if self.frequencies is not None:
+                self.frequencies.clear()
+        # only count the routes which were not already in the table
+        new_steps = sum(len(x.edge_ids) for x in new_routes)
+        self.routes_written += len(new_routes)
+        self.steps_written += new_steps
+        log.info("Flushed %i new routes with %i steps in %0.1fs, "
+                 "%i routes written", len(new_routes), new_steps,
+                 time.time() - start, self.routes_written)
+        self._routes.clear()
+        self._buffered_steps = 0
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def close(self):
+        """Flush the remaining routes"""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+
+A local stand-in for an OSRM server
+===================================
+
+Answers the ``/viaroute?loc=..&loc=..&raw=true`` queries built by
+:func:`stanalysis.routerunner.build_osrm_url` with routes computed by a
+:class:`stanalysis.routegraph.RouteGraph`, after an artificial latency.
+This allows testing and benchmarking the route runners without a real
+OSRM instance or a network.
+
+'''
+
+import BaseHTTPServer
+import json
+import logging
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+log = logging.getLogger(__name__)
+
+
+class StubOSRMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles route queries for a :class:`StubOSRMServer`"""
+
+    # keep-alive, like the real server
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        try:
+            if url.path != '/viaroute':
+                raise ValueError("Unknown service %s" % url.path)
+            locs = urlparse.parse_qs(url.query)['loc']
+            start, end = [
+                tuple(int(round(float(x) * 1E5)) for x in loc.split(','))
+                for loc in locs]
+        except (KeyError, ValueError) as error:
+            self._respond(400, json.dumps({'status_message': str(error)}))
+            return
+        self.server.wait()
+        steps = self.server.router.route(start, end)
+        if steps is None:
+            self._respond(404, json.dumps(
+                {'status': 207, 'status_message': 'Cannot find route'}))
+            return
+        self._respond(200, json.dumps(
+            {'status': 0, 'raw_data': steps.tolist()}))
+
+    def log_message(self, fmt, *args):
+        log.debug(fmt, *args)
+
+
+class StubOSRMServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server answering OSRM route queries
+
+    Each request is handled in its own thread, and waits latency seconds,
+    plus a uniformly distributed random jitter of up to jitter seconds,
+    before it is answered.
+
+    :param: address - (host, port) to listen on, port 0 picks a free one
+    :param: router - a :class:`stanalysis.routegraph.RouteGraph`
+    :param: latency - fixed delay of each response, in seconds
+    :param: jitter - maximum random extra delay, in seconds
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # allow many concurrent connections
+    request_queue_size = 1024
+
+    def __init__(self, address, router, latency=0., jitter=0.):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubOSRMHandler)
+        self.router = router
+        self.latency = latency
+        self.jitter = jitter
+
+    def wait(self):
+        """Sleep for the artificial latency of a response"""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def start_stub_server(router, host='localhost', port=0, latency=0.,
+                      jitter=0.):
+    """Start a :class:`StubOSRMServer` in a background thread
+
+    Returns the server.  Its actual port is ``server.server_address[1]``,
+    and ``server.shutdown()`` stops it.
+    """
+    server = StubOSRMServer((host, port), router, latency, jitter)
+    thread = threading.Thread(target=server.serve_forever, name='stubosrm')
+    thread.daemon = True
+    thread.start()
+    log.info("Stub OSRM server listening on %s:%i", *server.server_address)
+    return server
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the COPY based bulk loading of OSRM data
+
+'''
+
+import logging
+import numpy
+import shutil
+import tempfile
+from geoalchemy import WKTSpatialElement
+from nose.tools import eq_
+logging.basicConfig(level=logging.WARNING)
+
+log = logging.getLogger(__name__)
+
+from stanalysis.tests.mockdb import test_db_session, engine
+from stanalysis.models import OSRMNode, OSRMEdge, Base
+from stanalysis.osrmbinary import OSRMNode as OSRMNodeDatum, \
+    OSRMEdge as OSRMEdgeDatum
+from stanalysis.bulkload import node_records, edge_records, \
+    format_copy_rows, bulk_upload_osrm, update_osrm, deferred_upload_osrm, \
+    NODE_FORMAT, EDGE_FORMAT, BARE_NODE_FORMAT
+from stanalysis.parallelload import parallel_upload_osrm
+from stanalysis.tests.test_osrmbinary import make_dummy_file
+
+
+def make_arrays():
+    nodes = numpy.zeros(3, dtype=OSRMNodeDatum.DTYPE)
+    nodes['id'] = [1, 2, 3]
+    nodes['lat'] = [3400000, 3400001, 3400002]
+    nodes['lon'] = [-11800000, -11800001, -11800002]
+    nodes['bollard'] = [1, 0, 0]
+    edges = numpy.zeros(3, dtype=OSRMEdgeDatum.DTYPE)
+    edges['node_a'] = [1, 2, 2]
+    edges['node_b'] = [2, 3, 1]
+    edges['distance'] = [10, 20, 30]
+    edges['weight'] = [1, 2, 3]
+    edges['bidirectional'] = [1, 0, 0]
+    return nodes, edges
+
+
+def test_format_nodes():
+    nodes, edges = make_arrays()
+    rows = format_copy_rows(node_records(nodes), NODE_FORMAT).read()
+    eq_(rows.splitlines()[0],
+        '1\t3400000\t-11800000\t1\t0\t'
+        'SRID=4326;POINT(-118.000000 34.000000)')
+
+
+def test_format_bare_nodes():
+    nodes, edges = make_arrays()
+    rows = format_copy_rows(
+        node_records(nodes, geometry=False), BARE_NODE_FORMAT).read()
+    eq_(rows.splitlines()[1], '2\t3400001\t-11800001\t0\t0')
+
+
+def test_format_edges():
+    nodes, edges = make_arrays()
+    records = edge_records(edges)
+    # the 2 => 1 edge is a duplicate of 1 => 2
+    eq_(len(records), 2)
+    rows = format_copy_rows(records, EDGE_FORMAT).read().splitlines()
+    eq_(rows[1], '%i\t2\t3\t20\t2\t0' % OSRMEdge.hash_edge(2, 3))
+
+
+def test_bulk_upload():
+    with test_db_session() as session:
+        nodes, edges = make_arrays()
+        bulk_upload_osrm(session.connection().connection, nodes, edges,
+                         batch_size=2)
+        eq_(session.query(OSRMNode).count(), 3)
+        eq_(session.query(OSRMEdge).count(), 2)
+        edge = session.query(OSRMEdge).filter_by(
+            hash=OSRMEdge.hash_edge(1, 2)).one()
+        eq_(edge.source_node.bollard, True)
+        eq_(edge.bidirectional, True)
+
+
+def test_update():
+    with test_db_session() as session:
+        nodes, edges = make_arrays()
+        connection = session.connection().connection
+        bulk_upload_osrm(connection, nodes, edges)
+        # move node 1, drop node 3 and its edge, add node 4 with an edge
+        new_nodes = nodes[[0, 1, 1]].copy()
+        new_nodes['lat'][0] += 10
+        new_nodes['id'][2] = 4
+        new_edges = edges[[0, 1]].copy()
+        new_edges['node_b'][1] = 4
+        changes = update_osrm(connection, new_nodes, new_edges)
+        eq_(changes['nodes'], {'inserted': 1, 'updated': 1, 'deleted': 1})
+        eq_(changes['edges'], {'inserted': 1, 'updated': 0, 'deleted': 1})
+        session.expire_all()
+        eq_(sorted(x.osm_id for x in session.query(OSRMNode)), [1, 2, 4])
+        eq_(session.query(OSRMNode).get(1).lat, 3400010)
+        eq_(sorted((x.source, x.sink) for x in session.query(OSRMEdge)),
+            [(1, 2), (2, 4)])
+        # nothing to do the second time around
+        changes = update_osrm(connection, new_nodes, new_edges)
+        eq_(changes['nodes'], {'inserted': 0, 'updated': 0, 'deleted': 0})
+
+
+def test_deferred_upload():
+    with test_db_session() as session:
+        nodes, edges = make_arrays()
+        Base.metadata.drop_all(engine)
+        deferred_upload_osrm(engine.raw_connection(), nodes, edges)
+        Base.metadata.create_all(engine)
+        eq_(session.query(OSRMNode).count(), 3)
+        # the geometries are built in the DB
+        covering_box = WKTSpatialElement(
+            'POLYGON((-119 33, -117 33, -117 35, -119 35, -119 33))')
+        eq_(session.query(OSRMNode).filter(
+            OSRMNode.geom.covered_by(covering_box)).count(), 3)
+        edge = session.query(OSRMEdge).filter_by(
+            hash=OSRMEdge.hash_edge(1, 2)).one()
+        eq_(edge.source_node.bollard, True)
+
+
+def test_parallel_upload():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    with test_db_session() as session:
+        parallel_upload_osrm(str(engine.url), dummy_file.name, 3,
+                             use_cache=False, batch_size=7)
+        eq_(session.query(OSRMNode).count(), 100)
+        eq_(session.query(OSRMEdge).count(), 20)
+
+
+def test_parallel_upload_cached():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with test_db_session() as session:
+            Base.metadata.drop_all(engine)
+            # the workers read the cache built by the parent
+            parallel_upload_osrm(str(engine.url), dummy_file.name, 3,
+                                 cache_dir=cache_dir,
+                                 defer_constraints=True)
+            Base.metadata.create_all(engine)
+            eq_(session.query(OSRMNode).count(), 100)
+            eq_(session.query(OSRMEdge).count(), 20)
+    finally:
+        shutil.rmtree(cache_dir)
@@ -5,13 +5,19 @@ Test the edge frequency table access/insertion/joins
 '''
 
 import logging
+import os
+import numpy
 from nose.tools import eq_
 logging.basicConfig(level=logging.WARNING)
 
 log = logging.getLogger(__name__)
 
 from stanalysis.tests.mockdb import test_db_session
-from stanalysis.models import OSRMEdgeFrequencies, OSRMNode, OSRMEdge
+from stanalysis.models import OSRMEdgeFrequencies, OSRMNode, OSRMEdge, \
+    OSRMRouteStep, OSRMCountedRoute
+from stanalysis.edgefreq import count_edges, EdgeFrequencyAccumulator, \
+    rebuild_derived
+from stanalysis.routewriter import RouteWriter, convert_route
 
 
 def test_freq_backref():
@@ -47,3 +53,127 @@ def test_freq_backref():
         # test join
         eq_(results[0].edgeobj.source, 1)
         eq_(results[0].edgeobj.sink, 2)
+
+
+def test_count_edges():
+    counts = count_edges([5, 3, 5, 5, 3], [1, 0, 1, 0, 0])
+    eq_(counts.tolist(), [(3, 0, 2), (5, 0, 1), (5, 1, 2)])
+    eq_(len(count_edges([], [])), 0)
+
+
+def test_accumulator():
+    accumulator = EdgeFrequencyAccumulator(compact_rows=3)
+    accumulator.add(numpy.array([5, 3]), numpy.array([True, False]))
+    accumulator.add(numpy.array([5, 7]), numpy.array([True, True]))
+    accumulator.add(numpy.array([3]), numpy.array([False]))
+    eq_(accumulator.counts().tolist(), [(3, 0, 2), (5, 1, 2), (7, 1, 1)])
+    eq_(len(accumulator), 3)
+    eq_(accumulator.steps_added, 5)
+    accumulator.clear()
+    eq_(len(accumulator), 0)
+
+
+def test_route_writer_frequencies():
+    with test_db_session() as session:
+        for node_id in (1, 2, 3):
+            session.add(OSRMNode(node_id, node_id, node_id, False, False))
+        session.add(OSRMEdge(1, 2, 5, 5, True))
+        session.add(OSRMEdge(2, 3, 5, 5, True))
+        session.commit()
+
+        def route(start, end, node_ids):
+            steps = numpy.array([(x, 10, 0, 0) for x in node_ids])
+            return convert_route(((start, end), 'url', steps))
+        writer = RouteWriter(session.connection().connection,
+                             write_steps=False,
+                             frequencies=EdgeFrequencyAccumulator())
+        with writer:
+            writer.add(route((1, 1), (3, 3), [1, 2, 3]))
+            writer.add(route((3, 3), (1, 1), [3, 2, 1]))
+        with writer:
+            writer.add(route((1, 1), (2, 2), [1, 2]))
+            # already counted
+            writer.add(route((1, 1), (3, 3), [1, 2, 3]))
+        freqs = dict(((x.edge, x.forward), x.freq)
+                     for x in session.query(OSRMEdgeFrequencies))
+        eq_(freqs, {
+            (OSRMEdge.hash_edge(1, 2), True): 2,
+            (OSRMEdge.hash_edge(1, 2), False): 1,
+            (OSRMEdge.hash_edge(2, 3), True): 1,
+            (OSRMEdge.hash_edge(2, 3), False): 1,
+        })
+        eq_(session.query(OSRMRouteStep).count(), 0)
+
+
+def test_refresh_after_accumulation():
+    refresh = open(os.path.join(os.path.dirname(__file__), '..', '..',
+                                'refresh-edge-frequencies.sql')).read()
+    with test_db_session() as session:
+        for node_id in (1, 2, 3):
+            session.add(OSRMNode(node_id, node_id, node_id, False, False))
+        session.add(OSRMEdge(1, 2, 5, 5, True))
+        session.add(OSRMEdge(2, 3, 5, 5, True))
+        session.commit()
+        connection = session.connection().connection
+        cursor = connection.cursor()
+        # as left by edge-frequencies.sql over no routes
+        cursor.execute(
+            "CREATE TABLE edgefrequencies_watermark (seq BIGINT NOT NULL);"
+            "INSERT INTO edgefrequencies_watermark VALUES (0);"
+            "CREATE TABLE edgefrequencies_bothways (edge BIGINT PRIMARY KEY, "
+            "freq BIGINT, logfreq FLOAT, speed FLOAT, geom geometry)")
+        try:
+            def route(start, end, node_ids):
+                steps = numpy.array([(x, 10, 0, 0) for x in node_ids])
+                return convert_route(((start, end), 'url', steps))
+            counted = RouteWriter(connection,
+                                  frequencies=EdgeFrequencyAccumulator())
+            with counted:
+                counted.add(route((1, 1), (3, 3), [1, 2, 3]))
+            uncounted = RouteWriter(connection)
+            with uncounted:
+                uncounted.add(route((3, 3), (1, 1), [3, 2, 1]))
+            eq_(session.query(OSRMCountedRoute).count(), 1)
+            cursor.execute(refresh)
+            # each route is counted once
+            freqs = dict(((x.edge, x.forward), x.freq)
+                         for x in session.query(OSRMEdgeFrequencies))
+            eq_(freqs, {
+                (OSRMEdge.hash_edge(1, 2), True): 1,
+                (OSRMEdge.hash_edge(1, 2), False): 1,
+                (OSRMEdge.hash_edge(2, 3), True): 1,
+                (OSRMEdge.hash_edge(2, 3), False): 1,
+            })
+            eq_(session.query(OSRMCountedRoute).count(), 0)
+        finally:
+            connection.rollback()
+            cursor.execute("DROP TABLE IF EXISTS edgefrequencies_watermark; "
+                           "DROP TABLE IF EXISTS edgefrequencies_bothways")
+            connection.commit()
+
+
+def test_rebuild_derived():
+    with test_db_session() as session:
+        connection = session.connection().connection
+        cursor = connection.cursor()
+        # nothing to rebuild before edge-frequencies.sql
+        rebuild_derived(cursor, 5)
+        cursor.execute(
+            "CREATE TABLE edgefrequencies_watermark (seq BIGINT NOT NULL);"
+            "INSERT INTO edgefrequencies_watermark VALUES (0);"
+            "CREATE TABLE edgefrequencies_bothways (edge BIGINT PRIMARY KEY, "
+            "freq BIGINT, logfreq FLOAT, speed FLOAT, geom geometry);"
+            "INSERT INTO edgefrequencies_bothways VALUES (1, 1, 0, 1, NULL);"
+            "INSERT INTO edgefrequencies_counted VALUES (3)")
+        try:
+            rebuild_derived(cursor, 5)
+            cursor.execute("SELECT seq FROM edgefrequencies_watermark")
+            eq_(cursor.fetchall(), [(5,)])
+            cursor.execute("SELECT COUNT(*) FROM edgefrequencies_bothways")
+            eq_(cursor.fetchone()[0], 0)
+            eq_(session.query(OSRMCountedRoute).count(), 0)
+        finally:
+            connection.rollback()
+            cursor.execute("DROP TABLE IF EXISTS edgefrequencies_watermark; "
+                           "DROP TABLE IF EXISTS edgefrequencies_bothways")
+            connection.commit()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the route by edge incidence matrix
+
+'''
+
+import numpy
+import shutil
+import tempfile
+from nose.tools import eq_, raises
+
+from stanalysis.incidence import IncidenceMatrix, build_incidence, \
+    route_distances
+
+
+def make_routes():
+    return [
+        ((1, 0, 0, 3, 4, 10), [5, 6, 5], [True, False, True]),
+        ((2, 0, 0, 0, 0, 0), [], []),
+        ((3, 3, 4, 0, 0, 20), [6], [False]),
+    ]
+
+
+def test_build_incidence():
+    incidence = build_incidence(make_routes())
+    eq_(incidence.edges.tolist(), [(5, 1), (6, 0)])
+    eq_(incidence.matrix.toarray().tolist(), [[2, 1], [0, 0], [0, 1]])
+    eq_(incidence.routes['route_hash'].tolist(), [1, 2, 3])
+    eq_(incidence.frequencies().tolist(), [2, 2])
+    eq_(incidence.frequencies([0.5, 1, 2]).tolist(), [1, 2.5])
+    eq_(route_distances(incidence.routes).tolist(), [5, 0, 5])
+
+
+@raises(ValueError)
+def test_frequencies_weights():
+    build_incidence(make_routes()).frequencies([1, 2])
+
+
+def test_empty_incidence():
+    incidence = build_incidence([])
+    eq_(incidence.matrix.shape, (0, 0))
+    eq_(len(incidence.frequencies()), 0)
+
+
+def test_save_load():
+    tempdir = tempfile.mkdtemp()
+    try:
+        build_incidence(make_routes()).save(tempdir)
+        incidence = IncidenceMatrix.load(tempdir)
+        assert(isinstance(incidence.routes, numpy.memmap))
+        eq_(incidence.frequencies([0.5, 1, 2]).tolist(), [1, 2.5])
+        eq_(incidence.edges.tolist(), [(5, 1), (6, 0)])
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the journal of resumable route runs
+
+'''
+
+import os
+import shutil
+import tempfile
+import numpy
+from nose.tools import eq_, assert_raises
+
+from stanalysis.journal import RunJournal, ChunkTracker, journaled_pairs, \
+    nodes_fingerprint, tagged
+
+
+class FakeWriter(object):
+    """Stands in for a RouteWriter, flushing every 3 routes"""
+
+    def __init__(self):
+        self.buffered = []
+        self.written = []
+        self.on_flush = None
+
+    def add(self, route):
+        self.buffered.append(route)
+        if len(self.buffered) == 3:
+            self.flush()
+
+    def flush(self):
+        self.written.extend(self.buffered)
+        self.buffered = []
+        self.on_flush()
+
+    def close(self):
+        if self.buffered:
+            self.flush()
+
+
+def make_chunk(chunk):
+    return [(chunk, i) for i in range(4)]
+
+
+def run(journal, writer, n_chunks, stop_after=None, written=None):
+    tracker = ChunkTracker(journal, writer)
+    convert = tagged(lambda x: None if x[1] == 3 else x)
+    items = journaled_pairs(journal, tracker, n_chunks, make_chunk, written)
+    for i, item in enumerate(items):
+        if i == stop_after:
+            # crash, without closing the tracker
+            return
+        tracker(convert(item))
+    tracker.close()
+
+
+def test_journal_resume():
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'journal.sqlite')
+        journal = RunJournal(filename, 'run')
+        eq_(journal.start({'seed': 1}), {'seed': 1})
+        eq_(RunJournal(filename, 'run').start({'seed': 2}), {'seed': 1})
+
+        writer = FakeWriter()
+        # the first flush of 3 routes does not complete chunk 0, which
+        # ends with a failed route, the second flush does
+        run(journal, writer, 3, stop_after=7)
+        eq_(journal.chunks(done=True), set([0]))
+        eq_(journal.chunks(done=False), set([1]))
+        eq_(writer.written, [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)])
+
+        # resume, where chunk 1 is partially written
+        resumed = FakeWriter()
+        run(RunJournal(filename, 'run'), resumed, 3,
+            written=lambda pairs: [x for x in pairs if x in writer.written])
+        eq_(journal.chunks(done=True), set([0, 1, 2]))
+        eq_(resumed.written, [(2, 0), (2, 1), (2, 2)])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_journal_check():
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'journal.sqlite')
+        ids = numpy.array([1, 2, 3])
+        coords = numpy.array([(10, 20), (30, 40), (50, 60)])
+        fingerprint = nodes_fingerprint(ids, coords)
+        eq_(fingerprint.split(':')[0], '3')
+        config = {'seed': 1, 'nodes': fingerprint}
+        RunJournal(filename, 'run').start(config, check=['nodes'])
+        eq_(RunJournal(filename, 'run').start(
+            dict(config, seed=2), check=['nodes']), config)
+        # the same nodes in another order sample other pairs
+        moved = nodes_fingerprint(ids[::-1], coords[::-1])
+        assert(moved != fingerprint)
+        assert_raises(ValueError, RunJournal(filename, 'run').start,
+                      dict(config, nodes=moved), check=['nodes'])
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+'''
+
+Tests for the deterministic edge and route keys
+
+'''
+
+import numpy
+from nose.tools import eq_
+
+from stanalysis.keys import edge_key, edge_keys, edge_key_nodes, route_hash
+
+
+def test_edge_key():
+    eq_(edge_key(1, 2), (1 << 32) | 2)
+    eq_(edge_key(2, 1), edge_key(1, 2))
+    eq_(edge_key(numpy.uint32(2), numpy.int64(1)), edge_key(1, 2))
+    # The largest keys wrap around to negative BIGINTs
+    eq_(edge_key(2 ** 32 - 1, 2 ** 32 - 2), -(1 << 32) - 1)
+
+
+def test_edge_keys():
+    sources = numpy.array([1, 5, 2 ** 32 - 1, 7], dtype=numpy.uint32)
+    sinks = numpy.array([2, 3, 2 ** 32 - 2, 7], dtype=numpy.uint32)
+    keys = edge_keys(sources, sinks)
+    eq_(keys.dtype, numpy.int64)
+    eq_(list(keys), [edge_key(a, b) for a, b in zip(sources, sinks)])
+    lo, hi = edge_key_nodes(keys)
+    eq_(list(lo), [1, 3, 2 ** 32 - 2, 7])
+    eq_(list(hi), [2, 5, 2 ** 32 - 1, 7])
+
+
+def test_route_hash():
+    # first 64 bits of md5('1') == c4ca4238a0b92382
+    eq_(route_hash(1), 0xc4ca4238a0b92382 - (1 << 64))
+    eq_(route_hash((1, 2), (3, 4)), route_hash(1, 2, 3, 4))
+    eq_(route_hash(numpy.array([1, 2]), (3, 4)), route_hash(1, 2, 3, 4))
+    assert(route_hash(1, 2, 3, 4) != route_hash(3, 4, 1, 2))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the in-process batched router
+
+'''
+
+from concurrent import futures
+import numpy
+from nose.tools import eq_
+
+from stanalysis.localrouter import LocalRouter
+from stanalysis.osrmbinary import OSRMNode, OSRMEdge
+from stanalysis.routegraph import RouteGraph
+
+
+def test_local_router():
+    graph = RouteGraph.grid(5, 5, spacing=10, origin=(0, 0), duration=5)
+    origins = [(0, 0), (20, 20), (40, 0)]
+    pairs = [(start, end) for start in origins
+             for end in [(40, 40), (0, 40), (30, 10)]]
+    # the backward runs share their target
+    pairs += [(end, start) for start, end in pairs]
+    router = LocalRouter(graph, processes=2, max_wait=0.5)
+    try:
+        with futures.ThreadPoolExecutor(len(pairs)) as executor:
+            results = list(executor.map(router, pairs))
+    finally:
+        router.close()
+    for pair, result in zip(pairs, results):
+        coords, url, steps = result
+        eq_(coords, pair)
+        eq_(url, 'local')
+        expected = graph.route(*pair)
+        eq_(steps[0].tolist(), expected[0].tolist())
+        eq_(steps[-1].tolist(), expected[-1].tolist())
+        eq_(steps[:, 1].sum(), expected[:, 1].sum())
+    eq_(router.routes, len(pairs))
+    assert(router.searches < len(pairs))
+
+
+def test_local_router_no_route():
+    nodes = numpy.zeros(2, dtype=OSRMNode.DTYPE)
+    nodes['id'] = [10, 20]
+    nodes['lat'] = [0, 1]
+    edges = numpy.zeros(1, dtype=OSRMEdge.DTYPE)
+    edges['node_a'] = [10]
+    edges['node_b'] = [20]
+    edges['weight'] = [5]
+    router = LocalRouter(RouteGraph.from_osrm(nodes, edges), processes=1)
+    try:
+        eq_(router(((1, 0), (0, 0))), None)
+        eq_(router(((0, 0), (1, 0)))[2].tolist(),
+            [[10, 0, 0, 0], [20, 5, 1, 0]])
+    finally:
+        router.close()
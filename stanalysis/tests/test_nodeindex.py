@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+'''
+
+Tests for the sorted OSRM node index
+
+'''
+
+import os
+import time
+
+import numpy
+from nose.tools import eq_, assert_raises
+
+from stanalysis.osrmbinary import OSRMNode
+from stanalysis.nodeindex import NodeIndex, INDEX_SUFFIX, \
+    INDEX_MANIFEST_SUFFIX
+from stanalysis.tests.test_osrmbinary import make_dummy_file, \
+    make_dummy_data
+
+
+def make_nodes():
+    nodes = numpy.zeros(4, dtype=OSRMNode.DTYPE)
+    nodes['id'] = [30, 10, 40, 20]
+    nodes['lat'] = [3, 1, 4, 2]
+    nodes['lon'] = [-3, -1, -4, -2]
+    nodes['bollard'] = [0, 1, 0, 0]
+    return nodes
+
+
+def test_rows():
+    index = NodeIndex.from_nodes(make_nodes())
+    eq_(len(index), 4)
+    eq_(list(index.rows([10, 20, 30, 40])), [1, 3, 0, 2])
+    # missing ids, including past either end of the index
+    eq_(list(index.rows([5, 25, 50])), [-1, -1, -1])
+
+
+def test_lookup():
+    index = NodeIndex.from_nodes(make_nodes())
+    records = index.lookup(numpy.array([40, 10, 10]))
+    eq_(list(records['lat']), [4, 1, 1])
+    eq_(list(records['lon']), [-4, -1, -1])
+    eq_(list(records['bollard']), [0, 1, 1])
+    eq_(list(records['row']), [2, 1, 1])
+    assert_raises(KeyError, index.lookup, [10, 11])
+
+
+def test_for_osrm_file():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    try:
+        index = NodeIndex.for_osrm_file(dummy_file.name)
+        assert(os.path.exists(dummy_file.name + INDEX_SUFFIX))
+        eq_(list(index.rows([99, 0])), [99, 0])
+        # second time around comes from the cache
+        cached = NodeIndex.for_osrm_file(dummy_file.name)
+        assert(isinstance(cached.index, numpy.memmap))
+        eq_(list(cached.lookup([42])['lat']), [42])
+    finally:
+        os.remove(dummy_file.name + INDEX_SUFFIX)
+        os.remove(dummy_file.name + INDEX_MANIFEST_SUFFIX)
+
+
+def test_for_osrm_file_changed():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    try:
+        # whole seconds, which os.utime restores exactly
+        mtime = int(time.time())
+        os.utime(dummy_file.name, (mtime, mtime))
+        eq_(list(NodeIndex.for_osrm_file(dummy_file.name).rows([99])),
+            [99])
+        # a rewrite of the same size within the mtime resolution is
+        # still noticed
+        new_nodes, new_edges, new_binary = make_dummy_data(100, 20)
+        new_binary.seek(4 + 99 * OSRMNode.PACKING.size)
+        new_binary.write(OSRMNode.PACKING.pack(0, 0, 100, 0, 0, 0, 0))
+        with open(dummy_file.name, 'wb') as outputfd:
+            outputfd.write(new_binary.getvalue())
+        os.utime(dummy_file.name, (mtime, mtime))
+        index = NodeIndex.for_osrm_file(dummy_file.name)
+        eq_(list(index.rows([99, 100])), [-1, 99])
+    finally:
+        os.remove(dummy_file.name + INDEX_SUFFIX)
+        os.remove(dummy_file.name + INDEX_MANIFEST_SUFFIX)
+
+
+def test_from_ids():
+    index = NodeIndex.from_ids([30, 10, 20])
+    eq_(list(index.rows([10, 20, 30, 15])), [1, 2, 0, -1])
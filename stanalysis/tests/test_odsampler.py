@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the grid bucket origin-destination sampler
+
+'''
+
+import numpy
+from nose.tools import eq_
+
+from stanalysis.odsampler import GridSampler, generate_random_choices_grid
+
+
+def test_grid_sampler_distribution():
+    # one point per cell, so the cell distances are exact
+    points = numpy.array(
+        [(x, y) for x in range(6) for y in range(6)]) * 10 + 5
+    sampler = GridSampler(points, scale=20, cell_size=10, radius=4)
+
+    deltas = points[:, numpy.newaxis, :] - points[numpy.newaxis, :, :]
+    expected = numpy.exp(-(numpy.hypot(*deltas.T) / 20.) ** 2)
+    numpy.fill_diagonal(expected, 0)
+    expected /= expected.sum()
+
+    counts = numpy.zeros_like(expected)
+    random = numpy.random.RandomState(1234)
+    for _ in range(10):
+        origins, destinations = sampler.sample(50000, random)
+        assert(not numpy.any(origins == destinations))
+        counts += numpy.bincount(
+            origins * len(points) + destinations,
+            minlength=counts.size).reshape(counts.shape)
+    observed = counts / counts.sum()
+    assert(numpy.allclose(observed, expected, atol=0.001))
+
+
+def test_grid_sampler_per_origin():
+    points = numpy.arange(2000).reshape(1000, 2)
+    sampler = GridSampler(points, scale=20)
+    origins, destinations = sampler.sample(
+        1000, numpy.random.RandomState(1), per_origin=5)
+    # the pairs of an origin are consecutive
+    changes = numpy.count_nonzero(origins[1:] != origins[:-1])
+    assert(changes < 200)
+    assert(len(set(destinations)) > 500)
+
+
+def test_grid_sampler_radius():
+    points = numpy.array([(0, 0), (1, 1), (100, 100), (101, 101)])
+    sampler = GridSampler(points, scale=2, radius=3)
+    origins, destinations = sampler.sample(1000)
+    # the two clusters are out of range of each other
+    eq_(set(zip(origins, destinations)), set([(0, 1), (1, 0), (2, 3), (3, 2)]))
+
+
+def test_grid_sampler_large_extent():
+    # a dense grid would have 1E16 cells
+    points = numpy.array([(0, 0), (1, 1), (10 ** 8, 10 ** 8),
+                          (10 ** 8 + 1, 10 ** 8 + 1)])
+    sampler = GridSampler(points, scale=2, cell_size=1)
+    eq_(len(sampler.cells), 4)
+    origins, destinations = sampler.sample(1000)
+    eq_(set(zip(origins, destinations)), set([(0, 1), (1, 0), (2, 3), (3, 2)]))
+
+
+def test_generate_random_choices_grid():
+    points = numpy.arange(200).reshape(100, 2)
+    result = list(generate_random_choices_grid(25, points, 10, 7, seed=42))
+    eq_(len(result), 25)
+    again = list(generate_random_choices_grid(25, points, 10, 7, seed=42))
+    assert(numpy.array_equal(result, again))
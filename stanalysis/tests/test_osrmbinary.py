@@ -6,7 +6,10 @@ Tests for reading OSRM binary data
 '''
 
 from StringIO import StringIO
+import numpy
+import pickle
 import struct
+import tempfile
 
 
 #from nose.tools import eq_
@@ -16,6 +19,10 @@ def eq_(a, b):
 
 from stanalysis.osrmbinary import unpack_osrm_nodes, unpack_osrm_edges
 from stanalysis.osrmbinary import OSRMEdge, OSRMNode, read_uint32
+from stanalysis.osrmbinary import read_osrm_nodes, read_osrm_edges
+from stanalysis.osrmbinary import OSRMFile, read_osrm_edges_parallel
+from stanalysis.osrmbinary import unique_edge_rows
+from stanalysis.osrmbinary import unpack_osrm_data
 
 
 def make_dummy_data(n_nodes, n_edges):
@@ -39,6 +46,16 @@ def make_dummy_data(n_nodes, n_edges):
     return output_nodes, output_edges, output
 
 
+def make_dummy_file(n_nodes, n_edges):
+    """Write dummy OSRM data to a temporary file"""
+    dummy_nodes, dummy_edges, dummy_binary = make_dummy_data(
+        n_nodes, n_edges)
+    output = tempfile.NamedTemporaryFile(suffix='.osrm')
+    output.write(dummy_binary.getvalue())
+    output.flush()
+    return dummy_nodes, dummy_edges, output
+
+
 def test_read_uint32():
     my_io = StringIO()
     my_io.write(struct.pack('<I', 99))
@@ -67,6 +84,70 @@ def test_unpack_edges():
     #eq_(dummy_edges, new_edges)
 
 
+def test_unpack_chunks():
+    dummy_nodes, dummy_edges, dummy_binary = make_dummy_data(100, 20)
+    # chunks which don't divide the section evenly
+    new_nodes = list(unpack_osrm_data(OSRMNode, dummy_binary, 0, 7))
+    eq_(new_nodes, dummy_nodes)
+
+
+def test_packing_dtypes():
+    eq_(OSRMNode.DTYPE.itemsize, OSRMNode.PACKING.size)
+    eq_(OSRMEdge.DTYPE.itemsize, OSRMEdge.PACKING.size)
+    eq_(OSRMNode.DTYPE.names, OSRMNode._fields)
+    eq_(OSRMEdge.DTYPE.names, OSRMEdge._fields)
+
+
+def test_read_node_array():
+    dummy_nodes, dummy_edges, dummy_binary = make_dummy_data(100, 20)
+    nodes = read_osrm_nodes(dummy_binary)
+    eq_(len(nodes), 100)
+    eq_(OSRMNode(*nodes[5].tolist()), dummy_nodes[5])
+    eq_(list(nodes['id']), range(100))
+
+
+def test_read_edge_array():
+    dummy_nodes, dummy_edges, dummy_binary = make_dummy_data(100, 20)
+    edges = read_osrm_edges(dummy_binary)
+    eq_(len(edges), 20)
+    eq_([OSRMEdge(*x) for x in edges.tolist()], dummy_edges)
+
+
+def test_osrm_file():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    with OSRMFile(dummy_file.name) as osrm:
+        eq_(len(osrm.nodes), 100)
+        eq_(len(osrm.edges), 20)
+        eq_(osrm.node(42), dummy_nodes[42])
+        eq_(osrm.edge(19), dummy_edges[19])
+        # slices are views on the map
+        sliced = osrm.edges[5:10]
+        eq_(sliced.base is not None, True)
+        eq_(list(sliced['node_a']), range(5, 10))
+        # pickling re-maps the file
+        restored = pickle.loads(pickle.dumps(osrm))
+        eq_(restored.edge(3), dummy_edges[3])
+
+
+def test_read_edges_parallel():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    chunks = read_osrm_edges_parallel(
+        dummy_file.name, processes=2, chunk_size=7, concatenate=False)
+    eq_([len(x) for x in chunks], [7, 7, 6])
+    edges = read_osrm_edges_parallel(
+        dummy_file.name, processes=2, chunk_size=7)
+    eq_([OSRMEdge(*x) for x in edges.tolist()], dummy_edges)
+
+
+def test_unique_edge_rows():
+    edges = numpy.zeros(6, dtype=OSRMEdge.DTYPE)
+    edges['node_a'] = [1, 2, 2, 3, 2**32 - 1, 1]
+    edges['node_b'] = [2, 3, 1, 2, 1, 2**32 - 1]
+    rows, dropped = unique_edge_rows(edges)
+    eq_(list(rows), [0, 1, 4])
+    eq_(dropped, 3)
+
+
 if __name__ == "__main__":
     test_read_uint32()
     test_unpack_nodes()
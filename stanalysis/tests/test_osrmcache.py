@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''
+
+Tests for the parsed OSRM column cache
+
+'''
+
+import os
+import shutil
+import tempfile
+
+import numpy
+from nose.tools import eq_
+
+from stanalysis.osrmbinary import OSRMFile
+from stanalysis.osrmcache import load_osrm_columns, is_cache_valid, \
+    open_osrm
+from stanalysis.tests.test_osrmbinary import make_dummy_file, \
+    make_dummy_data
+
+
+def test_column_cache():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        assert(not is_cache_valid(dummy_file.name, cache_dir))
+        nodes, edges = load_osrm_columns(dummy_file.name, cache_dir)
+        eq_(len(nodes), 100)
+        eq_(len(edges), 20)
+        eq_(list(nodes['id']), range(100))
+        eq_(list(edges['weight']), range(20))
+        assert(is_cache_valid(dummy_file.name, cache_dir))
+
+        # Touching the file keeps the cache, since the content is the same
+        stat = os.stat(dummy_file.name)
+        os.utime(dummy_file.name, (stat.st_atime, stat.st_mtime + 10))
+        assert(is_cache_valid(dummy_file.name, cache_dir))
+
+        nodes, edges = load_osrm_columns(dummy_file.name, cache_dir)
+        assert(isinstance(nodes['lat'], numpy.memmap))
+
+        # Changing the content invalidates the cache
+        new_nodes, new_edges, new_binary = make_dummy_data(50, 10)
+        with open(dummy_file.name, 'wb') as outputfd:
+            outputfd.write(new_binary.getvalue())
+        assert(not is_cache_valid(dummy_file.name, cache_dir))
+        nodes, edges = load_osrm_columns(dummy_file.name, cache_dir)
+        eq_(len(nodes), 50)
+        eq_(len(edges), 10)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_open_osrm_parallel():
+    dummy_nodes, dummy_edges, dummy_file = make_dummy_file(100, 20)
+    nodes, edges = open_osrm(dummy_file.name, use_cache=False, processes=2)
+    eq_(len(nodes), 100)
+    assert(not isinstance(edges, numpy.memmap))
+    eq_(edges.tolist(), OSRMFile(dummy_file.name).edges.tolist())
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the packed storage of route steps
+
+'''
+
+import numpy
+from nose.tools import eq_
+from sqlalchemy import func
+
+from stanalysis.tests.mockdb import test_db_session
+from stanalysis.edgefreq import EdgeFrequencyAccumulator
+from stanalysis.keys import edge_key
+from stanalysis.models import OSRMEdgeFrequencies, OSRMNode, OSRMEdge, \
+    OSRMRoute, OSRMCountedRoute
+from stanalysis.packedsteps import pack_route, unpack_route, unpack_edges, \
+    copy_literal, count_packed_edges, refresh_frequencies, \
+    recount_frequencies
+from stanalysis.routerunner import convert_steps
+from stanalysis.routewriter import RouteWriter, convert_route
+
+
+def test_pack_route():
+    node_ids = numpy.array([5, 3, 2 ** 32 - 1, 9, 5])
+    packed = pack_route(node_ids)
+    eq_(unpack_route(packed).tolist(), node_ids.tolist())
+    edge_ids, forwards = unpack_edges(packed)
+    eq_(edge_ids.tolist(), [edge_key(5, 3), edge_key(3, 2 ** 32 - 1),
+                            edge_key(2 ** 32 - 1, 9), edge_key(9, 5)])
+    eq_(forwards.tolist(), [False, True, False, False])
+    eq_(len(unpack_route(pack_route([]))), 0)
+
+
+def test_packed_matches_rows():
+    steps = numpy.zeros((200, 4), dtype=int)
+    steps[:, 0] = 1000000 + numpy.cumsum(
+        numpy.random.RandomState(0).randint(-50, 50, 200))
+    packed = pack_route(steps[:, 0])
+    edge_ids, forwards = unpack_edges(packed)
+    expected = convert_steps(steps)
+    eq_(edge_ids.tolist(), expected[0].tolist())
+    eq_(forwards.tolist(), expected[1].tolist())
+    # several times smaller than the step rows
+    assert(len(packed) * 4 < len(edge_ids) * (8 + 4 + 8 + 1))
+
+
+def test_copy_literal():
+    eq_(copy_literal(None), '\\N')
+    eq_(copy_literal('\x01\xff'), '\\\\x01ff')
+
+
+def test_count_packed_edges():
+    accumulator = EdgeFrequencyAccumulator()
+    uncounted = EdgeFrequencyAccumulator()
+    eq_(count_packed_edges(
+        [(pack_route([1, 2, 3]), False), (pack_route([3, 2]), True)],
+        accumulator, uncounted), 2)
+    eq_(accumulator.counts().tolist(), [
+        (edge_key(1, 2), 1, 1),
+        (edge_key(2, 3), 0, 1),
+        (edge_key(2, 3), 1, 1)])
+    # the route already counted is left out
+    eq_(uncounted.counts().tolist(), [
+        (edge_key(1, 2), 1, 1),
+        (edge_key(2, 3), 1, 1)])
+
+
+def test_refresh_frequencies():
+    with test_db_session() as session:
+        for node_id in (1, 2, 3):
+            session.add(OSRMNode(node_id, node_id, node_id, False, False))
+        session.add(OSRMEdge(1, 2, 5, 5, True))
+        session.add(OSRMEdge(2, 3, 5, 5, True))
+        session.commit()
+        connection = session.connection().connection
+        cursor = connection.cursor()
+        # as left by edge-frequencies.sql over no routes
+        cursor.execute(
+            "CREATE TABLE edgefrequencies_watermark (seq BIGINT NOT NULL);"
+            "INSERT INTO edgefrequencies_watermark VALUES (0);"
+            "CREATE TABLE edgefrequencies_bothways (edge BIGINT PRIMARY KEY, "
+            "freq BIGINT, logfreq FLOAT, speed FLOAT, geom geometry)")
+        connection.commit()
+        try:
+            def route(start, end, node_ids):
+                steps = numpy.array([(x, 10, 0, 0) for x in node_ids])
+                return convert_route(((start, end), 'url', steps))
+
+            def freqs():
+                return dict(((x.edge, x.forward), x.freq) for x in
+                            session.query(OSRMEdgeFrequencies))
+            # packed and counted as written, packed only, and rows only
+            with RouteWriter(connection, write_steps=False,
+                             packed_steps=True,
+                             frequencies=EdgeFrequencyAccumulator()) as w:
+                w.add(route((1, 1), (3, 3), [1, 2, 3]))
+            with RouteWriter(connection, write_steps=False,
+                             packed_steps=True) as w:
+                w.add(route((3, 3), (1, 1), [3, 2, 1]))
+            with RouteWriter(connection) as w:
+                w.add(route((1, 1), (2, 2), [1, 2]))
+            expected = {
+                (edge_key(1, 2), True): 2,
+                (edge_key(1, 2), False): 1,
+                (edge_key(2, 3), True): 1,
+                (edge_key(2, 3), False): 1,
+            }
+            refresh_frequencies(connection)
+            eq_(freqs(), expected)
+            eq_(session.query(OSRMCountedRoute).count(), 0)
+            # nothing new to count
+            refresh_frequencies(connection)
+            eq_(freqs(), expected)
+            cursor.execute("SELECT seq FROM edgefrequencies_watermark")
+            eq_(cursor.fetchone()[0],
+                session.query(func.max(OSRMRoute.seq)).scalar())
+            # a recount includes the routes without packed steps
+            recount_frequencies(connection)
+            eq_(freqs(), expected)
+        finally:
+            connection.rollback()
+            cursor.execute("DROP TABLE IF EXISTS edgefrequencies_watermark; "
+                           "DROP TABLE IF EXISTS edgefrequencies_bothways")
+            connection.commit()
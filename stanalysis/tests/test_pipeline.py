@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+'''
+
+Tests for the threaded stage pipeline
+
+'''
+
+from nose.tools import eq_, assert_raises
+
+from stanalysis.pipeline import Pipeline
+
+
+def test_pipeline():
+    results = []
+    pipeline = Pipeline(xrange(100))
+    pipeline.add_stage('double', lambda x: 2 * x, workers=4, maxsize=3)
+    # None results are dropped
+    pipeline.add_stage('odd', lambda x: x if x % 4 else None, workers=2,
+                       maxsize=3)
+    pipeline.add_stage('collect', results.append, maxsize=3)
+    pipeline.run()
+    eq_(sorted(results), [2 * x for x in range(100) if x % 2])
+    eq_([x[0] for x in pipeline.queue_depths()],
+        ['double', 'odd', 'collect'])
+    eq_([x[2] for x in pipeline.queue_depths()], [100, 100, 50])
+
+
+def test_pipeline_error():
+    def fail(x):
+        if x == 50:
+            raise ValueError("fail")
+        return x
+
+    # the source is endless, so this only finishes if the error stops it
+    def forever():
+        i = 0
+        while True:
+            yield i
+            i += 1
+
+    pipeline = Pipeline(forever())
+    pipeline.add_stage('fail', fail, workers=2, maxsize=2)
+    pipeline.add_stage('sink', lambda x: None, maxsize=2)
+    assert_raises(ValueError, pipeline.run)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the in-memory route graph
+
+'''
+
+import numpy
+from nose.tools import eq_
+
+from stanalysis.osrmbinary import OSRMNode, OSRMEdge
+from stanalysis import routegraph
+from stanalysis.routegraph import RouteGraph
+
+
+def test_grid_route():
+    graph = RouteGraph.grid(3, 4, spacing=10, origin=(0, 0), duration=5)
+    eq_(graph.matrix.nnz, 2 * (2 * 4 + 3 * 3))
+    steps = graph.route((1, 2), (19, 31))
+    eq_(steps[0].tolist(), [0, 0, 0, 0])
+    eq_(steps[-1].tolist(), [11, 5, 20, 30])
+    # a shortest path on the grid
+    eq_(len(steps), 6)
+    eq_(steps[:, 1].sum(), 25)
+
+
+def test_osrm_graph():
+    nodes = numpy.zeros(3, dtype=OSRMNode.DTYPE)
+    nodes['id'] = [30, 10, 20]
+    nodes['lat'] = [2, 0, 1]
+    edges = numpy.zeros(3, dtype=OSRMEdge.DTYPE)
+    edges['node_a'] = [10, 20, 10]
+    edges['node_b'] = [20, 30, 20]
+    edges['weight'] = [5, 7, 3]
+    edges['bidirectional'] = [1, 0, 1]
+    graph = RouteGraph.from_osrm(nodes, edges)
+    steps = graph.route((0, 0), (2, 0))
+    # the faster of the parallel edges is taken
+    eq_(steps.tolist(), [[10, 0, 0, 0], [20, 3, 1, 0], [30, 7, 2, 0]])
+    # the last edge is one way
+    eq_(graph.route((2, 0), (0, 0)), None)
+
+
+def test_dangling_edges():
+    nodes = numpy.zeros(3, dtype=OSRMNode.DTYPE)
+    nodes['id'] = [30, 10, 20]
+    nodes['lat'] = [2, 0, 1]
+    edges = numpy.zeros(4, dtype=OSRMEdge.DTYPE)
+    # edges to nodes which are not in the node list
+    edges['node_a'] = [10, 20, 25, 99]
+    edges['node_b'] = [20, 30, 10, 30]
+    edges['weight'] = [5, 7, 1, 1]
+    edges['bidirectional'] = 1
+    graph = RouteGraph.from_osrm(nodes, edges)
+    eq_(graph.matrix.nnz, 4)
+    steps = graph.route((0, 0), (2, 0))
+    eq_(steps.tolist(), [[10, 0, 0, 0], [20, 5, 1, 0], [30, 7, 2, 0]])
+
+
+def test_routes_to():
+    graph = RouteGraph.grid(3, 4, spacing=10, origin=(0, 0), duration=5)
+    target = graph.snap([(20, 30)])[0]
+    sources = graph.snap([(0, 0), (10, 30), (20, 30)])
+    routes = graph.routes_to(target, sources)
+    for source, steps in zip(sources, routes):
+        forward = graph.routes_from(source, [target])[0]
+        eq_(steps[0].tolist(), forward[0].tolist())
+        eq_(steps[-1, 0], forward[-1, 0])
+        eq_(steps[:, 1].sum(), forward[:, 1].sum())
+        eq_(len(steps), len(forward))
+    eq_(routes[2].tolist(), [[11, 0, 20, 30]])
+
+
+def test_limited_search():
+    graph = RouteGraph.grid(20, 20, spacing=10, origin=(0, 0), duration=5)
+    source = graph.snap([(0, 0)])[0]
+    near, far = graph.snap([(10, 10), (190, 190)])
+    # a search stops soon after the nearby targets
+    distances, _ = graph._search(graph.matrix, source, [near])
+    assert(numpy.isinf(distances).sum() > len(distances) / 2)
+    # and is widened for those further than expected
+    graph.pace = 0.01
+    distances, _ = graph._search(graph.matrix, source, [near, far])
+    eq_(distances[far], 5 * 38)
+    eq_(graph.routes_from(source, [far])[0][:, 1].sum(), 5 * 38)
+
+
+def test_unlimited_search():
+    graph = RouteGraph.grid(5, 5, spacing=10, origin=(0, 0), duration=5)
+    source, target = graph.snap([(0, 0), (40, 40)])
+    limited = graph.routes_from(source, [target])[0]
+    # scipy before 0.14 has no search limit
+    supported, routegraph.DIJKSTRA_LIMIT = routegraph.DIJKSTRA_LIMIT, False
+    try:
+        distances, _ = graph._search(graph.matrix, source, [target])
+        assert(numpy.isfinite(distances).all())
+        unlimited = graph.routes_from(source, [target])[0]
+    finally:
+        routegraph.DIJKSTRA_LIMIT = supported
+    eq_(unlimited.tolist(), limited.tolist())
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
+from concurrent import futures
 import numpy
 import math
+import os
+import shutil
+import tempfile
 from nose.tools import eq_
 
 from stanalysis.routerunner import generate_random_choices, build_osrm_url,\
-    parse_osrm_output, generate_random_choices_exponential
+    parse_osrm_output, generate_random_choices_exponential, \
+    convert_steps, sample_pairs_exponential, generate_random_choices_batched, \
+    RouteCache, CachedRouteRunner
+from stanalysis.keys import edge_key
 
 
 def test_generate_random_choice():
@@ -52,6 +59,49 @@ def test_generate_random_choice_weighted():
     assert(numpy.array_equal(result, standard_impl))
 
 
+def test_sample_pairs_exponential():
+    points = numpy.array(
+        [(8, 1), (2, 1), (5, 1), (7, 4), (4, 0)],
+        dtype=int)
+    max_distance = numpy.hypot(6, 0)
+    # expected pair distribution of the per-pair sampler
+    expected = numpy.zeros((5, 5))
+    for i in range(4):
+        for j in range(4):
+            if i != j:
+                distance = numpy.hypot(*(points[i] - points[j]))
+                expected[i, j] = math.exp(-(distance / max_distance) ** 2)
+    expected /= expected.sum()
+
+    counts = numpy.zeros((5, 5))
+    samples = sample_pairs_exponential(points, 10000, seed=1234)
+    for _ in range(20):
+        starts, ends = next(samples)
+        assert(not numpy.any(starts == ends))
+        numpy.add.at(counts, (starts, ends), 1)
+    observed = counts / counts.sum()
+    assert(numpy.allclose(observed, expected, atol=0.005))
+
+    # sharing origins leaves the pair distribution unchanged
+    counts = numpy.zeros((5, 5))
+    samples = sample_pairs_exponential(points, 10000, seed=1234,
+                                       per_origin=4)
+    for _ in range(20):
+        starts, ends = next(samples)
+        numpy.add.at(counts, (starts, ends), 1)
+    observed = counts / counts.sum()
+    assert(numpy.allclose(observed, expected, atol=0.005))
+
+
+def test_generate_random_choices_batched():
+    points = numpy.arange(20).reshape(10, 2)
+    result = list(generate_random_choices_batched(25, points, 7, seed=42))
+    eq_(len(result), 25)
+    # seeded runs are reproducible
+    again = list(generate_random_choices_batched(25, points, 7, seed=42))
+    assert(numpy.array_equal(result, again))
+
+
 def test_build_osrm_url():
     eq_(build_osrm_url(((34E5, -118E5), (35E5, -118E5)), 'the_host', 9999),
         'http://the_host:9999/viaroute?loc=34.000000,-118.000000&'
@@ -72,3 +122,88 @@ def test_parse_osrm_output():
     result = parse_osrm_output(MockResponse())
     assert(numpy.array_equal(
         result, numpy.array([[0, 1, 2, 3], [4, 5, 6, 7]], dtype=int)))
+
+
+def test_convert_steps():
+    steps = numpy.array([
+        [5, 0, 1, 1],
+        [3, 10, 2, 2],
+        [9, 12, 3, 3],
+        [5, 8, 4, 4]], dtype=int)
+    edge_ids, forwards, step_idxs = convert_steps(steps)
+    eq_(list(edge_ids), [edge_key(5, 3), edge_key(3, 9), edge_key(9, 5)])
+    eq_(list(forwards), [False, True, False])
+    eq_(list(step_idxs), [0, 1, 2])
+    # a single node has no edges
+    eq_([len(x) for x in convert_steps(steps[:1])], [0, 0, 0])
+
+
+def test_route_cache():
+    tempdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tempdir, 'routes.sqlite')
+        steps = numpy.array([[5, 0, 1, 1], [3, 10, 2, 2]], dtype=int)
+        cache = RouteCache(filename, 'abc')
+        eq_(cache.get(((1, 2), (3, 4))), None)
+        cache.put(((1, 2), (3, 4)), 'url', steps)
+        coords, url, cached = cache.get(((1, 2), (3, 4)))
+        eq_(url, 'url')
+        assert(numpy.array_equal(cached, steps))
+        # directions and datasets are cached separately
+        eq_(cache.get(((3, 4), (1, 2))), None)
+        eq_(RouteCache(filename, 'def').get(((1, 2), (3, 4))), None)
+
+        # usable from other threads
+        def get_from_thread():
+            return cache.get(((1, 2), (3, 4)))[1]
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            eq_(list(executor.map(lambda _: get_from_thread(), range(4))),
+                ['url'] * 4)
+
+        calls = []
+
+        def fake_runner(coords):
+            calls.append(coords)
+            return coords, 'other', steps
+        runner = CachedRouteRunner(fake_runner, cache)
+        runner(((1, 2), (3, 4)))
+        runner(((3, 4), (1, 2)))
+        runner(((3, 4), (1, 2)))
+        eq_(calls, [((3, 4), (1, 2))])
+        eq_((runner.hits, runner.misses), (2, 1))
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_route_cache_eviction():
+    tempdir = tempfile.mkdtemp()
+    try:
+        steps = numpy.arange(400).reshape(100, 4)
+        cache = RouteCache(os.path.join(tempdir, 'routes.sqlite'))
+        cache.put(((0, 0), (1, 1)), 'url', steps)
+        size = cache.connection.execute(
+            'SELECT size FROM routes').fetchone()[0]
+        cache.max_bytes = 3 * size
+        for i in range(1, 4):
+            cache.put(((i, i), (1, 1)), 'url', steps)
+        # the first route was used least recently
+        eq_(len(cache), 2)
+        eq_(cache.get(((0, 0), (1, 1))), None)
+        assert(cache.get(((3, 3), (1, 1))) is not None)
+        eq_(cache.size(), 2 * size)
+        # replacing a route doesn't add to the total
+        cache.put(((3, 3), (1, 1)), 'url', steps)
+        eq_(cache.size(), 2 * size)
+
+        # hits are batched, but written before evicting
+        cache.touch_batch = 10
+        cache.put(((4, 4), (1, 1)), 'url', steps)
+        assert(cache.get(((2, 2), (1, 1))) is not None)
+        eq_(len(cache._touched), 1)
+        cache.put(((5, 5), (1, 1)), 'url', steps)
+        eq_(len(cache._touched), 0)
+        assert(cache.get(((2, 2), (1, 1))) is not None)
+        eq_(cache.get(((3, 3), (1, 1))), None)
+        eq_(cache.get(((4, 4), (1, 1))), None)
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the buffered COPY route writer
+
+'''
+
+import logging
+import numpy
+from nose.tools import eq_
+logging.basicConfig(level=logging.WARNING)
+
+log = logging.getLogger(__name__)
+
+from stanalysis.tests.mockdb import test_db_session
+from stanalysis.models import OSRMRoute, OSRMRouteStep, OSRMEdge
+from stanalysis.packedsteps import unpack_route
+from stanalysis.routewriter import RouteWriter, convert_route
+
+
+def make_route(start, end, node_ids):
+    steps = numpy.array(
+        [(node_id, 10, 0, 0) for node_id in node_ids], dtype=int)
+    return (start, end), 'http://query', steps
+
+
+def test_convert_route():
+    converted = convert_route(make_route((1, 2), (3, 4), [5, 6, 4]))
+    eq_(converted.route_hash, OSRMRoute.hash_route((1, 2), (3, 4)))
+    eq_(converted.duration, 30)
+    eq_(converted.nsteps, 3)
+    eq_(list(converted.edge_ids),
+        [OSRMEdge.hash_edge(5, 6), OSRMEdge.hash_edge(6, 4)])
+    eq_(list(converted.forwards), [True, False])
+    eq_(convert_route(make_route((1, 2), (3, 4), [])), None)
+
+
+def test_route_writer():
+    with test_db_session() as session:
+        writer = RouteWriter(session.connection().connection,
+                             max_rows=3, max_seconds=1000)
+        writer.add(convert_route(make_route((1, 2), (3, 4), [5, 6])))
+        eq_(writer.routes_written, 0)
+        # buffered steps reach max_rows
+        writer.add(convert_route(make_route((3, 4), (1, 2), [6, 5, 7])))
+        eq_(writer.routes_written, 2)
+        # already written routes are not written again
+        with writer:
+            writer.add(convert_route(make_route((1, 2), (3, 4), [5, 6])))
+            writer.add(convert_route(make_route((1, 2), (5, 6), [5, 8])))
+        # only the new route is counted
+        eq_(writer.routes_written, 3)
+        eq_(writer.steps_written, 4)
+        eq_(session.query(OSRMRoute).count(), 3)
+        eq_(session.query(OSRMRouteStep).count(), 4)
+        steps = session.query(OSRMRouteStep).filter_by(
+            route_hash=OSRMRoute.hash_route((3, 4), (1, 2))).order_by(
+                OSRMRouteStep.step_idx).all()
+        eq_([x.edge_id for x in steps],
+            [OSRMEdge.hash_edge(5, 6), OSRMEdge.hash_edge(5, 7)])
+        eq_([x.forward for x in steps], [False, True])
+
+
+def test_route_seq():
+    with test_db_session() as session:
+        writer = RouteWriter(session.connection().connection)
+        with writer:
+            writer.add(convert_route(make_route((1, 2), (3, 4), [5, 6])))
+        with writer:
+            writer.add(convert_route(make_route((3, 4), (1, 2), [6, 5])))
+        # raw inserts are numbered in the order they are written
+        seqs = [x.seq for x in session.query(OSRMRoute).order_by(
+            OSRMRoute.seq)]
+        eq_([x.start_lat for x in session.query(OSRMRoute).order_by(
+            OSRMRoute.seq)], [1, 3])
+        assert(seqs[0] < seqs[1])
+
+
+def test_packed_steps():
+    with test_db_session() as session:
+        writer = RouteWriter(session.connection().connection,
+                             write_steps=False, packed_steps=True)
+        with writer:
+            writer.add(convert_route(make_route((1, 2), (3, 4), [5, 6, 4])))
+        route = session.query(OSRMRoute).one()
+        eq_(unpack_route(route.steps).tolist(), [5, 6, 4])
+        eq_(session.query(OSRMRouteStep).count(), 0)
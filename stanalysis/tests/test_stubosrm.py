@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+'''
+
+Test the stand-in OSRM server
+
+'''
+
+import requests
+from nose.tools import eq_
+
+from stanalysis.routegraph import RouteGraph
+from stanalysis.routerunner import run_route, RouteClient
+from stanalysis.stubosrm import start_stub_server
+
+
+def test_stub_server():
+    graph = RouteGraph.grid(3, 4, spacing=10, origin=(3400000, -11800000))
+    server = start_stub_server(graph)
+    host, port = server.server_address
+    try:
+        coords = ((3400000, -11800000), (3400020, -11799970))
+        result = run_route(coords, host, port)
+        eq_(result[0], coords)
+        eq_(result[2].tolist(), graph.route(*coords).tolist())
+
+        client = RouteClient(host, port, 2)
+        eq_(client(coords)[2].tolist(), result[2].tolist())
+        client.close()
+
+        response = requests.get('http://%s:%i/nearest?loc=1,2' % (host, port))
+        eq_(response.status_code, 400)
+    finally:
+        server.shutdown()
+        server.server_close()